@@ -0,0 +1,556 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 Boundless Spatial
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+'''
+Helpers for measuring search performance.
+
+ElasticsearchStandIn is a small threaded HTTP server that answers the
+handful of Elasticsearch endpoints used by exchange.search with canned
+responses, and records every request it receives.
+
+SearchBenchmark runs the elastic_search view over a mix of queries, either
+against a synthetic catalogue loaded into a real cluster or against a
+stand-in replaying a recorded response, and reports latency percentiles
+and Elasticsearch round trips per request.
+'''
+
+import json
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from six.moves import BaseHTTPServer, socketserver
+
+
+EMPTY_SEARCH_RESPONSE = {
+    'took': 1,
+    'timed_out': False,
+    '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+    'hits': {'total': 0, 'max_score': None, 'hits': []},
+}
+SCROLL_ID = 'standin-scroll'
+
+
+# aggregations that wrap their sub aggregations in a single bucket
+SINGLE_BUCKET_AGGREGATIONS = ['global', 'filter', 'missing', 'nested',
+                              'reverse_nested', 'sampler']
+METRIC_AGGREGATIONS = ['min', 'max', 'avg', 'sum', 'cardinality',
+                       'value_count']
+
+
+def empty_aggregations(aggs):
+    '''
+    Build the response Elasticsearch gives for `aggs` when nothing matches.
+    '''
+    results = {}
+    for name, agg in aggs.items():
+        nested = agg.get('aggs', agg.get('aggregations', {}))
+        kind = [k for k in agg if k not in ('aggs', 'aggregations', 'meta')][0]
+        if kind in SINGLE_BUCKET_AGGREGATIONS:
+            result = {'doc_count': 0}
+            result.update(empty_aggregations(nested))
+        elif kind in METRIC_AGGREGATIONS:
+            result = {'value': None}
+        else:
+            result = {'buckets': []}
+        results[name] = result
+    return results
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep their connections alive
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.record_connection()
+
+    def respond(self):
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+        path = self.path.split('?')[0]
+        status, payload = self.server.handle_es_request(
+            self.command, path, body)
+        data = json.dumps(payload).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ElasticsearchStandIn(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    '''
+    Local stand-in for an Elasticsearch node.
+
+    `indices` is the list of index names reported by alias lookups,
+    `search_response` is returned for every _search call (as the only
+    batch of a scroll when one is requested) and `latency`
+    (seconds) is added to each request to simulate a remote cluster.
+    Setting `search_status` to an error status fails every search.
+    Indices in `missing_indices` do not exist until they are created.
+    Field mapping lookups report every field mapped on every index but
+    those in `unmapped_fields`.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, indices=None, search_response=None, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), _StandInHandler)
+        self.indices = indices or ['layer-index', 'map-index']
+        self.search_response = search_response or EMPTY_SEARCH_RESPONSE
+        self.latency = latency
+        self.search_status = 200
+        self.missing_indices = set()
+        self.unmapped_fields = set()
+        self.connections = 0
+        self.requests = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address)
+
+    def record_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def handle_es_request(self, method, path, body):
+        with self._lock:
+            self.requests.append((method, path, body))
+        if self.latency:
+            time.sleep(self.latency)
+
+        if '_search' in path and self.search_status != 200:
+            return self.search_status, {
+                'error': 'search failed', 'status': self.search_status}
+        if path.endswith('/_bulk'):
+            return 200, self.get_bulk_response(body)
+        if path.endswith('/_msearch'):
+            lines = [ln for ln in body.splitlines() if ln.strip()]
+            return 200, {'responses': [
+                self.get_search_response(json.loads(ln))
+                for ln in lines[1::2]]}
+        if path.endswith('/_search/scroll'):
+            if method == 'DELETE':
+                return 200, {'succeeded': True, 'num_freed': 1}
+            # every hit was returned with the first batch
+            response = dict(EMPTY_SEARCH_RESPONSE)
+            response['_scroll_id'] = SCROLL_ID
+            return 200, response
+        if path.endswith('/_search'):
+            return 200, self.get_search_response(
+                json.loads(body) if body else {})
+        index = path.strip('/').split('/')[0]
+        if index in self.missing_indices:
+            if method == 'PUT' and path.strip('/') == index:
+                self.missing_indices.discard(index)
+                return 200, {'acknowledged': True, 'index': index}
+            return 404, {'error': 'index_not_found_exception', 'status': 404}
+        if '/_mapping/field/' in path and method == 'GET':
+            fields = [f for f in path.rsplit('/', 1)[1].split(',')
+                      if f not in self.unmapped_fields]
+            return 200, dict((i, {'mappings': {'doc': dict(
+                (f, {'full_name': f, 'mapping': {f: {}}}) for f in fields
+            )}}) for i in index.split(','))
+        if path.endswith('/_mapping') and method == 'GET':
+            return 200, {index: {'mappings': {'doc': {'properties': {}}}}}
+        if '/_alias' in path:
+            return 200, dict((i, {'aliases': {}}) for i in self.indices)
+        if path == '/':
+            return 200, {
+                'name': 'standin',
+                'version': {'number': '6.1.1'},
+                'tagline': 'You Know, for Search'
+            }
+        return 200, {'acknowledged': True}
+
+    def get_bulk_response(self, body):
+        items = []
+        lines = iter(ln for ln in body.splitlines() if ln.strip())
+        for line in lines:
+            op_type, meta = json.loads(line).popitem()
+            if op_type != 'delete':
+                next(lines)
+            items.append({op_type: {
+                '_index': meta['_index'],
+                '_type': meta.get('_type', 'doc'),
+                '_id': str(meta['_id']),
+                'status': 200
+            }})
+        return {'took': 1, 'errors': False, 'items': items}
+
+    def get_search_response(self, body):
+        response = dict(self.search_response)
+        response['_scroll_id'] = SCROLL_ID
+        aggs = body.get('aggs', body.get('aggregations'))
+        if aggs:
+            # aggregations missing from the canned response match nothing
+            aggregations = empty_aggregations(aggs)
+            aggregations.update(response.get('aggregations', {}))
+            response['aggregations'] = aggregations
+        return response
+
+    def reset_counters(self):
+        with self._lock:
+            self.connections = 0
+            self.requests = []
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def time_calls(func, count):
+    '''
+    Call func() count times and return the list of durations in seconds.
+    '''
+    timings = []
+    for i in range(count):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return timings
+
+
+# share of each resource type in the synthetic catalogue
+CATALOGUE_TYPES = [('layer', 0.6), ('map', 0.2), ('document', 0.15),
+                   ('story', 0.05)]
+CATALOGUE_SUBTYPES = ['vector', 'raster', 'remote']
+CATALOGUE_CATEGORIES = ['boundaries', 'elevation', 'environment',
+                        'imageryBaseMapsEarthCover', 'inlandWaters',
+                        'location', 'society', 'transportation']
+CATALOGUE_HOSTS = [None, None, None, 'registry.example.com',
+                   'maps.example.org']
+CATALOGUE_WORDS = ['roads', 'rivers', 'census', 'land', 'cover', 'relief',
+                   'parcels', 'flood', 'zones', 'airports', 'schools',
+                   'elevation', 'imagery', 'boundaries', 'population',
+                   'rail', 'coastline', 'wetlands', 'soils', 'hydrants']
+CATALOGUE_OWNERS = ['admin'] + ['user{}'.format(i) for i in range(49)]
+CATALOGUE_MAPPING = {'doc': {'properties': {
+    'id': {'type': 'long'},
+    'type': {'type': 'keyword', 'fields': {'text': {'type': 'text'}}},
+    'subtype': {'type': 'keyword', 'fields': {'text': {'type': 'text'}}},
+    'title': {'type': 'text'},
+    'title_sortable': {'type': 'keyword'},
+    'abstract': {'type': 'text'},
+    'keywords': {'type': 'keyword', 'fields': {'text': {'type': 'text'}}},
+    'category': {'type': 'keyword'},
+    'owner__username': {'type': 'keyword',
+                        'fields': {'text': {'type': 'text'}}},
+    'source_host': {'type': 'keyword', 'fields': {'text': {'type': 'text'}}},
+    'references': {'properties': {'scheme': {'type': 'keyword'}}},
+    'date': {'type': 'date'},
+    'temporal_extent_start': {'type': 'date'},
+    'temporal_extent_end': {'type': 'date'},
+    'has_time': {'type': 'boolean'},
+    'bbox_left': {'type': 'float'},
+    'bbox_bottom': {'type': 'float'},
+    'bbox_right': {'type': 'float'},
+    'bbox_top': {'type': 'float'},
+    'popular_count': {'type': 'integer'},
+}}}
+
+# (name, parameters) of the queries run by SearchBenchmark
+QUERY_MIX = [
+    ('all', {}),
+    ('text', {'q': 'roads'}),
+    ('boolean', {'q': 'roads OR rivers -census'}),
+    ('phrase', {'q': '"land cover"'}),
+    ('facets', {'type__in': ['layer', 'map'], 'category__in': 'society'}),
+    ('extent', {'extent': '-100,20,-60,50'}),
+    ('timeline', {'date__range': '2010-01-01,2015-12-31',
+                  'timeline': '1'}),
+    ('sorted', {'order_by': 'title', 'offset': '200'}),
+]
+
+
+def synthetic_catalogue(count, seed=0):
+    '''
+    Yield the sources of count resources with realistic facets, extents
+    and dates, the same seed always gives the same catalogue.
+    '''
+    rnd = random.Random(seed)
+    types = [t for t, share in CATALOGUE_TYPES
+             for i in range(int(share * 100))]
+    for i in range(1, count + 1):
+        kind = rnd.choice(types)
+        title = ' '.join(rnd.sample(CATALOGUE_WORDS, rnd.randint(2, 4)))
+        left = rnd.uniform(-180, 170)
+        bottom = rnd.uniform(-90, 80)
+        width = rnd.expovariate(1 / 5.0)
+        start = rnd.randint(1990, 2017)
+        has_time = rnd.random() < 0.3
+        yield {
+            'id': i,
+            'uuid': 'benchmark-{}'.format(i),
+            'type': kind,
+            'subtype': rnd.choice(CATALOGUE_SUBTYPES)
+            if kind == 'layer' else None,
+            'title': title,
+            'title_sortable': title,
+            'abstract': ' '.join(rnd.choice(CATALOGUE_WORDS)
+                                 for w in range(rnd.randint(10, 80))),
+            'keywords': rnd.sample(CATALOGUE_WORDS, rnd.randint(0, 5)),
+            'category': rnd.choice(CATALOGUE_CATEGORIES),
+            'owner__username': rnd.choice(CATALOGUE_OWNERS),
+            'source_host': rnd.choice(CATALOGUE_HOSTS),
+            'references': [{'scheme': 'OGC:WMS'}]
+            if kind == 'layer' else [],
+            'date': '{}-{:02d}-01'.format(start, rnd.randint(1, 12)),
+            'temporal_extent_start': '{}-01-01'.format(start)
+            if has_time else None,
+            'temporal_extent_end': '{}-12-31'.format(start + rnd.randint(0, 5))
+            if has_time else None,
+            'has_time': has_time,
+            'bbox_left': left,
+            'bbox_bottom': bottom,
+            'bbox_right': min(180.0, left + width),
+            'bbox_top': min(90.0, bottom + width / 2),
+            'popular_count': int(rnd.expovariate(1 / 20.0)),
+            'detail_url': '/{}s/{}'.format(kind, i),
+        }
+
+
+def load_catalogue(es, catalogue, prefix='benchmark-'):
+    '''
+    Index catalogue into one index per resource type, named like the
+    geonode indices, and return the index names.
+    '''
+    from elasticsearch import helpers
+
+    indices = ['{}{}-index'.format(prefix, t) for t, share in CATALOGUE_TYPES]
+    for index in indices:
+        es.indices.delete(index=index, ignore=404)
+        es.indices.create(index=index, body={'mappings': CATALOGUE_MAPPING})
+    helpers.bulk(es, ({
+        '_index': '{}{}-index'.format(prefix, source['type']),
+        '_type': 'doc',
+        '_id': source['id'],
+        '_source': source
+    } for source in catalogue), chunk_size=2000, request_timeout=300)
+    es.indices.refresh(index=','.join(indices))
+    return indices
+
+
+def recorded_response(catalogue, page_size=20):
+    '''
+    Build the search response Elasticsearch gives for a page of catalogue,
+    with the facet aggregations of the search view.
+    '''
+    from .views import OVERALL_FACETS, VISIBLE_FACETS, get_facet_tables
+
+    sources = list(catalogue)
+    buckets = {}
+    for field in get_facet_tables().fields:
+        counts = Counter()
+        for source in sources:
+            value = source
+            for part in field.split('.'):
+                if isinstance(value, list):
+                    value = [v.get(part) for v in value]
+                else:
+                    value = value.get(part) if value else None
+            for v in value if isinstance(value, list) else [value]:
+                if v is not None:
+                    counts[v] += 1
+        buckets[field] = {'buckets': [
+            {'key': k, 'doc_count': c} for k, c in counts.most_common(10)]}
+
+    visible = dict(buckets, doc_count=len(sources))
+    aggregations = dict(buckets)
+    aggregations[OVERALL_FACETS] = {
+        'doc_count': len(sources), VISIBLE_FACETS: visible}
+    return {
+        'took': 5,
+        'timed_out': False,
+        '_shards': {'total': 5, 'successful': 5, 'skipped': 0, 'failed': 0},
+        'hits': {
+            'total': len(sources),
+            'max_score': None,
+            'hits': [{
+                '_index': '{}-index'.format(source['type']),
+                '_type': 'doc',
+                '_id': str(source['id']),
+                '_score': None,
+                '_source': source,
+                'sort': [0, source['id']]
+            } for source in sources[:page_size]]
+        },
+        'aggregations': aggregations,
+    }
+
+
+class BenchmarkUser(object):
+    # stands in for a django user, only what the search view looks at
+
+    def __init__(self, pk):
+        self.pk = pk
+
+    def is_authenticated(self):
+        return True
+
+
+def synthetic_users(count, ids, seed=0):
+    '''
+    Return (user, PermissionSet) pairs, each user seeing between half and
+    all of ids.
+    '''
+    from .permissions import PermissionSet
+
+    rnd = random.Random(seed)
+    users = []
+    for pk in range(1, count + 1):
+        share = rnd.uniform(0.5, 1.0)
+        users.append((BenchmarkUser(pk), PermissionSet(
+            i for i in ids if rnd.random() < share)))
+    return users
+
+
+def percentile(values, percent):
+    # nearest rank
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(0, int(round(percent / 100.0 * len(ordered))) - 1)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+@contextmanager
+def patched(obj, name, value):
+    original = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, original)
+
+
+class SearchBenchmark(object):
+    '''
+    Run the elastic_search view over QUERY_MIX against the node at es_url,
+    searching indices, as users, a list of (user, PermissionSet) pairs.
+
+    The search response cache is cleared before every request unless
+    use_cache is set, every other cache is left as in production.
+    '''
+
+    def __init__(self, es_url, indices, users, use_cache=False,
+                 queries=None):
+        self.es_url = es_url
+        self.indices = indices
+        self.users = users
+        self.use_cache = use_cache
+        self.queries = queries or QUERY_MIX
+        self.round_trips = 0
+
+    def count_round_trips(self, es):
+        perform_request = es.transport.perform_request
+
+        def counted(*args, **kwargs):
+            self.round_trips += 1
+            return perform_request(*args, **kwargs)
+
+        es.transport.perform_request = counted
+
+    def run_query(self, parameters, user):
+        from django.contrib.auth.models import AnonymousUser
+        from django.test import RequestFactory
+        from . import cache, views
+
+        if not self.use_cache:
+            cache.search_responses.clear()
+        request = RequestFactory().get('/api/base/search/', parameters)
+        request.user = user or AnonymousUser()
+        response = views.elastic_search(request)
+        if response.status_code != 200:
+            raise Exception('search failed with {}: {}'.format(
+                response.status_code, response.content))
+
+    def run(self, iterations):
+        '''
+        Run every query iterations times, as each user in turn, and return
+        an OrderedDict of query name to latency percentiles (ms) and
+        round trips per request.
+        '''
+        from django.test.utils import override_settings
+        from . import client, timeline, views
+
+        permission_sets = dict((u.pk, p) for u, p in self.users)
+        es_url = self.es_url
+        create_es_client = client.create_es_client
+
+        def get_permission_set(user):
+            return permission_sets[user.pk]
+
+        results = OrderedDict()
+        with override_settings(SKIP_PERMS_FILTER=not self.users), \
+                patched(client, 'create_es_client',
+                        lambda: create_es_client(es_url)), \
+                patched(views, 'get_search_indices', lambda: self.indices), \
+                patched(timeline, 'get_search_indices',
+                        lambda: self.indices), \
+                patched(views, 'get_permission_set', get_permission_set):
+            client.reset_es_client()
+            self.count_round_trips(client.get_es_client())
+            try:
+                users = [u for u, p in self.users] or [None]
+                for name, parameters in self.queries:
+                    # one request per user first, for the caches that
+                    # are warm in production (permission sets, indices)
+                    for user in users:
+                        self.run_query(parameters, user)
+
+                    self.round_trips = 0
+                    timings = []
+                    for i in range(iterations):
+                        user = users[i % len(users)]
+                        started = time.time()
+                        self.run_query(parameters, user)
+                        timings.append(time.time() - started)
+                    results[name] = OrderedDict([
+                        ('p50', 1000 * percentile(timings, 50)),
+                        ('p95', 1000 * percentile(timings, 95)),
+                        ('p99', 1000 * percentile(timings, 99)),
+                        ('round_trips', float(self.round_trips) / iterations),
+                    ])
+            finally:
+                client.reset_es_client()
+        return results
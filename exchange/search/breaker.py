@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 Boundless Spatial
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+'''
+Circuit breaker around the Elasticsearch calls of unified search.
+
+After ES_BREAKER_FAILURES consecutive failures the breaker opens and
+searches fail fast, without waiting on the cluster, for
+ES_BREAKER_RESET_TIMEOUT seconds. A single search is then let through to
+probe the cluster, it closes the breaker if it succeeds and opens it
+again if it fails.
+'''
+
+import logging
+import threading
+import time
+
+from elasticsearch import exceptions
+
+from .settings import ES_BREAKER_FAILURES, ES_BREAKER_RESET_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class SearchUnavailable(Exception):
+    '''
+    Raised when a search cannot be run and no stale response is available.
+    '''
+    pass
+
+
+def is_cluster_failure(e):
+    '''
+    Whether e says the cluster is unhealthy, rather than the request bad.
+    '''
+    if isinstance(e, exceptions.ConnectionError):
+        return True
+    if isinstance(e, exceptions.TransportError):
+        return not isinstance(e.status_code, int) or e.status_code >= 500
+    return False
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, failures, reset_timeout):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self._failed = 0
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        '''
+        Whether a call may go through, only one call is let through when
+        the reset timeout has passed.
+        '''
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if (self.state == OPEN and
+                    time.time() - self._opened >= self.reset_timeout):
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info('search: circuit breaker closed')
+            self.state = CLOSED
+            self._failed = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failed += 1
+            if self.state == HALF_OPEN or self._failed >= self.failures:
+                if self.state != OPEN:
+                    logger.warn('search: circuit breaker opened after {} '
+                                'failures'.format(self._failed))
+                self.state = OPEN
+                self._opened = time.time()
+
+    def call(self, func):
+        '''
+        Call func through the breaker, raises SearchUnavailable when the
+        breaker is open or func fails because of the cluster.
+        '''
+        if not self.allow():
+            raise SearchUnavailable('search is unavailable')
+        try:
+            result = func()
+        except Exception as e:
+            if not is_cluster_failure(e):
+                # the cluster answered, a bad request says nothing of it
+                self.record_success()
+                raise
+            self.record_failure()
+            logger.warn('search: failed: {}'.format(e))
+            raise SearchUnavailable('search is unavailable: {}'.format(e))
+        self.record_success()
+        return result
+
+
+search_breaker = CircuitBreaker(ES_BREAKER_FAILURES, ES_BREAKER_RESET_TIMEOUT)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 Boundless Spatial
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .settings import (ES_FACET_TABLES_TTL, ES_SEARCH_CACHE_SIZE,
+                       ES_SEARCH_CACHE_TTL, ES_SEARCH_TIMEOUT,
+                       ES_STALE_CACHE_SIZE, ES_STALE_CACHE_TTL)
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'exchange-search-generation-{}'
+# backends whose entries are only seen by the process that set them
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+RESPONSES_GENERATION = 'responses'
+FACETS_GENERATION = 'facets'
+
+
+class LRUCache(object):
+    '''
+    Thread safe, size bounded cache with a time to live.
+
+    Entries are evicted least recently used first once max_size is reached
+    and are ignored once they are older than ttl seconds, a ttl of None
+    keeps them until they are evicted.
+    '''
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires is not None and expires < time.time():
+                return default
+            # re-insert as the most recently used entry
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            expires = None if self.ttl is None else time.time() + self.ttl
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class _Pending(object):
+    # a computation other threads can wait on
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.failed = False
+
+
+class CoalescingCache(LRUCache):
+    '''
+    LRUCache that coalesces concurrent misses on the same key.
+
+    The first thread to miss a key computes the value, threads missing the
+    same key in the meantime wait for that value instead of computing it
+    again. If the computation fails or takes longer than wait_timeout the
+    waiting threads compute the value themselves.
+    '''
+
+    def __init__(self, max_size, ttl, wait_timeout):
+        super(CoalescingCache, self).__init__(max_size, ttl)
+        self.wait_timeout = wait_timeout
+        self._pending = {}
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = self._pending[key] = _Pending()
+
+        if not leader:
+            pending.event.wait(self.wait_timeout)
+            if pending.event.is_set() and not pending.failed:
+                return pending.value
+            return compute()
+
+        try:
+            # the previous leader may have finished in the meantime
+            pending.value = self.get(key)
+            if pending.value is None:
+                pending.value = compute()
+                self.set(key, pending.value)
+            return pending.value
+        except Exception:
+            pending.failed = True
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            pending.event.set()
+
+
+def get_response_cache_key(resourcetype, parameters, fingerprint,
+                           generation=True):
+    '''
+    Build the cache key of a search response.
+
+    The key covers the normalized query parameters, the permissions of the
+    caller and, unless generation is False, the current responses
+    generation.
+    '''
+    normalized = sorted(
+        (k, sorted(v)) for k, v in parameters.lists())
+    key = json.dumps([
+        resourcetype,
+        normalized,
+        fingerprint,
+        get_generation(RESPONSES_GENERATION) if generation else None
+    ])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def invalidate_search_responses():
+    '''
+    Drop every cached search response, in this process and, when the
+    default cache is shared, in the other processes.
+    '''
+    search_responses.clear()
+    bump_generation(RESPONSES_GENERATION)
+
+
+def invalidate_facet_tables():
+    '''
+    Rebuild the facet tables, and drop the responses that used them, in
+    this process and, when the default cache is shared, in the others.
+    '''
+    facet_tables.clear()
+    bump_generation(FACETS_GENERATION)
+    invalidate_search_responses()
+
+
+def get_generation(name):
+    '''
+    Return the current generation of a named group of cached values.
+
+    Generations live in the default Django cache so that every process
+    sharing that cache sees a bump. Including the generation in local cache
+    keys turns a bump into an invalidation of every entry of the group.
+    With a cache local to each process, see is_cache_shared, only the
+    process that bumped a generation sees it.
+    '''
+    try:
+        return cache.get(GENERATION_KEY.format(name), 0)
+    except Exception as e:
+        logger.warn('search: unable to read generation {}: {}'.format(
+            name, e))
+        return 0
+
+
+def is_cache_shared():
+    '''
+    Whether the default cache, which holds the generations, is shared by
+    every process. Django falls back on a local memory cache.
+    '''
+    default = getattr(settings, 'CACHES', {}).get('default', {})
+    return default.get('BACKEND', LOCAL_CACHE_BACKENDS[0]) not in \
+        LOCAL_CACHE_BACKENDS
+
+
+def bump_generation(name):
+    key = GENERATION_KEY.format(name)
+    try:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+    except Exception as e:
+        logger.warn('search: unable to bump generation {}: {}'.format(
+            name, e))
+
+
+search_responses = CoalescingCache(
+    ES_SEARCH_CACHE_SIZE, ES_SEARCH_CACHE_TTL, ES_SEARCH_TIMEOUT)
+# last good response of each search, kept across invalidations
+stale_responses = LRUCache(ES_STALE_CACHE_SIZE, ES_STALE_CACHE_TTL)
+# the facet tables of the current facets generation
+facet_tables = LRUCache(1, ES_FACET_TABLES_TTL)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 Boundless Spatial
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from elasticsearch import Elasticsearch
+
+from .settings import (ES_CONNECTIONS_PER_NODE, ES_INDEX_CACHE_TTL,
+                       ES_KEEPALIVE, ES_MAX_RETRIES, ES_PERMISSIONS_INDEX,
+                       ES_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+# exclude the profile and group indexes.
+# They aren't being used, and cause issues with faceting
+EXCLUDED_INDICES = ['profile-index', 'group-index', ES_PERMISSIONS_INDEX]
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+_indices = None
+_indices_expire = 0
+_indices_refresh_pid = None
+_indices_lock = threading.Lock()
+
+
+def create_es_client(hosts=None):
+    '''
+    Build a new Elasticsearch client with the configured connection pool.
+    '''
+    if hosts is None:
+        hosts = settings.ES_URL
+
+    return Elasticsearch(
+        hosts,
+        maxsize=ES_CONNECTIONS_PER_NODE,
+        timeout=ES_TIMEOUT,
+        max_retries=ES_MAX_RETRIES,
+        retry_on_timeout=False,
+        headers={'Connection': 'keep-alive' if ES_KEEPALIVE else 'close'}
+    )
+
+
+def get_es_client():
+    '''
+    Return the Elasticsearch client shared by every thread of this process.
+
+    The client is thread safe and owns a pool of keep-alive connections, so
+    it is created once and reused. When the process id changes (the worker
+    was forked after the client was created) a fresh client is built so
+    that parent and child never share sockets.
+    '''
+    global _client, _client_pid, _client_lock
+
+    pid = os.getpid()
+    if _client_pid is not None and _client_pid != pid:
+        # the lock may have been held by another thread at fork time
+        _client_lock = threading.Lock()
+
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            if _client is not None:
+                logger.debug('search: pid changed, recreating ES client')
+            _client = create_es_client()
+            _client_pid = pid
+
+    return _client
+
+
+def reset_es_client():
+    '''
+    Close the pooled connections and drop the shared client.
+    The next call to get_es_client() builds a new one.
+    '''
+    global _client, _client_pid
+
+    with _client_lock:
+        client = _client
+        _client = None
+        _client_pid = None
+
+    if client is not None:
+        try:
+            client.transport.close()
+        except Exception as e:
+            logger.warn('search: unable to close ES client: {}'.format(e))
+
+
+def resolve_search_indices(es):
+    '''
+    Ask the cluster for every index and drop the ones that are not
+    part of unified search.
+    '''
+    indices = es.indices.get_alias('*').keys()
+    return sorted(i for i in indices if i not in EXCLUDED_INDICES)
+
+
+def _refresh_search_indices():
+    global _indices, _indices_expire, _indices_refresh_pid
+
+    try:
+        indices = resolve_search_indices(get_es_client())
+        with _indices_lock:
+            _indices = indices
+            _indices_expire = time.time() + ES_INDEX_CACHE_TTL
+    except Exception as e:
+        logger.warn('search: unable to refresh index list: {}'.format(e))
+        with _indices_lock:
+            # keep serving the old list, try again a little later
+            _indices_expire = time.time() + min(ES_INDEX_CACHE_TTL, 30)
+    finally:
+        _indices_refresh_pid = None
+
+
+def get_search_indices():
+    '''
+    Return the list of indices searched by unified search.
+
+    The list is resolved once per process and cached for
+    ES_INDEX_CACHE_TTL seconds. Once it expires a background thread
+    resolves it again while searches keep using the previous list, so
+    the search path itself never waits on a metadata call.
+    '''
+    global _indices, _indices_expire, _indices_refresh_pid
+
+    if _indices is None:
+        with _indices_lock:
+            if _indices is None:
+                _indices = resolve_search_indices(get_es_client())
+                _indices_expire = time.time() + ES_INDEX_CACHE_TTL
+        return _indices
+
+    pid = os.getpid()
+    if time.time() >= _indices_expire and _indices_refresh_pid != pid:
+        with _indices_lock:
+            # the pid guards against a refresh thread lost in a fork
+            if (time.time() >= _indices_expire and
+                    _indices_refresh_pid != pid):
+                _indices_refresh_pid = pid
+                refresh = threading.Thread(target=_refresh_search_indices)
+                refresh.daemon = True
+                refresh.start()
+
+    return _indices
+
+
+def invalidate_search_indices():
+    '''
+    Forget the cached index list, the next search resolves it again.
+    '''
+    global _indices, _indices_expire
+
+    with _indices_lock:
+        _indices = None
+        _indices_expire = 0
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 Boundless Spatial
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+'''
+Batched indexing of unified search documents.
+
+Documents saved by model signals are queued instead of being indexed
+within the request that changed them. A background worker sends the
+queue to Elasticsearch through the _bulk API.
+'''
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from elasticsearch import exceptions, helpers
+
+from .cache import invalidate_search_responses
+from .client import get_es_client
+from .mappings import (BBOX_SHAPE_FIELD, ensure_bbox_shape_mapping,
+                       forget_bbox_shape_mapping, is_bbox_shape_mapped)
+from .settings import (ES_INDEX_BATCH_SIZE, ES_INDEX_FLUSH_INTERVAL,
+                       ES_INDEX_QUEUE)
+
+logger = logging.getLogger(__name__)
+
+
+def get_action_key(action):
+    # ids come back from _bulk as strings
+    return action['_index'], str(action['_id'])
+
+
+def strip_bbox_shape(action):
+    source = dict(action['_source'])
+    source.pop(BBOX_SHAPE_FIELD, None)
+    return dict(action, _source=source)
+
+
+def map_bbox_shapes(es, actions):
+    '''
+    Map BBOX_SHAPE_FIELD on the indices of actions, returns the actions
+    with the field left out of those it could not be mapped on.
+    '''
+    unmapped = set()
+    for index, doc_type in set(
+            (a['_index'], a['_type']) for a in actions):
+        try:
+            ensure_bbox_shape_mapping(index, es, doc_type)
+        except Exception as e:
+            logger.warn('search: unable to map {} on {}: {}'.format(
+                BBOX_SHAPE_FIELD, index, e))
+            unmapped.add(index)
+    if not unmapped:
+        return actions
+    # written without a mapping the field would be mapped as an object,
+    # searches fall back on the bbox_* fields instead
+    return [strip_bbox_shape(a) if a['_index'] in unmapped else a
+            for a in actions]
+
+
+class IndexQueue(object):
+    '''
+    Queue of index actions sent to Elasticsearch in _bulk batches.
+
+    Actions are keyed by index and id, a newer action for a document
+    replaces the queued one so bursts of edits are indexed once. The
+    worker flushes the queue once it holds batch_size actions or its
+    oldest action is flush_interval seconds old. Documents a _bulk request
+    fails to index are indexed again one at a time.
+    '''
+
+    def __init__(self, batch_size, flush_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._actions = OrderedDict()
+        self._oldest = None
+        self._condition = threading.Condition()
+        self._worker_lock = threading.Lock()
+        self._worker_pid = None
+
+    def __len__(self):
+        return len(self._actions)
+
+    def add(self, action):
+        self._ensure_worker()
+        with self._condition:
+            key = get_action_key(action)
+            self._actions.pop(key, None)
+            self._actions[key] = action
+            if self._oldest is None:
+                self._oldest = time.time()
+            self._condition.notify()
+
+    def take(self):
+        '''
+        Empty the queue and return the actions it held.
+        '''
+        with self._condition:
+            actions = list(self._actions.values())
+            self._actions.clear()
+            self._oldest = None
+        return actions
+
+    def flush(self):
+        '''
+        Send every queued action, returns the number of documents indexed.
+        '''
+        actions = self.take()
+        if not actions:
+            return 0
+        return self.send(actions)
+
+    def send(self, actions):
+        es = get_es_client()
+        actions = map_bbox_shapes(es, actions)
+
+        try:
+            indexed, errors = helpers.bulk(
+                es, actions, chunk_size=self.batch_size,
+                raise_on_error=False, raise_on_exception=False)
+        except Exception as e:
+            logger.warn('search: bulk indexing failed: {}'.format(e))
+            indexed, errors = 0, None
+
+        if errors is None:
+            failed = actions
+        else:
+            failed_keys = set(
+                get_action_key(info) for error in errors
+                for info in error.values())
+            failed = [a for a in actions
+                      if get_action_key(a) in failed_keys]
+        for action in failed:
+            indexed += self.send_one(es, action)
+
+        invalidate_search_responses()
+        return indexed
+
+    def send_one(self, es, action):
+        try:
+            es.index(
+                index=action['_index'],
+                doc_type=action['_type'],
+                id=action['_id'],
+                body=action['_source']
+            )
+            return 1
+        except (exceptions.NotFoundError, exceptions.RequestError) as e:
+            # the index may have been dropped since it was mapped
+            forget_bbox_shape_mapping(action['_index'])
+            logger.error('search: unable to index {}/{}: {}'.format(
+                action['_index'], action['_id'], e))
+            return 0
+        except Exception as e:
+            logger.error('search: unable to index {}/{}: {}'.format(
+                action['_index'], action['_id'], e))
+            return 0
+
+    def _due(self):
+        if not self._actions:
+            return False
+        return (len(self._actions) >= self.batch_size or
+                time.time() - self._oldest >= self.flush_interval)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._due():
+                    if self._actions:
+                        self._condition.wait(
+                            self._oldest + self.flush_interval - time.time())
+                    else:
+                        self._condition.wait()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error('search: index queue flush failed: {}'.format(e))
+
+    def _ensure_worker(self):
+        # the worker thread does not survive a fork, the child starts its own
+        pid = os.getpid()
+        if self._worker_pid == pid:
+            return
+        if self._worker_pid is not None:
+            # the locks may have been held by another thread at fork time,
+            # the queued actions are the parent's to send
+            self._condition = threading.Condition()
+            self._worker_lock = threading.Lock()
+            self._actions = OrderedDict()
+            self._oldest = None
+        with self._worker_lock:
+            if self._worker_pid == pid:
+                return
+            worker = threading.Thread(target=self._run)
+            worker.daemon = True
+            worker.start()
+            self._worker_pid = pid
+
+
+def index_document(document):
+    '''
+    Index an elasticsearch_dsl document and return its action.
+
+    The document is queued unless ES_INDEX_QUEUE is off, in which case it
+    is indexed right away. Mapping BBOX_SHAPE_FIELD is left to the queue,
+    the returned action only holds the field once this process knows it
+    is mapped on its index, so that it can be written with _bulk.
+    '''
+    action = document.to_dict(include_meta=True)
+    if ES_INDEX_QUEUE:
+        index_queue.add(action)
+    else:
+        index_queue.send([action])
+    if not is_bbox_shape_mapped(action['_index']):
+        return strip_bbox_shape(action)
+    return action
+
+
+index_queue = IndexQueue(ES_INDEX_BATCH_SIZE, ES_INDEX_FLUSH_INTERVAL)
+# queued documents are not lost on a clean shutdown
+atexit.register(index_queue.flush)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import json
+
+from django.core.management.base import BaseCommand
+from elasticsearch import Elasticsearch
+from exchange.search.benchmark import (ElasticsearchStandIn, SearchBenchmark,
+                                       load_catalogue, recorded_response,
+                                       synthetic_catalogue, synthetic_users)
+
+
+class Command(BaseCommand):
+    help = ('Benchmark unified search over a mix of queries, against a '
+            'synthetic catalogue loaded into ES or a stand-in replaying '
+            'a recorded response')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--es-url',
+            help='load the synthetic catalogue into this ES node and search '
+                 'it, by default searches are answered by a local stand-in')
+        parser.add_argument(
+            '--replay',
+            help='recorded _search response (JSON) the stand-in answers '
+                 'with, by default one is built from the catalogue')
+        parser.add_argument('--count', type=int, default=100000,
+                            help='resources in the synthetic catalogue')
+        parser.add_argument('--users', type=int, default=10,
+                            help='users with different permissions, 0 '
+                                 'searches without permission filtering')
+        parser.add_argument('--iterations', type=int, default=50,
+                            help='requests per query')
+        parser.add_argument('--latency', type=float, default=0.005,
+                            help='seconds added by the stand-in to each '
+                                 'request')
+        parser.add_argument('--cache', action='store_true',
+                            help='keep the search response cache on')
+        parser.add_argument('--keep', action='store_true',
+                            help='keep the loaded catalogue indices')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        users = synthetic_users(options['users'], range(1, count + 1))
+        standin = None
+
+        if options['es_url']:
+            es_url = options['es_url']
+            es = Elasticsearch(es_url)
+            self.stdout.write("Loading %s resources into %s" % (count, es_url))
+            indices = load_catalogue(es, synthetic_catalogue(count))
+        else:
+            if options['replay']:
+                with open(options['replay']) as f:
+                    response = json.load(f)
+            else:
+                response = recorded_response(synthetic_catalogue(count))
+            standin = ElasticsearchStandIn(
+                search_response=response, latency=options['latency']).start()
+            es_url = standin.url
+            indices = standin.indices
+
+        benchmark = SearchBenchmark(
+            es_url, indices, users, use_cache=options['cache'])
+        try:
+            results = benchmark.run(options['iterations'])
+        finally:
+            if standin is not None:
+                standin.stop()
+            elif not options['keep']:
+                es.indices.delete(index=','.join(indices), ignore=404)
+
+        self.stdout.write("%-10s %9s %9s %9s %12s" % (
+            'query', 'p50 ms', 'p95 ms', 'p99 ms', 'round trips'))
+        for name, result in results.items():
+            self.stdout.write("%-10s %9.1f %9.1f %9.1f %12.1f" % (
+                name, result['p50'], result['p95'], result['p99'],
+                result['round_trips']))
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from exchange.search.client import get_es_client, resolve_search_indices
+from exchange.search.mappings import update_bbox_shapes
+
+
+class Command(BaseCommand):
+    help = ('Index the extent of every searchable resource as a geo_shape '
+            'envelope, for spatial search relations')
+
+    def handle(self, *args, **options):
+        es = get_es_client()
+
+        for index in resolve_search_indices(es):
+            updated = update_bbox_shapes(index, es)
+            self.stdout.write("- %s: %s documents updated" % (index, updated))
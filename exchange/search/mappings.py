@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 Boundless Spatial
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+'''
+geo_shape envelopes of resource extents.
+
+Resources are indexed with their extent as four numbers, bbox_left,
+bbox_bottom, bbox_right and bbox_top. BBOX_SHAPE_FIELD holds the same
+extent as an indexed geo_shape envelope so that searches can use spatial
+relations (intersects, within) instead of comparing the numbers.
+'''
+
+import logging
+import threading
+import time
+
+from elasticsearch import exceptions
+
+from .cache import LRUCache
+from .client import get_es_client
+from .settings import ES_INDEX_CACHE_TTL, ES_MAPPING_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+BBOX_SHAPE_FIELD = 'bbox_shape'
+BBOX_SHAPE_MAPPING = {
+    'type': 'geo_shape',
+    'tree': 'quadtree',
+    # catalogue extents are coarse, a finer tree only adds terms
+    'precision': '1km',
+}
+# fills BBOX_SHAPE_FIELD from the bbox_* fields of a document
+BBOX_SHAPE_SCRIPT = '''
+def s = ctx._source;
+s.bbox_shape = ['type': 'envelope', 'coordinates': [
+    [Math.max(-180.0, s.bbox_left), Math.min(90.0, s.bbox_top)],
+    [Math.min(180.0, s.bbox_right), Math.max(-90.0, s.bbox_bottom)]
+]];
+'''
+BBOX_FIELDS = ['bbox_left', 'bbox_bottom', 'bbox_right', 'bbox_top']
+
+# indices BBOX_SHAPE_MAPPING was added to by this process, with the time
+# they are mapped again at
+_mapped = {}
+_mapped_lock = threading.Lock()
+# fields mapped on every index of a list, by (indices, fields)
+_mapped_fields = LRUCache(100, ES_INDEX_CACHE_TTL)
+
+
+def get_bbox_shape(left, bottom, right, top):
+    '''
+    Return the geo_shape envelope of an extent, None if it is incomplete.
+    '''
+    if None in (left, bottom, right, top):
+        return None
+    return {
+        'type': 'envelope',
+        'coordinates': [
+            [max(-180.0, float(left)), min(90.0, float(top))],
+            [min(180.0, float(right)), max(-90.0, float(bottom))]
+        ]
+    }
+
+
+def ensure_bbox_shape_mapping(index, es=None, doc_type=None):
+    '''
+    Add BBOX_SHAPE_FIELD to the mapping of every type of index.
+
+    New fields can be added to an existing mapping, but a document
+    indexed with the field first would map it as a plain object. A
+    missing index is created with the field mapped on doc_type, without
+    a doc_type the NotFoundError is raised.
+    '''
+    if is_bbox_shape_mapped(index):
+        return
+    # not under the lock, threads mapping other indices do not wait on
+    # these calls, mapping the same index twice is harmless
+    es = es or get_es_client()
+    try:
+        mappings = es.indices.get_mapping(index=index)
+    except exceptions.NotFoundError:
+        if doc_type is None:
+            raise
+        # 400 when another process created the index in the meantime
+        es.indices.create(index=index, body={'mappings': {doc_type: {
+            'properties': {BBOX_SHAPE_FIELD: BBOX_SHAPE_MAPPING}
+        }}}, ignore=400)
+        mappings = es.indices.get_mapping(index=index)
+    for name in mappings:
+        for doc_type in mappings[name].get('mappings', {}):
+            es.indices.put_mapping(
+                index=name,
+                doc_type=doc_type,
+                body={'properties': {
+                    BBOX_SHAPE_FIELD: BBOX_SHAPE_MAPPING
+                }}
+            )
+    with _mapped_lock:
+        _mapped[index] = time.time() + ES_MAPPING_CACHE_TTL
+
+
+def is_bbox_shape_mapped(index):
+    '''
+    Whether this process mapped BBOX_SHAPE_FIELD on index recently, without
+    asking Elasticsearch.
+    '''
+    with _mapped_lock:
+        return _mapped.get(index, 0) > time.time()
+
+
+def forget_bbox_shape_mapping(index):
+    '''
+    Map index again on the next call to ensure_bbox_shape_mapping, once
+    it may have been dropped.
+    '''
+    with _mapped_lock:
+        _mapped.pop(index, None)
+
+
+def update_bbox_shapes(index, es=None):
+    '''
+    Fill BBOX_SHAPE_FIELD on every document of index that has an extent,
+    returns the number of documents updated.
+    '''
+    es = es or get_es_client()
+    ensure_bbox_shape_mapping(index, es)
+    response = es.update_by_query(
+        index=index,
+        body={
+            'query': {'bool': {'filter': [
+                {'exists': {'field': field}} for field in BBOX_FIELDS
+            ]}},
+            'script': {'source': BBOX_SHAPE_SCRIPT, 'lang': 'painless'}
+        },
+        conflicts='proceed',
+        request_timeout=3600
+    )
+    return response.get('updated', 0)
+
+
+def get_mapped_fields(indices, fields, es=None):
+    '''
+    Return the set of fields mapped on every one of indices.
+
+    Queries that need a field mapped, like the functions of a
+    function_score query, fail the whole search on shards of an index
+    lacking it. The result is cached for ES_INDEX_CACHE_TTL seconds.
+    '''
+    key = (tuple(indices), tuple(fields))
+    mapped = _mapped_fields.get(key)
+    if mapped is None:
+        es = es or get_es_client()
+        response = es.indices.get_field_mapping(
+            index=indices, fields=fields, ignore_unavailable=True)
+        mapped = set(fields)
+        for index in response.values():
+            mapped &= set(
+                field for doc_type in index.get('mappings', {}).values()
+                for field, mapping in doc_type.items() if mapping)
+        mapped = frozenset(mapped)
+        _mapped_fields.set(key, mapped)
+    return mapped
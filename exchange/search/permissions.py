@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 Boundless Spatial
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+'''
+Cached view permissions for unified search.
+
+The ids of the resources a user can view are kept as a sorted array of
+ints, identified by a fingerprint (the sha1 of that array). Users who can
+see the same resources share the same fingerprint. Large sets are stored
+once in ES_PERMISSIONS_INDEX and searches refer to them with a terms
+lookup instead of sending every id with every query. Stored sets carry
+the time they were last written, sets no process wrote for
+ES_PERMISSIONS_SET_TTL seconds are deleted.
+'''
+
+import array
+import hashlib
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from elasticsearch import exceptions
+from elasticsearch_dsl import Q
+from guardian.shortcuts import get_objects_for_user
+
+from .cache import (LRUCache, bump_generation, get_generation,
+                    is_cache_shared)
+from .client import get_es_client
+from .settings import (ES_LOCAL_PERMISSIONS_CACHE_TTL,
+                       ES_PERMISSIONS_CACHE_SIZE, ES_PERMISSIONS_CACHE_TTL,
+                       ES_PERMISSIONS_INDEX, ES_PERMISSIONS_LOOKUP_THRESHOLD,
+                       ES_PERMISSIONS_PURGE_INTERVAL, ES_PERMISSIONS_SET_TTL)
+
+logger = logging.getLogger(__name__)
+
+PERMISSIONS_GENERATION = 'permissions'
+PERMISSIONS_DOC_TYPE = 'doc'
+
+
+class PermissionSet(object):
+    '''
+    The sorted ids a user can view and the fingerprint identifying them.
+    '''
+
+    def __init__(self, ids):
+        self.ids = array.array('l', sorted(set(ids)))
+        self.fingerprint = hashlib.sha1(self.ids.tostring()).hexdigest()
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def get_permission_sets_ttl():
+    # other processes only see invalidations through a shared cache,
+    # without one a revoked permission lasts until the sets expire
+    if is_cache_shared():
+        return ES_PERMISSIONS_CACHE_TTL
+    return min(ES_PERMISSIONS_CACHE_TTL, ES_LOCAL_PERMISSIONS_CACHE_TTL)
+
+
+_permission_sets = LRUCache(
+    ES_PERMISSIONS_CACHE_SIZE, get_permission_sets_ttl())
+# fingerprints already written to ES_PERMISSIONS_INDEX by this process
+_stored = LRUCache(ES_PERMISSIONS_CACHE_SIZE, ES_PERMISSIONS_CACHE_TTL)
+_index_created = False
+_index_lock = threading.Lock()
+_next_purge = 0
+# set while a search is run again with its permission set inline
+_local = threading.local()
+
+
+def get_user_key(user):
+    if user is None or not user.is_authenticated():
+        return 'anonymous'
+    return 'user-{}'.format(user.pk)
+
+
+def get_permission_set(user):
+    '''
+    Return the PermissionSet of the resources the user is able to view.
+
+    Sets are cached per user until the permissions generation is bumped,
+    which happens whenever object permissions or group membership change.
+    Processes only see each other's bumps through a shared default cache,
+    without one sets are cached for ES_LOCAL_PERMISSIONS_CACHE_TTL seconds
+    at most.
+    '''
+    key = (get_user_key(user), get_generation(PERMISSIONS_GENERATION))
+    permission_set = _permission_sets.get(key)
+    if permission_set is None:
+        filter_set = get_objects_for_user(user, 'base.view_resourcebase')
+        permission_set = PermissionSet(
+            filter_set.values_list('id', flat=True))
+        _permission_sets.set(key, permission_set)
+    return permission_set
+
+
+def invalidate_permissions():
+    '''
+    Drop every cached permission set, in this process and, when the
+    default cache is shared, in the other processes.
+    '''
+    _permission_sets.clear()
+    bump_generation(PERMISSIONS_GENERATION)
+
+
+def _create_permissions_index(es):
+    global _index_created
+
+    with _index_lock:
+        if not _index_created:
+            # ids are only read back by terms lookups, never searched
+            es.indices.create(
+                index=ES_PERMISSIONS_INDEX,
+                body={'mappings': {PERMISSIONS_DOC_TYPE: {
+                    'dynamic': False,
+                    'properties': {'ids': {
+                        'type': 'long', 'index': False, 'doc_values': False
+                    }}
+                }}},
+                ignore=400
+            )
+            # indices created before sets expired lack the field
+            es.indices.put_mapping(
+                index=ES_PERMISSIONS_INDEX,
+                doc_type=PERMISSIONS_DOC_TYPE,
+                body={'properties': {'stored_at': {'type': 'date'}}}
+            )
+            _index_created = True
+
+
+def purge_permission_sets(es=None):
+    '''
+    Delete the sets that were not written for ES_PERMISSIONS_SET_TTL
+    seconds. Processes write the sets they use again once their _stored
+    entry expires, so only sets nobody uses anymore are deleted.
+    '''
+    es = es or get_es_client()
+    # runs in the background, ES does not answer once it is done
+    es.delete_by_query(
+        index=ES_PERMISSIONS_INDEX,
+        doc_type=PERMISSIONS_DOC_TYPE,
+        body={'query': {'range': {'stored_at': {
+            'lt': 'now-{}s'.format(int(ES_PERMISSIONS_SET_TTL))
+        }}}},
+        conflicts='proceed',
+        wait_for_completion=False
+    )
+
+
+def _purge_if_due(es):
+    global _next_purge
+
+    with _index_lock:
+        if _next_purge > time.time():
+            return
+        _next_purge = time.time() + ES_PERMISSIONS_PURGE_INTERVAL
+    try:
+        purge_permission_sets(es)
+    except Exception as e:
+        logger.warn('search: unable to delete expired permission sets: '
+                    '{}'.format(e))
+
+
+def store_permission_set(permission_set):
+    '''
+    Write the set to ES_PERMISSIONS_INDEX, keyed by its fingerprint.
+    Sets are immutable, each fingerprint is only written again once its
+    _stored entry expires, which keeps the sets in use from expiring.
+    '''
+    if _stored.get(permission_set.fingerprint):
+        return
+    es = get_es_client()
+    _create_permissions_index(es)
+    es.index(
+        index=ES_PERMISSIONS_INDEX,
+        doc_type=PERMISSIONS_DOC_TYPE,
+        id=permission_set.fingerprint,
+        body={
+            'ids': permission_set.ids.tolist(),
+            'stored_at': int(time.time() * 1000)
+        }
+    )
+    _stored.set(permission_set.fingerprint, True)
+    _purge_if_due(es)
+
+
+def forget_permission_set(permission_set):
+    '''
+    Write the set, and create ES_PERMISSIONS_INDEX, again the next time
+    they are needed, once they may have been dropped.
+    '''
+    global _index_created
+
+    with _index_lock:
+        _index_created = False
+    _stored.delete(permission_set.fingerprint)
+
+
+@contextmanager
+def inline_permission_sets():
+    _local.inline = True
+    try:
+        yield
+    finally:
+        _local.inline = False
+
+
+def is_missing_lookup(e):
+    # 404s of searches name the index that was not found
+    return (isinstance(e, exceptions.NotFoundError) and
+            ES_PERMISSIONS_INDEX in str(e.info))
+
+
+def call_with_permission_set(permission_set, search):
+    '''
+    Return search(), which runs a search filtered by get_permission_filter.
+
+    The permissions index may disappear under a running process, with a
+    cluster restore or an index wipe. A search whose terms lookup is not
+    found stores the set again and is run once more with the ids inline.
+    '''
+    try:
+        return search()
+    except exceptions.NotFoundError as e:
+        if not is_missing_lookup(e):
+            raise
+        logger.warn('search: stored permission set {} not found: {}'.format(
+            permission_set.fingerprint, e))
+
+    forget_permission_set(permission_set)
+    try:
+        store_permission_set(permission_set)
+    except Exception as e:
+        logger.warn('search: unable to store permission set: {}'.format(e))
+    with inline_permission_sets():
+        return search()
+
+
+def get_permission_filter(permission_set):
+    '''
+    Build the filter limiting a search to the ids of permission_set.
+
+    Small sets are sent inline. Larger ones are sent as a terms lookup on
+    the stored set, which keeps the request small and lets Elasticsearch
+    cache the filter for every user sharing the fingerprint.
+    '''
+    if (len(permission_set) >= ES_PERMISSIONS_LOOKUP_THRESHOLD and
+            not getattr(_local, 'inline', False)):
+        try:
+            store_permission_set(permission_set)
+            return Q('terms', id={
+                'index': ES_PERMISSIONS_INDEX,
+                'type': PERMISSIONS_DOC_TYPE,
+                'id': permission_set.fingerprint,
+                'path': 'ids'
+            })
+        except Exception as e:
+            logger.warn(
+                'search: unable to store permission set, '
+                'sending ids inline: {}'.format(e))
+
+    return Q('terms', id=permission_set.ids.tolist())
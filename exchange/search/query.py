@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 Boundless Spatial
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+'''
+Parser for the unified search query mini-language.
+
+    relief maps            both words (AND is implied)
+    relief OR boxes        either word
+    relief NOT boxes       relief without boxes, also `-boxes`
+    "shaded relief"        a phrase
+    title:relief           a word in a single field, also title:"a phrase"
+    (relief OR boxes) map  grouping
+
+Queries are parsed into a small tree and compiled into one flat bool
+query, nested groups of the same operator are merged into their parent.
+Compiled queries are cached by query string.
+'''
+
+import copy
+import re
+
+from elasticsearch_dsl import Q
+
+from .cache import LRUCache
+from .settings import ES_QUERY_CACHE_SIZE
+
+# fields searched by terms without a field prefix
+SEARCH_FIELDS = [
+    'abstract',
+    'abstract.english',
+    'abstract.pattern',
+    'category.text',
+    'category.english',
+    'category__gn_description',
+    'keywords.text',
+    'keywords.english',
+    'layer_identifier',
+    'layer_originator',
+    'owner__first_name',
+    'owner__last_name',
+    'owner__username.text',
+    'title_alternate',
+    'title_alternate.english',
+    'title_alternate.pattern',
+    'source_host.text',
+    'source',
+    'subtype.text',
+    'subtype.pattern',
+    'supplemental_information',
+    'title',
+    'title.pattern',
+    'title.english',
+    'typename',
+    'type.text',
+    'type.english',
+    'references.scheme.text',
+    'references.scheme.pattern'
+]
+
+TOKEN_RE = re.compile(r'''
+    (?P<paren>[()])
+  | (?:(?P<field>[\w.]+):)?
+    (?:
+        "(?P<double>[^"]*)"?
+      | '(?P<single>[^']*)'?
+      | (?P<word>[^\s()"]+)
+    )
+''', re.VERBOSE | re.UNICODE)
+
+AND, OR, NOT, TERM = 'and', 'or', 'not', 'term'
+OPERATORS = {'AND': AND, 'OR': OR, 'NOT': NOT, '-': NOT}
+
+_compiled = LRUCache(ES_QUERY_CACHE_SIZE, None)
+
+
+def tokenize(query):
+    '''
+    Split a query into (kind, value) tokens, where kind is a paren, an
+    operator or TERM with a (field, text) value.
+    '''
+    # allow a space after a field name, "title: relief"
+    query = re.sub(r':\s+', ':', query)
+
+    tokens = []
+    for match in TOKEN_RE.finditer(query):
+        field = match.group('field')
+        word = match.group('word')
+        if match.group('paren'):
+            tokens.append((match.group('paren'), None))
+        elif word is not None and field is None and word.upper() in OPERATORS:
+            tokens.append((OPERATORS[word.upper()], None))
+        elif word == '+':
+            continue
+        elif word is not None:
+            if word.startswith('-') and field is None:
+                tokens.append((NOT, None))
+                word = word[1:]
+            if word.startswith('+'):
+                word = word[1:]
+            if word:
+                tokens.append((TERM, (field, word)))
+        else:
+            text = match.group('double')
+            if text is None:
+                text = match.group('single')
+            if text.strip():
+                tokens.append((TERM, (field, text.strip())))
+    return tokens
+
+
+def _combine(operator, nodes):
+    # merge nested nodes of the same operator into one
+    children = []
+    for node in nodes:
+        if node[0] == operator:
+            children.extend(node[1])
+        else:
+            children.append(node)
+    if len(children) == 1:
+        return children[0]
+    return (operator, children)
+
+
+def _negate(node):
+    if node[0] == NOT:
+        return node[1]
+    return (NOT, node)
+
+
+class _Parser(object):
+    '''
+    Recursive descent parser, AND binds tighter than OR:
+
+        expression := conjunction (OR conjunction)*
+        conjunction := unary (AND? unary)*
+        unary := NOT* primary
+        primary := '(' expression ')' | TERM
+
+    Queries are typed by users so it never fails: unbalanced parentheses
+    are closed or dropped and dangling operators are ignored.
+    '''
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self):
+        nodes = []
+        while self.peek() is not None:
+            node = self.expression()
+            if node is not None:
+                nodes.append(node)
+            if self.peek() == ')':
+                # unbalanced
+                self.next()
+        if not nodes:
+            return None
+        return _combine(AND, nodes)
+
+    def expression(self):
+        nodes = []
+        while True:
+            node = self.conjunction()
+            if node is not None:
+                nodes.append(node)
+            if self.peek() != OR:
+                break
+            self.next()
+        if not nodes:
+            return None
+        return _combine(OR, nodes)
+
+    def conjunction(self):
+        nodes = []
+        while self.peek() not in (None, OR, ')'):
+            if self.peek() == AND:
+                self.next()
+                continue
+            node = self.unary()
+            if node is not None:
+                nodes.append(node)
+        if not nodes:
+            return None
+        return _combine(AND, nodes)
+
+    def unary(self):
+        negated = False
+        while self.peek() == NOT:
+            self.next()
+            negated = not negated
+        node = self.primary()
+        if node is not None and negated:
+            node = _negate(node)
+        return node
+
+    def primary(self):
+        kind = self.peek()
+        if kind == '(':
+            self.next()
+            node = self.expression()
+            if self.peek() == ')':
+                self.next()
+            return node
+        if kind == TERM:
+            return self.next()
+        # an operator without an operand
+        return None
+
+
+def parse(query):
+    '''
+    Parse a query into a tree of (AND, [nodes]), (OR, [nodes]), (NOT, node)
+    and (TERM, (field, text)) tuples, None when there is nothing to search.
+    '''
+    return _Parser(tokenize(query)).parse()
+
+
+def compile_node(node):
+    kind, value = node
+    if kind == TERM:
+        field, text = value
+        return {'multi_match': {
+            'query': text,
+            'type': 'phrase_prefix',
+            'fields': [field] if field else SEARCH_FIELDS
+        }}
+    if kind == OR:
+        return {'bool': {
+            'should': [compile_node(n) for n in value],
+            'minimum_should_match': 1
+        }}
+
+    children = value if kind == AND else [node]
+    must = [compile_node(n) for n in children if n[0] != NOT]
+    must_not = [compile_node(n[1]) for n in children if n[0] == NOT]
+    if len(must) == 1 and not must_not:
+        return must[0]
+    query = {}
+    if must:
+        query['must'] = must
+    if must_not:
+        query['must_not'] = must_not
+    return {'bool': query}
+
+
+def compile_query(query):
+    '''
+    Compile a query string into an elasticsearch_dsl query, None when
+    the query has nothing to search for.
+    '''
+    compiled = _compiled.get(query)
+    if compiled is None:
+        node = parse(query)
+        compiled = compile_node(node) if node is not None else {}
+        _compiled.set(query, compiled)
+    if not compiled:
+        return None
+    # the cached body must not be shared with the search being built
+    return Q(copy.deepcopy(compiled))
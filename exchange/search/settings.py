@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 Boundless Spatial
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+from django.conf import settings
+
+
+# Number of pooled HTTP connections kept open to each ES node
+ES_CONNECTIONS_PER_NODE = getattr(
+    settings,
+    'ES_CONNECTIONS_PER_NODE',
+    10
+)
+# Reuse HTTP connections between requests
+ES_KEEPALIVE = getattr(
+    settings,
+    'ES_KEEPALIVE',
+    True
+)
+# Default socket timeout (seconds) for any call made by the client
+ES_TIMEOUT = getattr(
+    settings,
+    'ES_TIMEOUT',
+    10
+)
+# Timeout (seconds) applied to each search request
+ES_SEARCH_TIMEOUT = getattr(
+    settings,
+    'ES_SEARCH_TIMEOUT',
+    5
+)
+ES_MAX_RETRIES = getattr(
+    settings,
+    'ES_MAX_RETRIES',
+    1
+)
+# Seconds the resolved list of search indices is cached for
+ES_INDEX_CACHE_TTL = getattr(
+    settings,
+    'ES_INDEX_CACHE_TTL',
+    300
+)
+# Index holding the permission sets referenced by terms lookups
+ES_PERMISSIONS_INDEX = getattr(
+    settings,
+    'ES_PERMISSIONS_INDEX',
+    'exchange-permissions'
+)
+# Permission sets with at least this many ids are sent as a terms lookup
+ES_PERMISSIONS_LOOKUP_THRESHOLD = getattr(
+    settings,
+    'ES_PERMISSIONS_LOOKUP_THRESHOLD',
+    1000
+)
+ES_PERMISSIONS_CACHE_SIZE = getattr(
+    settings,
+    'ES_PERMISSIONS_CACHE_SIZE',
+    1000
+)
+ES_PERMISSIONS_CACHE_TTL = getattr(
+    settings,
+    'ES_PERMISSIONS_CACHE_TTL',
+    300
+)
+# Longest time permission sets are cached for when the default cache is
+# local to each process, processes do not see each other's invalidations
+ES_LOCAL_PERMISSIONS_CACHE_TTL = getattr(
+    settings,
+    'ES_LOCAL_PERMISSIONS_CACHE_TTL',
+    10
+)
+# Seconds a stored permission set is kept once no process writes it again,
+# processes write the sets they use every ES_PERMISSIONS_CACHE_TTL seconds
+ES_PERMISSIONS_SET_TTL = getattr(
+    settings,
+    'ES_PERMISSIONS_SET_TTL',
+    86400
+)
+# Seconds between two deletions of expired sets by a process
+ES_PERMISSIONS_PURGE_INTERVAL = getattr(
+    settings,
+    'ES_PERMISSIONS_PURGE_INTERVAL',
+    3600
+)
+# Number of search responses cached by each process
+ES_SEARCH_CACHE_SIZE = getattr(
+    settings,
+    'ES_SEARCH_CACHE_SIZE',
+    500
+)
+# Seconds a search response is cached for, 0 disables the cache
+ES_SEARCH_CACHE_TTL = getattr(
+    settings,
+    'ES_SEARCH_CACHE_TTL',
+    60
+)
+# Number of hits fetched per scroll request by the export endpoint
+ES_EXPORT_BATCH_SIZE = getattr(
+    settings,
+    'ES_EXPORT_BATCH_SIZE',
+    500
+)
+# How long a scroll context is kept alive between two batches of an export
+ES_EXPORT_SCROLL = getattr(
+    settings,
+    'ES_EXPORT_SCROLL',
+    '1m'
+)
+# Source fields returned for search results unless `fields` is given,
+# what the search result list displays and the workspace cart stores
+ES_SEARCH_RESULT_FIELDS = getattr(
+    settings,
+    'ES_SEARCH_RESULT_FIELDS',
+    [
+        'id',
+        'uuid',
+        'type',
+        'subtype',
+        'title',
+        'abstract',
+        'detail_url',
+        'typename',
+        'layer_identifier',
+        'owner__username',
+        'category__gn_description',
+        'source_host',
+        'geogig_link',
+        'references',
+        'bbox',
+        'date',
+    ]
+)
+# Number of compiled search queries kept, by query string
+ES_QUERY_CACHE_SIZE = getattr(
+    settings,
+    'ES_QUERY_CACHE_SIZE',
+    1000
+)
+# Searches taking longer than this (seconds) are logged with their ES body,
+# 0 disables the slow search log
+ES_SLOW_SEARCH_THRESHOLD = getattr(
+    settings,
+    'ES_SLOW_SEARCH_THRESHOLD',
+    1.0
+)
+# Consecutive failed searches after which searches fail fast
+ES_BREAKER_FAILURES = getattr(
+    settings,
+    'ES_BREAKER_FAILURES',
+    5
+)
+# Seconds searches fail fast for before the cluster is tried again
+ES_BREAKER_RESET_TIMEOUT = getattr(
+    settings,
+    'ES_BREAKER_RESET_TIMEOUT',
+    30
+)
+# Last good responses served, marked as stale, while searches fail
+ES_STALE_CACHE_SIZE = getattr(
+    settings,
+    'ES_STALE_CACHE_SIZE',
+    1000
+)
+ES_STALE_CACHE_TTL = getattr(
+    settings,
+    'ES_STALE_CACHE_TTL',
+    3600
+)
+# Seconds the facet tables are kept, processes that do not share the
+# default cache miss each other's invalidations until they expire
+ES_FACET_TABLES_TTL = getattr(
+    settings,
+    'ES_FACET_TABLES_TTL',
+    300
+)
+# Boosts added to the text score by order_by=relevance, dates decay to
+# ES_RELEVANCE_DATE_DECAY of their boost ES_RELEVANCE_DATE_SCALE from now
+ES_RELEVANCE_DATE_SCALE = getattr(
+    settings,
+    'ES_RELEVANCE_DATE_SCALE',
+    '365d'
+)
+ES_RELEVANCE_DATE_DECAY = getattr(
+    settings,
+    'ES_RELEVANCE_DATE_DECAY',
+    0.5
+)
+ES_RELEVANCE_DATE_WEIGHT = getattr(
+    settings,
+    'ES_RELEVANCE_DATE_WEIGHT',
+    1.0
+)
+ES_RELEVANCE_POPULARITY_WEIGHT = getattr(
+    settings,
+    'ES_RELEVANCE_POPULARITY_WEIGHT',
+    1.0
+)
+ES_RELEVANCE_RATING_WEIGHT = getattr(
+    settings,
+    'ES_RELEVANCE_RATING_WEIGHT',
+    1.0
+)
+# Documents are queued and indexed in _bulk batches of ES_INDEX_BATCH_SIZE,
+# at most ES_INDEX_FLUSH_INTERVAL seconds after they were saved
+ES_INDEX_QUEUE = getattr(
+    settings,
+    'ES_INDEX_QUEUE',
+    True
+)
+ES_INDEX_BATCH_SIZE = getattr(
+    settings,
+    'ES_INDEX_BATCH_SIZE',
+    500
+)
+ES_INDEX_FLUSH_INTERVAL = getattr(
+    settings,
+    'ES_INDEX_FLUSH_INTERVAL',
+    1.0
+)
+# Seconds an index is assumed to keep the bbox_shape mapping this process
+# added, indices dropped and recreated elsewhere are mapped again after it
+ES_MAPPING_CACHE_TTL = getattr(
+    settings,
+    'ES_MAPPING_CACHE_TTL',
+    300
+)
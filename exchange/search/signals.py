@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 Boundless Spatial
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import logging
+
+from django.contrib.auth import get_user_model
+from django.db.models import signals as models_signals
+from django.test.signals import setting_changed
+from geonode.base.models import ResourceBase, TopicCategory
+from guardian.models import GroupObjectPermission, UserObjectPermission
+
+from .cache import invalidate_facet_tables, invalidate_search_responses
+from .permissions import invalidate_permissions
+
+logger = logging.getLogger(__name__)
+
+
+def permissions_changed(sender, **kwargs):
+    """
+    signal to drop the cached permission sets used by unified search
+    whenever an object permission or a group membership changes.
+    """
+    logger.debug('search: permissions changed by {}'.format(sender))
+    invalidate_permissions()
+
+
+def resource_changed(sender, instance, **kwargs):
+    """
+    signal to drop the cached search responses when a resource that is
+    indexed for unified search is saved or deleted.
+    """
+    if isinstance(instance, ResourceBase):
+        invalidate_search_responses()
+
+
+def facets_changed(sender, **kwargs):
+    """
+    signal to rebuild the facet tables used by unified search when a
+    topic category or the ADDITIONAL_FACETS setting changes.
+    """
+    if sender is TopicCategory or kwargs.get('setting') == 'ADDITIONAL_FACETS':
+        invalidate_facet_tables()
+
+
+for model in (UserObjectPermission, GroupObjectPermission):
+    models_signals.post_save.connect(
+        permissions_changed,
+        sender=model,
+        dispatch_uid='exchange_search_perms_save_{}'.format(model.__name__)
+    )
+    models_signals.post_delete.connect(
+        permissions_changed,
+        sender=model,
+        dispatch_uid='exchange_search_perms_delete_{}'.format(model.__name__)
+    )
+
+models_signals.m2m_changed.connect(
+    permissions_changed,
+    sender=get_user_model().groups.through,
+    dispatch_uid='exchange_search_perms_groups'
+)
+models_signals.post_save.connect(
+    resource_changed,
+    dispatch_uid='exchange_search_resource_save'
+)
+models_signals.post_delete.connect(
+    resource_changed,
+    dispatch_uid='exchange_search_resource_delete'
+)
+models_signals.post_save.connect(
+    facets_changed,
+    sender=TopicCategory,
+    dispatch_uid='exchange_search_facets_save'
+)
+models_signals.post_delete.connect(
+    facets_changed,
+    sender=TopicCategory,
+    dispatch_uid='exchange_search_facets_delete'
+)
+setting_changed.connect(
+    facets_changed,
+    dispatch_uid='exchange_search_facets_setting'
+)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 Boundless Spatial
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+'''
+Timeline histograms for unified search.
+
+Publication dates and the start of temporal extents are counted with
+date_histogram aggregations. The interval is picked from the range being
+searched so that a timeline gets at most TIMELINE_BUCKETS buckets, the
+catalogue range is used for any bound the search leaves open.
+'''
+
+import calendar
+import datetime
+import logging
+import math
+
+import elasticsearch_dsl
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .cache import LRUCache
+from .client import get_es_client, get_search_indices
+from .settings import ES_INDEX_CACHE_TTL, ES_SEARCH_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# histogram fields and the prefix of the search parameters bounding them
+TIMELINE_FIELDS = [
+    ('date', 'date'),
+    ('temporal_extent_start', 'extent'),
+]
+TIMELINE_BUCKETS = 50
+# calendar intervals from the finest, with their approximate length
+CALENDAR_INTERVALS = [
+    ('minute', 60),
+    ('hour', 3600),
+    ('day', 86400),
+    ('week', 604800),
+    ('month', 2629746),
+    ('quarter', 7889238),
+    ('year', 31556952),
+]
+
+# min and max of each field over the whole catalogue
+_catalogue_bounds = LRUCache(len(TIMELINE_FIELDS), ES_INDEX_CACHE_TTL)
+
+
+def to_timestamp(value):
+    '''
+    Seconds since the epoch of an ISO date or datetime, None if value
+    is not one (ES also accepts date math that is not parsed here).
+    '''
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value) or parse_date(value)
+    except ValueError:
+        return None
+    if parsed is None:
+        return None
+    if isinstance(parsed, datetime.datetime):
+        # aware values are counted from their UTC time
+        return calendar.timegm(parsed.utctimetuple())
+    return calendar.timegm(parsed.timetuple())
+
+
+def get_parameter_bounds(parameters, prefix):
+    # the same parameters as add_temporal_search
+    start = parameters.get('{}__gte'.format(prefix), None)
+    end = parameters.get('{}__lte'.format(prefix), None)
+    date_range = parameters.get('{}__range'.format(prefix), None)
+    if date_range is not None and ',' in date_range:
+        start, end = date_range.split(',', 1)
+    return to_timestamp(start), to_timestamp(end)
+
+
+def get_catalogue_bounds(field):
+    '''
+    Return the (min, max) timestamps of field over every index, or
+    (None, None) when no resource has a value.
+    '''
+    bounds = _catalogue_bounds.get(field)
+    if bounds is None:
+        search = elasticsearch_dsl.Search(
+            using=get_es_client(), index=get_search_indices())
+        search = search.params(
+            request_timeout=ES_SEARCH_TIMEOUT,
+            ignore_unavailable=True
+        )
+        search.aggs.metric('min', 'min', field=field)
+        search.aggs.metric('max', 'max', field=field)
+        aggregations = search[0:0].execute().aggregations
+        bounds = tuple(
+            None if v is None else v / 1000.0
+            for v in (aggregations.min.value, aggregations.max.value))
+        _catalogue_bounds.set(field, bounds)
+    return bounds
+
+
+def get_interval(start, end):
+    '''
+    The finest interval splitting start to end in at most TIMELINE_BUCKETS.
+    '''
+    span = max(end - start, 1)
+    for name, length in CALENDAR_INTERVALS:
+        if float(span) / length <= TIMELINE_BUCKETS:
+            return name
+    # longer than TIMELINE_BUCKETS years, fixed multiples of a day
+    return '{}d'.format(int(math.ceil(float(span) / TIMELINE_BUCKETS / 86400)))
+
+
+def add_timeline_aggregations(search, parameters):
+    '''
+    Add a date_histogram per timeline field, empty buckets included so
+    that a timeline covers the whole range.
+    '''
+    for field, prefix in TIMELINE_FIELDS:
+        start, end = get_parameter_bounds(parameters, prefix)
+        if start is None or end is None:
+            try:
+                low, high = get_catalogue_bounds(field)
+            except Exception as e:
+                logger.warn('search: unable to read the range of {}: {}'
+                            .format(field, e))
+                low, high = None, None
+            start = low if start is None else start
+            end = high if end is None else end
+        if start is None or end is None or end < start:
+            continue
+
+        search.aggs.bucket(
+            field, 'date_histogram',
+            field=field,
+            interval=get_interval(start, end),
+            min_doc_count=0,
+            extended_bounds={
+                'min': int(start * 1000),
+                'max': int(end * 1000)
+            }
+        )
+    return search
+
+
+def get_timeline_results(search, aggregations):
+    timeline = {}
+    for field, prefix in TIMELINE_FIELDS:
+        if field not in aggregations:
+            continue
+        histogram = search.aggs[field].to_dict()['date_histogram']
+        timeline[field] = {
+            'interval': histogram['interval'],
+            'buckets': [{
+                'key': bucket.key_as_string,
+                'count': bucket.doc_count
+            } for bucket in aggregations[field].buckets],
+        }
+    return timeline
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#########################################################################
+#
+# Copyright (C) 2017 Boundless Spatial
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+'''
+Per stage timings of unified search requests.
+
+Every search is timed stage by stage. The timings are logged as one JSON
+object per request, which log shippers can turn into metrics, and can be
+returned to the client in a debug_timing meta block. Searches slower than
+ES_SLOW_SEARCH_THRESHOLD are logged with the body sent to Elasticsearch.
+'''
+
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .settings import ES_SLOW_SEARCH_THRESHOLD
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger(__name__ + '.slow')
+
+
+class SearchTimer(object):
+    '''
+    Wall clock time spent in each stage of a search, in seconds.
+
+    `took` is the time Elasticsearch reports for the search itself and
+    `search` the search sent to it, both set by the search.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.took = None
+        self.search = None
+
+    @contextmanager
+    def stage(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] = (
+                self.stages.get(name, 0) + time.time() - started)
+
+    @property
+    def total(self):
+        return time.time() - self.started
+
+    def as_dict(self):
+        # milliseconds, rounded for readability
+        timings = OrderedDict(
+            (name, round(1000 * elapsed, 2))
+            for name, elapsed in self.stages.items())
+        return OrderedDict([
+            ('total', round(1000 * self.total, 2)),
+            ('took', self.took),
+            ('stages', timings),
+        ])
+
+    def finish(self):
+        '''
+        Log the timings, and the search body if the search was slow.
+        '''
+        total = self.total
+        logger.info(json.dumps(OrderedDict(
+            [('search', self.name)] + list(self.as_dict().items()))))
+
+        if ES_SLOW_SEARCH_THRESHOLD and total > ES_SLOW_SEARCH_THRESHOLD:
+            body = self.search.to_dict() if self.search is not None else None
+            slow_logger.warn('search: {} took {:.0f}ms: {}'.format(
+                self.name, 1000 * total, json.dumps(body)))
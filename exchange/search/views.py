@@ -1,17 +1,62 @@
+import base64
+import json
 import logging
+import math
 import re
+from collections import namedtuple
 
 from django.conf import settings
-from django.http import JsonResponse
-from elasticsearch import Elasticsearch
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.html import format_html_join
+from elasticsearch import helpers
 import elasticsearch_dsl
-from guardian.shortcuts import get_objects_for_user
-from six import iteritems
+from six import integer_types, iteritems, string_types
 
 from geonode.base.models import TopicCategory
 
+from .breaker import SearchUnavailable, search_breaker
+from .cache import (FACETS_GENERATION, facet_tables, get_generation,
+                    get_response_cache_key, search_responses,
+                    stale_responses)
+from .client import get_es_client, get_search_indices
+from .mappings import BBOX_SHAPE_FIELD, get_bbox_shape, get_mapped_fields
+from .permissions import (call_with_permission_set, get_permission_filter,
+                          get_permission_set)
+from .query import compile_query
+from .settings import (ES_BREAKER_RESET_TIMEOUT, ES_EXPORT_BATCH_SIZE,
+                       ES_EXPORT_SCROLL, ES_RELEVANCE_DATE_DECAY,
+                       ES_RELEVANCE_DATE_SCALE, ES_RELEVANCE_DATE_WEIGHT,
+                       ES_RELEVANCE_POPULARITY_WEIGHT,
+                       ES_RELEVANCE_RATING_WEIGHT, ES_SEARCH_CACHE_TTL,
+                       ES_SEARCH_RESULT_FIELDS, ES_SEARCH_TIMEOUT)
+from .timeline import add_timeline_aggregations, get_timeline_results
+from .timing import SearchTimer
+
 logger = logging.getLogger(__name__)
 
+# source fields suggested by the suggest endpoints and the text fields
+# their prefixes are matched on
+SUGGEST_FIELDS = {
+    'title': 'title',
+    'keywords': 'keywords.text',
+    'owner__username': 'owner__username.text',
+}
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_LIMIT = 50
+# bounds the number of terms a prefix is expanded to, and so its cost
+SUGGEST_MAX_EXPANSIONS = 20
+
+# spatial relations of resources to the extent searched, see add_bbox_search
+BBOX_RELATIONS = ['intersects', 'within']
+
+# number of grid cells along each side of the extent
+GRID_CELLS = 16
+GRID_MAX_CELLS = 64
+WORLD_EXTENT = [-180.0, -90.0, 180.0, 90.0]
+# centre of the bbox of a resource, that decides which cell it falls in
+GRID_CENTER_X = "(doc['bbox_left'].value + doc['bbox_right'].value) / 2"
+GRID_CENTER_Y = "(doc['bbox_bottom'].value + doc['bbox_top'].value) / 2"
+
 
 def edsl_base_init(self, _expand__to_dot=False, **params):
     # elasticsearch_dsl overwrites any double underscores with a .
@@ -27,6 +72,29 @@ def edsl_base_init(self, _expand__to_dot=False, **params):
 elasticsearch_dsl.utils.DslBase.__init__ = edsl_base_init
 Q = elasticsearch_dsl.query.Q
 
+# names of the aggregations holding the overall facet counts
+OVERALL_FACETS = 'overall_facets'
+VISIBLE_FACETS = 'visible'
+
+
+def split_bbox(value):
+    # bbox is indexed as [left, bottom, right, top]
+    if not value:
+        return {}
+    return {
+        'bbox_left': value[0],
+        'bbox_bottom': value[1],
+        'bbox_right': value[2],
+        'bbox_top': value[3],
+    }
+
+
+# source fields that are reshaped before being returned, every other field
+# is copied as is
+RESULT_FIELD_TRANSFORMS = {
+    'bbox': split_bbox,
+}
+
 
 def get_unified_search_result_objects(hits):
     # Reformat objects for use in the results.
@@ -35,27 +103,40 @@ def get_unified_search_result_objects(hits):
 
     objects = []
     for hit in hits:
-        try:
-            source = hit.get('_source')
-        except:  # No source
-            pass
         result = {}
         result['index'] = hit.get('_index', None)
-        for key, value in source.iteritems():
-            if key == 'bbox':
-                result['bbox_left'] = value[0]
-                result['bbox_bottom'] = value[1]
-                result['bbox_right'] = value[2]
-                result['bbox_top'] = value[3]
-                # flake8 F841
-                # bbox_str = ','.join(map(str, value))
+        for key, value in iteritems(hit.get('_source', {})):
+            transform = RESULT_FIELD_TRANSFORMS.get(key)
+            if transform is None:
+                result[key] = value
             else:
-                result[key] = source.get(key, None)
+                result.update(transform(value))
         objects.append(result)
 
     return objects
 
 
+def get_result_fields(parameters, default):
+    '''
+    Return the source fields requested with `fields`, a comma separated
+    list where '*' stands for every field. None means every field.
+    '''
+    fields = parameters.get('fields', None)
+    if fields is None:
+        return default
+    fields = [f.strip() for f in fields.split(',') if f.strip()]
+    if not fields or '*' in fields:
+        return None
+    return fields
+
+
+def apply_source_filter(search, fields):
+    # only the requested fields are read and sent back by ES
+    if fields is None:
+        return search
+    return search.source(includes=fields)
+
+
 def get_facet_lookup():
     categories = TopicCategory.objects.all()
     category_lookup = {}
@@ -126,22 +207,19 @@ def apply_base_filter(request, search):
     '''
 
     if not settings.SKIP_PERMS_FILTER:
-        # Get the list of objects the user has access to
-        filter_set = get_objects_for_user(
-            request.user,
-            'base.view_resourcebase'
-        )
+        # Get the list of objects the user has access to, the list is
+        # cached until permissions change
+        permission_set = get_permission_set(request.user)
 
         # Various resources do not have is_published,
         # which end up affecting results
         # if settings.RESOURCE_PUBLISHING:
         # filter_set = filter_set.filter(is_published=True)
 
-        filter_set_ids = map(str, filter_set.values_list('id', flat=True))
-        if len(filter_set_ids) > 0:
-            search = search.filter(Q('terms', id=filter_set_ids))
+        if len(permission_set) > 0:
+            search = search.filter(get_permission_filter(permission_set))
 
-        return search
+    return search
 
 
 def get_facet_fields():
@@ -166,10 +244,65 @@ def get_facet_fields():
     return facet_fields
 
 
+FacetTables = namedtuple('FacetTables', ['fields', 'settings', 'lookups'])
+
+
+def get_facet_tables():
+    '''
+    Return the facet fields, the display settings of each facet field and
+    the display lookups of facet values.
+
+    The tables are built once per process and rebuilt after topic
+    categories or the facet settings change, or ES_FACET_TABLES_TTL
+    seconds after they were built.
+    '''
+    generation = get_generation(FACETS_GENERATION)
+    tables = facet_tables.get(generation)
+    if tables is None:
+        fields = get_facet_fields()
+        facet_settings = get_facet_settings()
+        field_settings = {}
+        for k in fields:
+            # Default display to the id of the facet in case none is set
+            fsettings = dict(facet_settings['category'], display=k)
+            fsettings.update(facet_settings.get(k, {}))
+            field_settings[k] = fsettings
+        tables = FacetTables(fields, field_settings, get_facet_lookup())
+        facet_tables.set(generation, tables)
+    return tables
+
+
+def add_facet_aggregations(search, parameters):
+    '''
+    Add the facet aggregations to the search.
+
+    Each facet is aggregated twice within the same request. The top level
+    terms aggregations follow the full query and give the filtered counts.
+    The copies nested in a global aggregation are only limited by the query
+    built so far, which makes sure to get every item that is possible in the
+    facets in order for a UI to build the choices.
+    '''
+    overall_query = Q(search.to_dict().get('query', {'match_all': {}}))
+    overall = search.aggs.bucket(OVERALL_FACETS, 'global').bucket(
+        VISIBLE_FACETS, 'filter', filter=overall_query)
+
+    for fn in get_facet_tables().fields:
+        terms = elasticsearch_dsl.A(
+            'terms',
+            field=fn,
+            order={"_count": "desc"},
+            size=parameters.get("nfacets", 15)
+        )
+        overall.bucket(fn, terms)
+        search.aggs.bucket(fn, terms)
+
+    return search
+
+
 def get_facet_filter(parameters):
     # add filters to facet_filters to be used *after* initial overall search
     facet_filters = []
-    for fn in get_facet_fields():
+    for fn in get_facet_tables().fields:
         # if there is a filter set in the parameters for this facet
         # add to the filters
         fp = parameters.getlist(fn)
@@ -182,149 +315,109 @@ def get_facet_filter(parameters):
     return facet_filters
 
 
-def get_facet_results(aggregations, parameters):
+def get_facet_results(overall, filtered, parameters):
+    '''
+    Merge the overall facet buckets with the counts of the filtered ones.
+
+    Every value of the overall buckets is listed with its global count and
+    the count within the search results, facets without any value in the
+    results are left out.
+    '''
+    tables = get_facet_tables()
     facet_results = {}
-    facet_lookups = get_facet_lookup()
-    facet_settings = get_facet_settings()
-
-    for k in aggregations.to_dict():
-        buckets = aggregations[k]['buckets']
-        if len(buckets) > 0:
-            lookup = None
-            if k in facet_lookups:
-                lookup = facet_lookups[k]
-            fsettings = facet_settings['category'].copy()
-            fsettings['display'] = k
-            # Default display to the id of the facet in case none is set
-            if k in facet_settings:
-                fsettings.update(facet_settings[k])
-            if parameters.getlist(k):
-                # Make sure list starts open when a filter is set
-                fsettings['open'] = True
-            facet_results[k] = {'settings': fsettings, 'facets': {}}
-
-            for bucket in buckets:
-                bucket_key = bucket.key
-                bucket_count = bucket.doc_count
-                bucket_dict = {
-                    'global_count': bucket_count,
-                    'count': 0,
-                    'display': bucket.key
-                }
-                if lookup:
-                    if bucket_key in lookup:
-                        bucket_dict.update(lookup[bucket_key])
-                facet_results[k]['facets'][bucket_key] = bucket_dict
+
+    for k in tables.fields:
+        if k not in overall or k not in filtered:
+            continue
+        counts = dict(
+            (bucket.key, bucket.doc_count)
+            for bucket in filtered[k]['buckets'])
+
+        lookup = tables.lookups.get(k, {})
+        facets = {}
+        for bucket in overall[k]['buckets']:
+            bucket_dict = {
+                'global_count': bucket.doc_count,
+                'count': counts.get(bucket.key, 0),
+                'display': bucket.key
+            }
+            if bucket.key in lookup:
+                bucket_dict.update(lookup[bucket.key])
+            facets[bucket.key] = bucket_dict
+        if not any(f['count'] for f in facets.values()):
+            continue
+
+        fsettings = dict(tables.settings[k])
+        if parameters.getlist(k):
+            # Make sure list starts open when a filter is set
+            fsettings['open'] = True
+        facet_results[k] = {'settings': fsettings, 'facets': facets}
 
     return facet_results
 
 
 def get_main_query(search, query):
-    # Set base fields to search
-    fields = [
-        'abstract',
-        'abstract.english',
-        'abstract.pattern',
-        'category.text',
-        'category.english',
-        'category__gn_description',
-        'keywords.text',
-        'keywords.english',
-        'layer_identifier',
-        'layer_originator',
-        'owner__first_name',
-        'owner__last_name',
-        'owner__username.text',
-        'title_alternate',
-        'title_alternate.english',
-        'title_alternate.pattern',
-        'source_host.text',
-        'source',
-        'subtype.text',
-        'subtype.pattern',
-        'supplemental_information',
-        'title',
-        'title.pattern',
-        'title.english',
-        'typename',
-        'type.text',
-        'type.english',
-        'references.scheme.text',
-        'references.scheme.pattern'
-    ]
-
-    # Build main query to search in fields[]
+    # Build main query to search in SEARCH_FIELDS
     # Filter by Query Params
     if query:
-        query = re.sub(":\s+", ":", query)
-
-        if query.startswith('"') or query.startswith('\''):
-            # Match exact phrase
-            phrase = query.replace('"', '')
-            search = search.query(
-                "multi_match",
-                type='phrase_prefix',
-                query=phrase,
-                fields=fields
-            )
-        else:
-            word_query = None
-            words = [w for w in query.split() if w]
-
-            for i, search_word in enumerate(words):
-                search_fields = fields
-
-                if ":" in search_word:
-                    search_fields, search_word = search_word.split(':')
-                    search_fields = [search_fields]
-
-                if i == 0:
-                    word_query = Q(
-                        "multi_match",
-                        type='phrase_prefix',
-                        query=search_word,
-                        fields=search_fields
-                    )
-                elif search_word.upper() in ["AND", "OR", "NOT", "-", "+"]:
-                    pass
-                elif words[i - 1].upper() == "OR":
-                    word_query = word_query | Q(
-                        "multi_match",
-                        type='phrase_prefix',
-                        query=search_word,
-                        fields=search_fields
-                    )
-                elif words[i - 1].upper() in ["NOT", "-"]:
-                    search = search.exclude(
-                        "multi_match",
-                        type='phrase_prefix',
-                        query=search_word,
-                        fields=search_fields
-                    )
-                else:  # previous word AND this word
-                    word_query = word_query & Q(
-                        "multi_match",
-                        type='phrase_prefix',
-                        query=search_word,
-                        fields=search_fields
-                    )
-
-            if word_query is not None:
-                search = search.query(word_query)
+        q = compile_query(query)
+        if q is not None:
+            search = search.query(q)
 
     return search
 
 
-def add_bbox_search(search, bbox):
-    # Add in Bounding Box filter
+def split_extent(left, bottom, right, top):
+    # an extent crossing the antimeridian has its left edge east of its
+    # right edge, envelopes cannot cross it so it is split in two
+    if left > right:
+        return [(left, bottom, 180.0, top), (-180.0, bottom, right, top)]
+    return [(left, bottom, right, top)]
+
+
+def get_contained_filters(left, bottom, right, top):
+    return [
+        Q({'range': {'bbox_left': {'gte': left}}}),
+        Q({'range': {'bbox_bottom': {'gte': bottom}}}),
+        Q({'range': {'bbox_right': {'lte': right}}}),
+        Q({'range': {'bbox_top': {'lte': top}}}),
+    ]
+
+
+def add_bbox_search(search, bbox, relation=None):
+    '''
+    Filter on the extent of resources.
+
+    By default resources have to be contained in bbox, comparing the
+    bbox_* fields. With a relation of BBOX_RELATIONS the geo_shape
+    envelopes of the resources are searched instead. Documents indexed
+    without an envelope are still compared field by field.
+    '''
     if bbox:
-        left, bottom, right, top = bbox.split(',')
-        leftq = Q({'range': {'bbox_left': {'gte': float(left)}}})
-        bottomq = Q({'range': {'bbox_bottom': {'gte': float(bottom)}}})
-        rightq = Q({'range': {'bbox_right': {'lte': float(right)}}})
-        topq = Q({'range': {'bbox_top': {'lte': float(top)}}})
-        q = leftq & bottomq & rightq & topq
-        search = search.query(q)
+        left, bottom, right, top = [float(c) for c in bbox.split(',')]
+        if relation not in BBOX_RELATIONS:
+            for q in get_contained_filters(left, bottom, right, top):
+                search = search.filter(q)
+            return search
+
+        extents = split_extent(left, bottom, right, top)
+        shapes = [
+            # indices without the field match nothing instead of failing
+            Q('geo_shape', ignore_unmapped=True, **{BBOX_SHAPE_FIELD: {
+                'shape': get_bbox_shape(*extent),
+                'relation': relation
+            }})
+            for extent in extents
+        ]
+        fallback = Q(
+            'bool',
+            must_not=[Q('exists', field=BBOX_SHAPE_FIELD)],
+            should=[Q('bool', filter=get_contained_filters(*extent))
+                    for extent in extents],
+            minimum_should_match=1
+        )
+        search = search.filter(Q(
+            'bool', should=shapes + [fallback], minimum_should_match=1))
 
     return search
 
@@ -348,170 +441,643 @@ def add_temporal_search(search, parameters):
     # Add range filters to the search
     if date_start:
         q = Q({'range': {'date': {'gte': date_start}}})
-        search = search.query(q)
+        search = search.filter(q)
 
     if date_end:
         q = Q({'range': {'date': {'lte': date_end}}})
-        search = search.query(q)
+        search = search.filter(q)
 
     if time_range_start:
         q = Q(
             {'range': {'temporal_extent_end': {'gte': time_range_start}}})
-        search = search.query(q)
+        search = search.filter(q)
 
     if time_range_end:
         q = Q(
             {'range': {'temporal_extent_start': {'lte': time_range_end}}})
-        search = search.query(q)
+        search = search.filter(q)
+
+    return search
+
+
+def get_relevance_functions():
+    # newer, more popular and better rated resources score higher, the
+    # log scale keeps a few very popular resources from drowning the rest.
+    # each function only scores resources that have a value for its field.
+    return [
+        ('date', {
+            'gauss': {'date': {
+                'origin': 'now',
+                'scale': ES_RELEVANCE_DATE_SCALE,
+                'decay': ES_RELEVANCE_DATE_DECAY
+            }},
+            'weight': ES_RELEVANCE_DATE_WEIGHT
+        }),
+        ('popular_count', {
+            'field_value_factor': {
+                'field': 'popular_count',
+                'modifier': 'log1p',
+                'missing': 0
+            },
+            'weight': ES_RELEVANCE_POPULARITY_WEIGHT
+        }),
+        ('rating', {
+            'field_value_factor': {
+                'field': 'rating',
+                'modifier': 'log1p',
+                'missing': 0
+            },
+            'weight': ES_RELEVANCE_RATING_WEIGHT
+        }),
+    ]
+
 
+def apply_relevance(search):
+    '''
+    Rank the search by relevance within Elasticsearch.
+
+    The query is wrapped in a function_score query that adds recency,
+    popularity and rating boosts to the text score. Filters do not score,
+    searches without a text query are ranked by the boosts alone. A boost
+    is left out unless its field is mapped on every searched index, ES
+    fails the search on indices lacking it whatever the function filter.
+    '''
+    functions = get_relevance_functions()
+    mapped = get_mapped_fields(
+        get_search_indices(), [field for field, function in functions])
+    query = search.to_dict().get('query', {'match_all': {}})
+    search = search._clone()
+    search.query = Q(
+        'function_score',
+        query=Q(query),
+        functions=[
+            dict(function, filter={'exists': {'field': field}})
+            for field, function in functions if field in mapped
+        ],
+        score_mode='sum',
+        boost_mode='sum'
+    )
     return search
 
 
 def apply_sort(search, sort):
-    if sort.lower() == "-date":
-        search = search.sort(
-            {"date": {
-                "order": "desc",
-                "missing": "_last",
-                "unmapped_type": "date"
-            }}
-        )
+    if sort.lower() == "relevance":
+        search = apply_relevance(search)
+        order = '_score'
     elif sort.lower() == "date":
-        search = search.sort(
-            {"date": {
-                "order": "asc",
-                "missing": "_last",
-                "unmapped_type": "date"
-            }}
-        )
+        order = {"date": {
+            "order": "asc",
+            "missing": "_last",
+            "unmapped_type": "date"
+        }}
     elif sort.lower() == "title":
-        search = search.sort('title_sortable')
+        order = 'title_sortable'
     elif sort.lower() == "-title":
-        search = search.sort('-title_sortable')
+        order = '-title_sortable'
     elif sort.lower() == "-popular_count":
-        search = search.sort('-popular_count')
+        order = '-popular_count'
     else:
-        search = search.sort(
-            {"date": {
-                "order": "desc",
-                "missing": "_last",
-                "unmapped_type": "date"
-            }}
-        )
+        order = {"date": {
+            "order": "desc",
+            "missing": "_last",
+            "unmapped_type": "date"
+        }}
 
-    return search
+    # resource ids are unique across indices, breaking ties on them gives
+    # every hit a stable position that search_after cursors can resume from
+    return search.sort(
+        order, {"id": {"order": "desc", "unmapped_type": "long"}})
+
+
+def encode_cursor(sort_values):
+    # opaque to clients, the sort values of the last hit of a page
+    return base64.urlsafe_b64encode(json.dumps(sort_values))
+
+
+def get_cursor_types(sort):
+    # the types of the sort values apply_sort gives a hit, the id last.
+    # titles are keywords, resources without one sort on null
+    numbers = integer_types + (float,)
+    if sort.lower() in ('title', '-title'):
+        return [string_types + (type(None),), integer_types]
+    return [numbers, integer_types]
+
+
+def decode_cursor(cursor, sort='-date'):
+    '''
+    Return the sort values held by cursor, raises ValueError unless they
+    are the values of a hit sorted by sort.
+    '''
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError, UnicodeError):
+        sort_values = None
+    types = get_cursor_types(sort)
+    if (not isinstance(sort_values, list) or
+            len(sort_values) != len(types) or
+            any(isinstance(value, bool) or not isinstance(value, value_types)
+                for value, value_types in zip(sort_values, types))):
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+    return sort_values
+
+
+def get_next_url(request, parameters, hits, limit):
+    # a page shorter than the limit is the last one
+    if not hits or len(hits) < limit:
+        return None
+    next_parameters = parameters.copy()
+    next_parameters.pop('offset', None)
+    next_parameters['cursor'] = encode_cursor(list(hits[-1]['sort']))
+    return '{}?{}'.format(request.path, next_parameters.urlencode())
 
 
 def filter_by_resource_type(search, resource_type):
     # filter by resourcetype
     if resource_type == 'documents':
-        search = search.query("match", type="document")
+        search = search.filter("match", type="document")
     elif resource_type == 'layers':
-        search = search.query("match", type="layer")
+        search = search.filter("match", type="layer")
     elif resource_type == 'maps':
-        search = search.query("match", type="map")
+        search = search.filter("match", type="map")
 
     return search
 
 
-def filter_results_by_facets(aggregations, facet_results):
-    # get facets based on search criteria, add to overall facets
-    for k in aggregations.to_dict():
-        buckets = aggregations[k]['buckets']
-        if len(buckets) > 0:
-            for bucket in buckets:
-                bkey = bucket.key
-                count = bucket.doc_count
-                try:
-                    if count > 0:
-                        facet_results[k]['facets'][bkey]['count'] = count
-                except Exception as e:
-                    facet_results['errors'] = "key: {}, bucket_key: {} \
-                        , error: {}".format(k, bkey, e)
-
-    # Remove Empty Facets
-    for item in facet_results.keys():
-        try:
-            facets = facet_results[item]['facets']
-            if sum(facets[prop]['count'] for prop in facets) == 0:
-                del facet_results[item]
-        except Exception as e:
-            logger.warn(e)
-
-    return facet_results
-
-
-def elastic_search(request, resourcetype='base'):
-    parameters = request.GET
-    es = Elasticsearch(settings.ES_URL)
-
-    # exclude the profile and group indexes.
-    # They aren't being used, and cause issues with faceting
-    indices = es.indices.get_alias("*").keys()
-    exclude_indexes = ['profile-index', 'group-index']
-    [indices.remove(i) for i in exclude_indexes if i in indices]
+def get_base_search(request, timer=None):
+    '''
+    Build the search over every resource the user is able to see.
+    '''
+    timer = timer or SearchTimer(None)
+    es = get_es_client()
 
+    with timer.stage('indices'):
+        indices = get_search_indices()
+    # indices that disappear between index list refreshes are skipped
     search = elasticsearch_dsl.Search(using=es, index=indices)
+    search = search.params(
+        request_timeout=ES_SEARCH_TIMEOUT,
+        ignore_unavailable=True
+    )
     search = get_base_query(search)
-    search = apply_base_filter(request, search)
-
-    # Add facets to search
-    for fn in get_facet_fields():
-        search.aggs.bucket(
-            fn,
-            'terms',
-            field=fn,
-            order={"_count": "desc"},
-            size=parameters.get("nfacets", 15)
-        )
+    with timer.stage('permissions'):
+        search = apply_base_filter(request, search)
+    return search
 
-    # run search only filtered by what a particular user is able to see
-    # this makes sure to get every item that is possible in the facets
-    # in order for a UI to build the choices
-    overall_results = search[0:0].execute()
-    facet_results = get_facet_results(overall_results.aggregations, parameters)
 
+def apply_search_filters(search, resourcetype, parameters):
+    '''
+    Narrow the search down to the resources matching the request parameters.
+    '''
     search = filter_by_resource_type(search, resourcetype)
     search = get_main_query(search, parameters.get('q', None))
 
     # Add the facet queries to the main search
     for fq in get_facet_filter(parameters):
-        search = search.query(fq)
+        search = search.filter(fq)
 
     # Add in has_time filter if set
     if parameters.get("has_time", False):
-        search = search.query(Q({'match': {'has_time': True}}))
+        search = search.filter(Q({'match': {'has_time': True}}))
 
-    search = add_bbox_search(search, parameters.get("extent", None))
+    search = add_bbox_search(
+        search,
+        parameters.get("extent", None),
+        parameters.get("extent_relation", None)
+    )
     search = add_temporal_search(search, parameters)
-    search = apply_sort(search, parameters.get("order_by", "relevance"))
+
+    return search
+
+
+def get_search_results(request, resourcetype, parameters, timer=None):
+    timer = timer or SearchTimer(None)
+    search = get_base_search(request, timer)
+
+    with timer.stage('query'):
+        # Add facets to search, the overall counts are only filtered
+        # by what a particular user is able to see
+        search = add_facet_aggregations(search, parameters)
+
+        search = apply_search_filters(search, resourcetype, parameters)
+    timeline = parameters.get('timeline', False)
+    if timeline:
+        with timer.stage('timeline'):
+            search = add_timeline_aggregations(search, parameters)
+    with timer.stage('query'):
+        search = apply_source_filter(
+            search, get_result_fields(parameters, ES_SEARCH_RESULT_FIELDS))
+        search = apply_sort(search, parameters.get("order_by", "-date"))
 
     limit = int(parameters.get('limit', settings.API_LIMIT_PER_PAGE))
     offset = int(parameters.get('offset', '0'))
 
+    cursor = parameters.get('cursor', None)
+    if cursor:
+        # resume after the last hit of the previous page, the cost does not
+        # grow with the depth of the page like from + size does
+        search = search.extra(search_after=decode_cursor(
+            cursor, parameters.get('order_by', '-date')))
+        offset = 0
+
     # Run the search using the offset and limit
     search = search[offset:offset + limit]
-    results = search.execute()
+    timer.search = search
+    with timer.stage('search'):
+        results = search.execute()
+    timer.took = results.took
 
     logger.debug('search: {}, results: {}'.format(search, results))
 
-    filtered_facet_results = filter_results_by_facets(
-        results.aggregations,
-        facet_results
+    with timer.stage('facets'):
+        facet_results = get_facet_results(
+            results.aggregations[OVERALL_FACETS][VISIBLE_FACETS],
+            results.aggregations,
+            parameters
+        )
+
+    with timer.stage('objects'):
+        # Get results
+        objects = get_unified_search_result_objects(results.hits.hits)
+
+        object_list = {
+            "meta": {
+                "limit": limit,
+                "next": get_next_url(
+                    request, parameters, results.hits.hits, limit),
+                "offset": offset,
+                "previous": None,
+                "total_count": results.hits.total,
+                "facets": facet_results,
+            },
+            "objects": objects,
+        }
+
+        if timeline:
+            object_list['meta']['timeline'] = get_timeline_results(
+                search, results.aggregations)
+
+    return object_list
+
+
+def get_request_permission_set(request):
+    # the set of resources the caller is able to see
+    if settings.SKIP_PERMS_FILTER:
+        return None
+    return get_permission_set(request.user)
+
+
+def mark_stale(results):
+    # a copy, the cached results are shared
+    if isinstance(results, dict) and 'meta' in results:
+        results = dict(results)
+        results['meta'] = dict(results['meta'], stale=True)
+    return results
+
+
+def unavailable_response(e):
+    response = HttpResponse(str(e), status=503)
+    response['Retry-After'] = str(ES_BREAKER_RESET_TIMEOUT)
+    return response
+
+
+def get_cached_results(request, name, parameters, compute, timer=None):
+    '''
+    Return the results of compute, a search, shared between identical
+    searches by callers that see the same resources.
+
+    Searches go through the circuit breaker. While the cluster is
+    unavailable the last good results of the same search are returned,
+    marked as stale, or SearchUnavailable is raised if there are none.
+    '''
+    timer = timer or SearchTimer(None)
+    with timer.stage('permissions'):
+        permission_set = get_request_permission_set(request)
+    fingerprint = permission_set.fingerprint if permission_set else None
+    stale_key = get_response_cache_key(
+        name, parameters, fingerprint, generation=False)
+
+    def run():
+        if permission_set is None:
+            return compute()
+        return call_with_permission_set(permission_set, compute)
+
+    def search():
+        results = search_breaker.call(run)
+        stale_responses.set(stale_key, results)
+        return results
+
+    try:
+        if ES_SEARCH_CACHE_TTL <= 0:
+            return search()
+        # concurrent misses only run the search once
+        key = get_response_cache_key(name, parameters, fingerprint)
+        return search_responses.get_or_compute(key, search)
+    except SearchUnavailable:
+        results = stale_responses.get(stale_key)
+        if results is None:
+            raise
+        return mark_stale(results)
+
+
+def elastic_search(request, resourcetype='base'):
+    parameters = request.GET
+
+    try:
+        if parameters.get('cursor', None):
+            decode_cursor(parameters['cursor'],
+                          parameters.get('order_by', '-date'))
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+
+    timer = SearchTimer(resourcetype)
+    try:
+        object_list = get_cached_results(
+            request,
+            resourcetype,
+            parameters,
+            lambda: get_search_results(
+                request, resourcetype, parameters, timer),
+            timer
+        )
+    except SearchUnavailable as e:
+        return unavailable_response(e)
+
+    if parameters.get('debug_timing', False):
+        # per request, never stored with the cached response
+        object_list = dict(object_list)
+        object_list['meta'] = dict(
+            object_list['meta'], debug_timing=timer.as_dict())
+
+    with timer.stage('json'):
+        response = JsonResponse(object_list)
+    timer.finish()
+
+    return response
+
+
+def iter_export_lines(search):
+    # hits are pulled from a scroll in batches of ES_EXPORT_BATCH_SIZE,
+    # only the current batch is held in memory
+    hits = helpers.scan(
+        get_es_client(),
+        query=search.to_dict(),
+        index=get_search_indices(),
+        scroll=ES_EXPORT_SCROLL,
+        size=ES_EXPORT_BATCH_SIZE,
+        request_timeout=ES_SEARCH_TIMEOUT,
+        ignore_unavailable=True
     )
-    # Get results
-    objects = get_unified_search_result_objects(results.hits.hits)
+    for hit in hits:
+        for obj in get_unified_search_result_objects([hit]):
+            yield json.dumps(obj) + '\n'
+
 
-    object_list = {
+def export_search(request, resourcetype='base'):
+    '''
+    Stream every resource matching the search as newline delimited JSON.
+
+    Takes the same filter parameters as elastic_search but has no paging,
+    sorting or facets. Results are returned in index order, with every
+    field unless `fields` says otherwise.
+    '''
+    parameters = request.GET
+    if not search_breaker.allow():
+        return unavailable_response(SearchUnavailable(
+            'search is unavailable'))
+    search = apply_search_filters(
+        get_base_search(request), resourcetype, parameters)
+    search = apply_source_filter(
+        search, get_result_fields(parameters, None))
+
+    return StreamingHttpResponse(
+        iter_export_lines(search),
+        content_type='application/x-ndjson'
+    )
+
+
+def matches_prefix(value, text):
+    # whether a word of value starts with text, like match_phrase_prefix
+    return re.search(
+        r'\b' + re.escape(text.lower()), value.lower(), re.UNICODE
+    ) is not None
+
+
+def get_suggestions(request, resourcetype, text, limit):
+    '''
+    Suggest titles, keywords and owners starting with text.
+
+    Only resources the user is able to see are suggested. A single small
+    search is run, without aggregations and reading only the suggested
+    fields.
+    '''
+    search = get_base_search(request)
+    search = filter_by_resource_type(search, resourcetype)
+    search = search.query(Q(
+        'bool',
+        should=[
+            Q('match_phrase_prefix', **{field: {
+                'query': text,
+                'max_expansions': SUGGEST_MAX_EXPANSIONS
+            }})
+            for field in SUGGEST_FIELDS.values()
+        ],
+        minimum_should_match=1
+    ))
+    search = search.source(includes=list(SUGGEST_FIELDS))
+    search = search[0:limit]
+
+    suggestions = []
+    seen = set()
+    for hit in search.execute().hits.hits:
+        source = hit.get('_source', {})
+        for field in SUGGEST_FIELDS:
+            values = source.get(field) or []
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                key = (field, value.lower())
+                if key in seen or not matches_prefix(value, text):
+                    continue
+                seen.add(key)
+                suggestions.append({'text': value, 'field': field})
+
+    return suggestions[:limit]
+
+
+def get_suggest_limit(parameters):
+    '''
+    Return the number of suggestions asked for, between 1 and
+    SUGGEST_MAX_LIMIT, raises ValueError on a limit that is not a number.
+    '''
+    try:
+        limit = int(parameters.get('limit', SUGGEST_LIMIT))
+    except (TypeError, ValueError):
+        raise ValueError('limit takes a whole number')
+    return max(1, min(limit, SUGGEST_MAX_LIMIT))
+
+
+def get_suggest_results(request, resourcetype, parameters):
+    text = parameters.get('q', '').strip()
+    if not text:
+        return []
+    limit = get_suggest_limit(parameters)
+    return get_cached_results(
+        request,
+        'suggest-{}'.format(resourcetype),
+        parameters,
+        lambda: get_suggestions(request, resourcetype, text, limit)
+    )
+
+
+def suggest(request, resourcetype='base'):
+    '''
+    Suggestions for the text typed so far in `q`, as JSON.
+    '''
+    try:
+        get_suggest_limit(request.GET)
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+
+    try:
+        suggestions = get_suggest_results(request, resourcetype, request.GET)
+    except SearchUnavailable as e:
+        return unavailable_response(e)
+
+    return JsonResponse({'suggestions': suggestions})
+
+
+def autocomplete(request):
+    '''
+    Suggestions for the site search box, as the choices expected by
+    the autocomplete_light widget.
+    '''
+    try:
+        get_suggest_limit(request.GET)
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+
+    try:
+        suggestions = get_suggest_results(request, 'base', request.GET)
+    except SearchUnavailable:
+        # the search box works without suggestions
+        suggestions = []
+
+    return HttpResponse(format_html_join(
+        '', u'<span data-value="{0}">{0}</span>',
+        ((s['text'],) for s in suggestions)
+    ))
+
+
+def add_grid_aggregations(search, extent, cells):
+    # resources are bucketed on the centre of their bbox, cell by cell
+    left, bottom, right, top = extent
+    width = (right - left) / cells
+    height = (top - bottom) / cells
+
+    for field in ('bbox_left', 'bbox_bottom', 'bbox_right', 'bbox_top'):
+        search = search.filter(Q('exists', field=field))
+
+    cell = search.aggs.bucket(
+        'x', 'histogram',
+        script={'source': GRID_CENTER_X, 'lang': 'painless'},
+        interval=width,
+        offset=left % width,
+        min_doc_count=1
+    ).bucket(
+        'y', 'histogram',
+        script={'source': GRID_CENTER_Y, 'lang': 'painless'},
+        interval=height,
+        offset=bottom % height,
+        min_doc_count=1
+    )
+    # extent covering every resource of the cell
+    cell.metric('left', 'min', field='bbox_left')
+    cell.metric('bottom', 'min', field='bbox_bottom')
+    cell.metric('right', 'max', field='bbox_right')
+    cell.metric('top', 'max', field='bbox_top')
+
+    return search
+
+
+def get_grid_parameters(parameters):
+    '''
+    Return the extent and the number of cells of a grid search, raises
+    ValueError on values no grid can be built from.
+    '''
+    extent = parameters.get('extent', None)
+    if extent:
+        extent = [float(c) for c in extent.split(',')]
+        if len(extent) != 4 or any(
+                math.isnan(c) or math.isinf(c) for c in extent):
+            raise ValueError('extent takes left,bottom,right,top')
+        left, bottom, right, top = extent
+        # extents crossing the antimeridian are not split_extent in two
+        # as for filters, the grid would need cells of two widths
+        if left >= right or bottom >= top:
+            raise ValueError(
+                'extent needs its left edge west of its right edge and '
+                'its bottom edge south of its top edge')
+    else:
+        extent = WORLD_EXTENT
+    cells = int(parameters.get('cells', GRID_CELLS))
+    return extent, max(1, min(cells, GRID_MAX_CELLS))
+
+
+def get_grid_results(request, resourcetype, parameters):
+    extent, cells = get_grid_parameters(parameters)
+
+    search = get_base_search(request)
+    search = apply_search_filters(search, resourcetype, parameters)
+    search = add_grid_aggregations(search, extent, cells)
+    # only counts are needed, size 0 searches are also cached by ES
+    search = search[0:0]
+    results = search.execute()
+
+    width = (extent[2] - extent[0]) / cells
+    height = (extent[3] - extent[1]) / cells
+    buckets = []
+    for x in results.aggregations.x.buckets:
+        for y in x.y.buckets:
+            buckets.append({
+                'count': y.doc_count,
+                'cell': [x.key, y.key, x.key + width, y.key + height],
+                'extent': [y.left.value, y.bottom.value,
+                           y.right.value, y.top.value],
+            })
+
+    return {
         "meta": {
-            "limit": limit,
-            "next": None,
-            "offset": offset,
-            "previous": None,
+            "cells": cells,
+            "extent": extent,
             "total_count": results.hits.total,
-            "facets": filtered_facet_results,
         },
-        "objects": objects,
+        "buckets": buckets,
     }
 
-    return JsonResponse(object_list)
+
+def grid_search(request, resourcetype='base'):
+    '''
+    Count the resources matching the search in a grid over `extent`.
+
+    Takes the same filter parameters as elastic_search, plus `cells`, the
+    number of cells along each side of the grid. Only cells holding
+    resources are returned, each with its count and the extent covering
+    its resources.
+    '''
+    parameters = request.GET
+    try:
+        get_grid_parameters(parameters)
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+
+    try:
+        grid = get_cached_results(
+            request,
+            'grid-{}'.format(resourcetype),
+            parameters,
+            lambda: get_grid_results(request, resourcetype, parameters)
+        )
+    except SearchUnavailable as e:
+        return unavailable_response(e)
+
+    return JsonResponse(grid)
@@ -188,6 +188,7 @@ INSTALLED_APPS = (
     'exchange.themes',
     'exchange.fileservice',
     'exchange.thumbnails',
+    'exchange.search',
     'geonode',
     'geonode.contrib.geogig',
     'geonode.contrib.slack',
@@ -340,6 +341,53 @@ REGISTRY_URL must be set in order to provide links to Registry
 
 # elasticsearch-dsl settings
 ES_URL = os.getenv('ES_URL', 'http://127.0.0.1:9200/')
+# a single pooled client is shared by all threads of a worker process
+ES_CONNECTIONS_PER_NODE = le(os.getenv('ES_CONNECTIONS_PER_NODE', '10'))
+ES_KEEPALIVE = str2bool(os.getenv('ES_KEEPALIVE', 'True'))
+ES_TIMEOUT = le(os.getenv('ES_TIMEOUT', '10'))
+ES_SEARCH_TIMEOUT = le(os.getenv('ES_SEARCH_TIMEOUT', '5'))
+ES_MAX_RETRIES = le(os.getenv('ES_MAX_RETRIES', '1'))
+ES_INDEX_CACHE_TTL = le(os.getenv('ES_INDEX_CACHE_TTL', '300'))
+# permission sets are cached per user and stored in ES for terms lookups
+ES_PERMISSIONS_INDEX = os.getenv(
+    'ES_PERMISSIONS_INDEX', 'exchange-permissions')
+ES_PERMISSIONS_LOOKUP_THRESHOLD = le(os.getenv(
+    'ES_PERMISSIONS_LOOKUP_THRESHOLD', '1000'))
+ES_PERMISSIONS_CACHE_SIZE = le(os.getenv('ES_PERMISSIONS_CACHE_SIZE', '1000'))
+ES_PERMISSIONS_CACHE_TTL = le(os.getenv('ES_PERMISSIONS_CACHE_TTL', '300'))
+ES_LOCAL_PERMISSIONS_CACHE_TTL = le(os.getenv(
+    'ES_LOCAL_PERMISSIONS_CACHE_TTL', '10'))
+ES_PERMISSIONS_SET_TTL = le(os.getenv('ES_PERMISSIONS_SET_TTL', '86400'))
+ES_PERMISSIONS_PURGE_INTERVAL = le(os.getenv(
+    'ES_PERMISSIONS_PURGE_INTERVAL', '3600'))
+# identical searches by users with the same permissions share a response
+ES_SEARCH_CACHE_SIZE = le(os.getenv('ES_SEARCH_CACHE_SIZE', '500'))
+ES_SEARCH_CACHE_TTL = le(os.getenv('ES_SEARCH_CACHE_TTL', '60'))
+# exports stream every matching hit through a scroll
+ES_EXPORT_BATCH_SIZE = le(os.getenv('ES_EXPORT_BATCH_SIZE', '500'))
+ES_EXPORT_SCROLL = os.getenv('ES_EXPORT_SCROLL', '1m')
+ES_QUERY_CACHE_SIZE = le(os.getenv('ES_QUERY_CACHE_SIZE', '1000'))
+# searches slower than this many seconds are logged with their body
+ES_SLOW_SEARCH_THRESHOLD = le(os.getenv('ES_SLOW_SEARCH_THRESHOLD', '1.0'))
+# searches fail fast, or serve the last good response, while ES is down
+ES_BREAKER_FAILURES = le(os.getenv('ES_BREAKER_FAILURES', '5'))
+ES_BREAKER_RESET_TIMEOUT = le(os.getenv('ES_BREAKER_RESET_TIMEOUT', '30'))
+ES_STALE_CACHE_SIZE = le(os.getenv('ES_STALE_CACHE_SIZE', '1000'))
+ES_STALE_CACHE_TTL = le(os.getenv('ES_STALE_CACHE_TTL', '3600'))
+# facet tables are rebuilt at least this often (seconds)
+ES_FACET_TABLES_TTL = le(os.getenv('ES_FACET_TABLES_TTL', '300'))
+# weights of the boosts used by order_by=relevance
+ES_RELEVANCE_DATE_SCALE = os.getenv('ES_RELEVANCE_DATE_SCALE', '365d')
+ES_RELEVANCE_DATE_DECAY = le(os.getenv('ES_RELEVANCE_DATE_DECAY', '0.5'))
+ES_RELEVANCE_DATE_WEIGHT = le(os.getenv('ES_RELEVANCE_DATE_WEIGHT', '1.0'))
+ES_RELEVANCE_POPULARITY_WEIGHT = le(
+    os.getenv('ES_RELEVANCE_POPULARITY_WEIGHT', '1.0'))
+ES_RELEVANCE_RATING_WEIGHT = le(
+    os.getenv('ES_RELEVANCE_RATING_WEIGHT', '1.0'))
+# saved documents are indexed in batches by a background worker
+ES_INDEX_QUEUE = str2bool(os.getenv('ES_INDEX_QUEUE', 'True'))
+ES_INDEX_BATCH_SIZE = le(os.getenv('ES_INDEX_BATCH_SIZE', '500'))
+ES_INDEX_FLUSH_INTERVAL = le(os.getenv('ES_INDEX_FLUSH_INTERVAL', '1.0'))
 
 
 # amqp settings
@@ -499,6 +547,30 @@ FILESERVICE_CONFIG = {
     'streaming_supported': False
 }
 
+# Thumbnail images are stored in 'store_dir'. Set 'sendfile' to
+# 'x-sendfile' (apache) or 'x-accel-redirect' (nginx, with an internal
+# location at 'accel_redirect_prefix') to have the web server send them.
+THUMBNAIL_CONFIG = {
+    'store_dir': os.getenv(
+        'THUMBNAIL_STORE_DIR', os.path.join(MEDIA_ROOT, 'thumbnails')),
+    'sendfile': os.getenv('THUMBNAIL_SENDFILE', ''),
+    'accel_redirect_prefix': os.getenv(
+        'THUMBNAIL_ACCEL_REDIRECT_PREFIX', '/thumbnail_store/'),
+    # seconds browsers and proxies keep a thumbnail before revalidating it
+    'max_age': le(os.getenv('THUMBNAIL_MAX_AGE', '3600')),
+    # bytes of thumbnails each process keeps in memory, for cache_ttl
+    # seconds, and the alias of a shared cache in CACHES, if any
+    'cache_bytes': le(os.getenv('THUMBNAIL_CACHE_BYTES', '33554432')),
+    'cache_ttl': le(os.getenv('THUMBNAIL_CACHE_TTL', '300')),
+    'cache_backend': os.getenv('THUMBNAIL_CACHE_BACKEND', ''),
+    # requests made to GeoServer for an automatic thumbnail, waiting
+    # retry_delay seconds after the first, doubling up to retry_delay_max
+    'generation_attempts': le(
+        os.getenv('THUMBNAIL_GENERATION_ATTEMPTS', '15')),
+    'retry_delay': le(os.getenv('THUMBNAIL_RETRY_DELAY', '3')),
+    'retry_delay_max': le(os.getenv('THUMBNAIL_RETRY_DELAY_MAX', '60')),
+}
+
 try:
     from local_settings import *  # noqa
 except ImportError:
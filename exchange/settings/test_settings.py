@@ -19,6 +19,10 @@ FILESERVICE_CONFIG = {
     'streaming_supported': True
 }
 
+THUMBNAIL_CONFIG = {
+    'store_dir': os.path.join(MEDIA_ROOT, 'thumbnails'),
+}
+
 SECRET_KEY = os.getenv('SECRET_KEY', 'unit tests only not for production')
 DEBUG = True
 ALLOWED_HOSTS = ['testserver']
@@ -100,6 +100,8 @@ class Story(ResourceBase):
     def indexing(self):
         if settings.ES_SEARCH:
             from elasticsearch_app.search import StoryIndex
+            from exchange.search.indexing import index_document
+            from exchange.search.mappings import get_bbox_shape
             obj = StoryIndex(
                 meta={'id': self.id},
                 id=self.id,
@@ -123,6 +125,8 @@ class Story(ResourceBase):
                 bbox_right=self.bbox_x1,
                 bbox_bottom=self.bbox_y0,
                 bbox_top=self.bbox_y1,
+                bbox_shape=get_bbox_shape(
+                    self.bbox_x0, self.bbox_y0, self.bbox_x1, self.bbox_y1),
                 temporal_extent_start=self.temporal_extent_start,
                 temporal_extent_end=self.temporal_extent_end,
                 keywords=self.keyword_slug_list(),
@@ -135,8 +139,8 @@ class Story(ResourceBase):
                 is_published=self.is_published,
                 featured=self.featured
             )
-            obj.save()
-            return obj.to_dict(include_meta=True)
+            # batched with other saved documents into a _bulk request
+            return index_document(obj)
 
     # elasticsearch_dsl indexing helper functions
     def prepare_type(self):
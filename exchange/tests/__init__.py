@@ -8,6 +8,7 @@ from django.test import TestCase, Client
 from django.contrib.auth import get_user_model
 from django.core.management import call_command
 
+import mock
 import os.path
 
 TESTDIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'files')
@@ -80,3 +81,42 @@ class ExchangeTest(TestCase):
         self.expected_status = 200
 
         return True
+
+
+# Points the shared search client at a local Elasticsearch stand-in
+# instead of the cluster at ES_URL.
+#
+class ElasticsearchStandInMixin(object):
+
+    def setUp(self):
+        from exchange.search import breaker, cache, client, mappings, timeline
+
+        super(ElasticsearchStandInMixin, self).setUp()
+        self.standin = self.create_standin().start()
+        create_es_client = client.create_es_client
+        self.client_patcher = mock.patch.object(
+            client, 'create_es_client',
+            lambda: create_es_client(self.standin.url))
+        self.client_patcher.start()
+        client.reset_es_client()
+        client.invalidate_search_indices()
+        cache.search_responses.clear()
+        cache.stale_responses.clear()
+        breaker.search_breaker.record_success()
+        timeline._catalogue_bounds.clear()
+        mappings._mapped_fields.clear()
+
+    def tearDown(self):
+        from exchange.search import cache, client
+
+        cache.search_responses.clear()
+        cache.stale_responses.clear()
+        client.invalidate_search_indices()
+        client.reset_es_client()
+        self.client_patcher.stop()
+        self.standin.stop()
+        super(ElasticsearchStandInMixin, self).tearDown()
+
+    def create_standin(self):
+        from exchange.search.benchmark import ElasticsearchStandIn
+        return ElasticsearchStandIn()
@@ -0,0 +1,57 @@
+#
+# Tests for the offline search benchmark harness.
+#
+
+from django.test import TestCase
+
+from exchange.search import benchmark
+
+
+class PercentileTest(TestCase):
+
+    def test_nearest_rank(self):
+        values = range(1, 101)
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+        self.assertEqual(benchmark.percentile([3], 95), 3)
+        self.assertIsNone(benchmark.percentile([], 50))
+
+
+class SyntheticCatalogueTest(TestCase):
+
+    def test_reproducible(self):
+        first = list(benchmark.synthetic_catalogue(50, seed=1))
+        second = list(benchmark.synthetic_catalogue(50, seed=1))
+        self.assertEqual(first, second)
+        self.assertEqual([s['id'] for s in first], list(range(1, 51)))
+
+    def test_recorded_response(self):
+        response = benchmark.recorded_response(
+            benchmark.synthetic_catalogue(200), page_size=5)
+        self.assertEqual(response['hits']['total'], 200)
+        self.assertEqual(len(response['hits']['hits']), 5)
+        type_counts = dict(
+            (b['key'], b['doc_count'])
+            for b in response['aggregations']['type']['buckets'])
+        self.assertEqual(sum(type_counts.values()), 200)
+
+
+class SearchBenchmarkTest(TestCase):
+
+    def test_replayed(self):
+        catalogue = list(benchmark.synthetic_catalogue(200))
+        standin = benchmark.ElasticsearchStandIn(
+            search_response=benchmark.recorded_response(catalogue)).start()
+        try:
+            users = benchmark.synthetic_users(2, [s['id'] for s in catalogue])
+            results = benchmark.SearchBenchmark(
+                standin.url, standin.indices, users,
+                queries=benchmark.QUERY_MIX[:2]
+            ).run(4)
+        finally:
+            standin.stop()
+
+        self.assertEqual(list(results), ['all', 'text'])
+        for result in results.values():
+            self.assertEqual(result['round_trips'], 1.0)
+            self.assertTrue(0 < result['p50'] <= result['p99'])
@@ -0,0 +1,61 @@
+#
+# Tests for the circuit breaker around unified search.
+#
+
+from unittest import TestCase
+
+import mock
+from elasticsearch import exceptions
+
+from exchange.search import breaker
+
+
+def fail(status):
+    def call():
+        raise exceptions.TransportError(status, 'failed')
+    return call
+
+
+class CircuitBreakerTest(TestCase):
+
+    def test_opens_after_failures(self):
+        circuit = breaker.CircuitBreaker(2, 30)
+        for i in range(2):
+            with self.assertRaises(breaker.SearchUnavailable):
+                circuit.call(fail(503))
+        self.assertEqual(circuit.state, breaker.OPEN)
+
+        called = []
+        with self.assertRaises(breaker.SearchUnavailable):
+            circuit.call(lambda: called.append(1))
+        self.assertEqual(called, [])
+
+    def test_success_resets_failures(self):
+        circuit = breaker.CircuitBreaker(2, 30)
+        with self.assertRaises(breaker.SearchUnavailable):
+            circuit.call(fail('N/A'))
+        self.assertEqual(circuit.call(lambda: 1), 1)
+        with self.assertRaises(breaker.SearchUnavailable):
+            circuit.call(fail(500))
+        self.assertEqual(circuit.state, breaker.CLOSED)
+
+    def test_bad_request_not_counted(self):
+        circuit = breaker.CircuitBreaker(1, 30)
+        with self.assertRaises(exceptions.TransportError):
+            circuit.call(fail(400))
+        self.assertEqual(circuit.state, breaker.CLOSED)
+
+    def test_half_open_probe(self):
+        circuit = breaker.CircuitBreaker(1, 30)
+        with mock.patch.object(breaker.time, 'time', return_value=100):
+            with self.assertRaises(breaker.SearchUnavailable):
+                circuit.call(fail(503))
+        with mock.patch.object(breaker.time, 'time', return_value=131):
+            # a single probe is let through
+            self.assertTrue(circuit.allow())
+            self.assertFalse(circuit.allow())
+            circuit.record_failure()
+            self.assertEqual(circuit.state, breaker.OPEN)
+        with mock.patch.object(breaker.time, 'time', return_value=162):
+            self.assertEqual(circuit.call(lambda: 1), 1)
+        self.assertEqual(circuit.state, breaker.CLOSED)
@@ -0,0 +1,89 @@
+#
+# Tests for the in-process caches used by unified search.
+#
+
+import threading
+import time
+from unittest import TestCase
+
+from django.http import QueryDict
+
+from exchange.search import cache
+
+
+class LRUCacheTest(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        lru = cache.LRUCache(2, 60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('c'), 3)
+
+    def test_ttl(self):
+        lru = cache.LRUCache(2, 60)
+        lru.set('a', 1)
+        lru.ttl = -1
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+
+
+class CoalescingCacheTest(TestCase):
+
+    def test_concurrent_misses_compute_once(self):
+        coalescing = cache.CoalescingCache(10, 60, 5)
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.05)
+            return {'objects': []}
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                coalescing.get_or_compute('key', compute)))
+            for i in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'objects': []}] * 5)
+
+    def test_failure_not_cached(self):
+        coalescing = cache.CoalescingCache(10, 60, 5)
+
+        def fail():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            coalescing.get_or_compute('key', fail)
+        self.assertEqual(coalescing.get_or_compute('key', lambda: 1), 1)
+
+
+class ResponseCacheKeyTest(TestCase):
+
+    def test_normalized(self):
+        a = cache.get_response_cache_key(
+            'base', QueryDict('q=relief&type__in=layer&type__in=map'), 'f')
+        b = cache.get_response_cache_key(
+            'base', QueryDict('type__in=map&q=relief&type__in=layer'), 'f')
+        self.assertEqual(a, b)
+
+    def test_varies(self):
+        params = QueryDict('q=relief')
+        key = cache.get_response_cache_key('base', params, 'f')
+        self.assertNotEqual(
+            key, cache.get_response_cache_key('layers', params, 'f'))
+        self.assertNotEqual(
+            key, cache.get_response_cache_key('base', params, 'g'))
+        self.assertNotEqual(
+            key, cache.get_response_cache_key(
+                'base', QueryDict('q=boxes'), 'f'))
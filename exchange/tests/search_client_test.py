@@ -0,0 +1,102 @@
+#
+# Tests for the pooled Elasticsearch client used by unified search.
+#
+
+import logging
+import time
+from unittest import TestCase
+
+from elasticsearch import Elasticsearch
+
+from . import ElasticsearchStandInMixin
+from exchange.search import client
+from exchange.search.benchmark import ElasticsearchStandIn, time_calls
+
+logger = logging.getLogger(__name__)
+
+
+class ElasticsearchClientTest(ElasticsearchStandInMixin, TestCase):
+
+    def create_standin(self):
+        # 2ms per request to approximate a cluster on the local network
+        return ElasticsearchStandIn(latency=0.002)
+
+    def test_shared_client(self):
+        es = client.get_es_client()
+        self.assertIs(es, client.get_es_client())
+
+    def test_recreated_after_fork(self):
+        es = client.get_es_client()
+        # pretend this process was forked from the one that built the client
+        client._client_pid = -1
+        self.assertIsNot(es, client.get_es_client())
+
+    def test_request_overhead(self):
+        requests = 50
+
+        def per_request_client():
+            Elasticsearch(self.standin.url).search(index='layer-index')
+
+        def pooled_client():
+            client.get_es_client().search(index='layer-index')
+
+        self.standin.reset_counters()
+        before = time_calls(per_request_client, requests)
+        before_connections = self.standin.connections
+
+        self.standin.reset_counters()
+        after = time_calls(pooled_client, requests)
+        after_connections = self.standin.connections
+
+        logger.info(
+            'search client: per-request client %.2fms/request '
+            '(%d connections), pooled client %.2fms/request '
+            '(%d connections)',
+            1000 * sum(before) / requests, before_connections,
+            1000 * sum(after) / requests, after_connections)
+
+        # a new connection for every request without pooling
+        self.assertEqual(before_connections, requests)
+        # a single keep-alive connection is reused with pooling
+        self.assertEqual(after_connections, 1)
+
+
+class SearchIndicesTest(ElasticsearchStandInMixin, TestCase):
+
+    def create_standin(self):
+        return ElasticsearchStandIn(
+            indices=['layer-index', 'profile-index', 'group-index',
+                     'map-index'])
+
+    def alias_requests(self):
+        return len([r for r in self.standin.requests if '_alias' in r[1]])
+
+    def test_cached(self):
+        self.assertEqual(
+            client.get_search_indices(), ['layer-index', 'map-index'])
+        client.get_search_indices()
+        client.get_search_indices()
+        self.assertEqual(self.alias_requests(), 1)
+
+    def test_background_refresh(self):
+        client.get_search_indices()
+        self.standin.indices = ['layer-index', 'story-index']
+        self.standin.latency = 0.05
+        client._indices_expire = 0
+
+        # the expired list is still served while it is being refreshed
+        self.assertEqual(
+            client.get_search_indices(), ['layer-index', 'map-index'])
+        for i in range(100):
+            if client._indices_refresh_pid is None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(
+            client.get_search_indices(), ['layer-index', 'story-index'])
+        self.assertEqual(self.alias_requests(), 2)
+
+    def test_invalidate(self):
+        client.get_search_indices()
+        client.invalidate_search_indices()
+        client.get_search_indices()
+        self.assertEqual(self.alias_requests(), 2)
@@ -0,0 +1,146 @@
+#
+# Benchmark of search constraints in query context against filter context.
+#
+# Only runs with EXCHANGE_BENCHMARKS=1 in the environment,
+# against the Elasticsearch node at ES_URL, and is skipped when none is
+# reachable. A throwaway index of synthetic resources is created and
+# deleted again.
+#
+#   EXCHANGE_BENCHMARKS=1 py.test -k FilterContextBenchmark exchange/tests
+#
+
+import logging
+import os
+import random
+from unittest import TestCase, skipUnless
+
+import elasticsearch_dsl
+from django.conf import settings
+from django.http import QueryDict
+from elasticsearch import Elasticsearch, helpers
+
+from exchange.search import views
+from exchange.search.benchmark import time_calls
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_INDEX = 'exchange-benchmark-filters'
+DOCUMENTS = 20000
+REQUESTS = 200
+PARAMETERS = QueryDict(
+    'q=relief&extent=-120,-60,120,60&has_time=true'
+    '&date__gte=2010-01-01&type__in=layer&type__in=map')
+
+
+# the benchmark indexes DOCUMENTS resources, regular test runs skip it
+BENCHMARKS_ENABLED = os.getenv('EXCHANGE_BENCHMARKS', '').lower() in (
+    '1', 'true', 'yes')
+
+
+def es_available():
+    try:
+        es = Elasticsearch(settings.ES_URL, max_retries=0)
+        return es.ping(request_timeout=1)
+    except Exception:
+        return False
+
+
+def synthetic_documents(count):
+    words = ['relief', 'boxes', 'roads', 'rivers', 'parcels', 'census']
+    for i in range(count):
+        left = random.uniform(-180, 170)
+        bottom = random.uniform(-90, 80)
+        yield {
+            '_index': BENCHMARK_INDEX,
+            '_type': 'doc',
+            '_id': i,
+            '_source': {
+                'id': i,
+                'type': random.choice(['layer', 'map', 'document']),
+                'title': ' '.join(random.sample(words, 2)),
+                'has_time': random.random() < 0.5,
+                'date': '{}-01-01'.format(random.randint(2000, 2018)),
+                'bbox_left': left,
+                'bbox_bottom': bottom,
+                'bbox_right': left + random.uniform(0, 10),
+                'bbox_top': bottom + random.uniform(0, 10),
+            }
+        }
+
+
+def query_context_search(search, parameters):
+    # every constraint scored, as the search view used to build it
+    left, bottom, right, top = parameters['extent'].split(',')
+    search = search.query('match', title=parameters['q'])
+    search = search.query('terms', type=parameters.getlist('type__in'))
+    search = search.query('match', has_time=True)
+    search = search.query('range', bbox_left={'gte': float(left)})
+    search = search.query('range', bbox_bottom={'gte': float(bottom)})
+    search = search.query('range', bbox_right={'lte': float(right)})
+    search = search.query('range', bbox_top={'lte': float(top)})
+    return search.query('range', date={'gte': parameters['date__gte']})
+
+
+def filter_context_search(search, parameters):
+    search = search.query('match', title=parameters['q'])
+    for fq in views.get_facet_filter(parameters):
+        search = search.filter(fq)
+    search = search.filter('match', has_time=True)
+    search = views.add_bbox_search(search, parameters['extent'])
+    return views.add_temporal_search(search, parameters)
+
+
+@skipUnless(BENCHMARKS_ENABLED, 'set EXCHANGE_BENCHMARKS=1 to run')
+@skipUnless(BENCHMARKS_ENABLED and es_available(),
+            'no Elasticsearch node at ES_URL')
+class FilterContextBenchmarkTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.es = Elasticsearch(settings.ES_URL)
+        cls.es.indices.delete(index=BENCHMARK_INDEX, ignore=404)
+        cls.es.indices.create(index=BENCHMARK_INDEX, body={
+            'mappings': {'doc': {'properties': {
+                'id': {'type': 'long'},
+                'type': {'type': 'keyword'},
+                'title': {'type': 'text'},
+                'has_time': {'type': 'boolean'},
+                'date': {'type': 'date'},
+                'bbox_left': {'type': 'float'},
+                'bbox_bottom': {'type': 'float'},
+                'bbox_right': {'type': 'float'},
+                'bbox_top': {'type': 'float'},
+            }}}
+        })
+        helpers.bulk(cls.es, synthetic_documents(DOCUMENTS))
+        cls.es.indices.refresh(index=BENCHMARK_INDEX)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.es.indices.delete(index=BENCHMARK_INDEX, ignore=404)
+
+    def search(self):
+        return elasticsearch_dsl.Search(using=self.es, index=BENCHMARK_INDEX)
+
+    def test_repeated_query(self):
+        scored = query_context_search(self.search(), PARAMETERS)
+        filtered = filter_context_search(self.search(), PARAMETERS)
+        self.assertEqual(scored.count(), filtered.count())
+
+        def run_scored():
+            scored.execute(ignore_cache=True)
+
+        def run_filtered():
+            filtered.execute(ignore_cache=True)
+
+        # warm up both, the filter cache only kicks in for repeated filters
+        time_calls(run_scored, 20)
+        time_calls(run_filtered, 20)
+        before = time_calls(run_scored, REQUESTS)
+        after = time_calls(run_filtered, REQUESTS)
+
+        logger.info(
+            'search filters: query context %.2fms/request, '
+            'filter context %.2fms/request over %d documents',
+            1000 * sum(before) / REQUESTS, 1000 * sum(after) / REQUESTS,
+            DOCUMENTS)
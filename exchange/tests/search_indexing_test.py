@@ -0,0 +1,128 @@
+#
+# Tests for the batched indexing queue of unified search.
+#
+
+import json
+import time
+
+import mock
+from django.test import TestCase
+
+from . import ElasticsearchStandInMixin
+from exchange.search import indexing
+
+
+def story(pk, title):
+    return {
+        '_index': 'story-index',
+        '_type': 'doc',
+        '_id': pk,
+        '_source': {'id': pk, 'title': title}
+    }
+
+
+class IndexQueueTest(ElasticsearchStandInMixin, TestCase):
+
+    def bulk_requests(self):
+        return [r for r in self.standin.requests if r[1].endswith('_bulk')]
+
+    def bulk_sources(self):
+        lines = self.bulk_requests()[-1][2].splitlines()
+        return [json.loads(ln) for ln in lines[1::2]]
+
+    def test_coalesced(self):
+        queue = indexing.IndexQueue(100, 60)
+        queue.add(story(1, 'relief'))
+        queue.add(story(2, 'boxes'))
+        queue.add(story(1, 'shaded relief'))
+        self.assertEqual(len(queue), 2)
+
+        self.assertEqual(queue.flush(), 2)
+        self.assertEqual(len(self.bulk_requests()), 1)
+        self.assertEqual(
+            self.bulk_sources(),
+            [{'id': 2, 'title': 'boxes'}, {'id': 1, 'title': 'shaded relief'}])
+        self.assertEqual(len(queue), 0)
+
+    def test_flushed_by_size(self):
+        queue = indexing.IndexQueue(2, 60)
+        queue.add(story(1, 'relief'))
+        queue.add(story(2, 'boxes'))
+        for i in range(100):
+            if self.bulk_requests():
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(self.bulk_requests()), 1)
+
+    def test_flushed_by_time(self):
+        queue = indexing.IndexQueue(100, 0.05)
+        queue.add(story(1, 'relief'))
+        for i in range(100):
+            if self.bulk_requests():
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(self.bulk_requests()), 1)
+
+    def test_failed_documents_indexed_one_by_one(self):
+        queue = indexing.IndexQueue(100, 60)
+        queue.add(story(1, 'relief'))
+        queue.add(story(2, 'boxes'))
+        failed = {'index': {'_index': 'story-index', '_id': '2',
+                            'status': 429, 'error': 'rejected'}}
+        with mock.patch.object(indexing.helpers, 'bulk',
+                               return_value=(1, [failed])):
+            self.assertEqual(queue.flush(), 2)
+        puts = [r[1] for r in self.standin.requests if r[0] == 'PUT']
+        self.assertIn('/story-index/doc/2', puts)
+        self.assertNotIn('/story-index/doc/1', puts)
+
+    def test_not_queued(self):
+        document = mock.Mock()
+        document.to_dict.return_value = story(1, 'relief')
+        with mock.patch.object(indexing, 'ES_INDEX_QUEUE', False):
+            action = indexing.index_document(document)
+        self.assertEqual(action['_id'], 1)
+        self.assertEqual(len(self.bulk_requests()), 1)
+
+    def test_unmapped_shape_left_out(self):
+        queue = indexing.IndexQueue(100, 60)
+        action = story(1, 'relief')
+        action['_source']['bbox_shape'] = {
+            'type': 'envelope', 'coordinates': [[-10, 10], [10, -10]]}
+        queue.add(action)
+        with mock.patch.object(indexing, 'ensure_bbox_shape_mapping',
+                               side_effect=Exception('unavailable')):
+            self.assertEqual(queue.flush(), 1)
+        self.assertEqual(self.bulk_sources(), [{'id': 1, 'title': 'relief'}])
+
+    def test_returned_action_mapped(self):
+        # callers may write the returned action into a recreated index
+        action = story(1, 'relief')
+        action['_source']['bbox_shape'] = {
+            'type': 'envelope', 'coordinates': [[-10, 10], [10, -10]]}
+        document = mock.Mock()
+        document.to_dict.return_value = action
+        with mock.patch.object(indexing.index_queue, 'add') as add, \
+                mock.patch.object(indexing, 'is_bbox_shape_mapped',
+                                  return_value=False):
+            returned = indexing.index_document(document)
+        self.assertNotIn('bbox_shape', returned['_source'])
+        # the queue still indexes the shape once it is mapped
+        self.assertIn('bbox_shape', add.call_args[0][0]['_source'])
+        # nothing is asked of Elasticsearch while saving
+        self.assertEqual(self.standin.requests, [])
+
+        with mock.patch.object(indexing.index_queue, 'add'), \
+                mock.patch.object(indexing, 'is_bbox_shape_mapped',
+                                  return_value=True):
+            returned = indexing.index_document(document)
+        self.assertIn('bbox_shape', returned['_source'])
+
+    def test_fork_drops_parent_actions(self):
+        queue = indexing.IndexQueue(100, 60)
+        queue.add(story(1, 'relief'))
+        # as seen by a child process
+        queue._worker_pid = -1
+        with mock.patch.object(indexing.threading, 'Thread'):
+            queue.add(story(2, 'boxes'))
+        self.assertEqual([a['_id'] for a in queue.take()], [2])
@@ -0,0 +1,77 @@
+#
+# Tests for the geo_shape envelopes of resource extents.
+#
+
+import json
+from unittest import TestCase
+
+import mock
+from elasticsearch import exceptions
+
+from . import ElasticsearchStandInMixin
+from exchange.search import mappings
+
+
+class BboxShapeTest(TestCase):
+
+    def test_envelope(self):
+        self.assertEqual(mappings.get_bbox_shape(-10, -20, 10, 20), {
+            'type': 'envelope',
+            'coordinates': [[-10.0, 20.0], [10.0, -20.0]]
+        })
+
+    def test_clamped(self):
+        shape = mappings.get_bbox_shape(-190, -95, 190, 95)
+        self.assertEqual(shape['coordinates'],
+                         [[-180.0, 90.0], [180.0, -90.0]])
+
+    def test_incomplete(self):
+        self.assertIsNone(mappings.get_bbox_shape(None, -20, 10, 20))
+
+
+class BboxShapeMappingTest(ElasticsearchStandInMixin, TestCase):
+
+    def setUp(self):
+        super(BboxShapeMappingTest, self).setUp()
+        mappings._mapped.clear()
+
+    def test_mapped_once(self):
+        mappings.ensure_bbox_shape_mapping('layer-index')
+        mappings.ensure_bbox_shape_mapping('layer-index')
+        puts = [r for r in self.standin.requests if r[0] == 'PUT']
+        self.assertEqual(len(puts), 1)
+        self.assertEqual(puts[0][1], '/layer-index/_mapping/doc')
+        self.assertEqual(
+            json.loads(puts[0][2])['properties'],
+            {mappings.BBOX_SHAPE_FIELD: mappings.BBOX_SHAPE_MAPPING})
+
+    def test_mapped_again(self):
+        # the index may have been dropped and recreated by another process
+        mappings.ensure_bbox_shape_mapping('layer-index')
+        mappings.forget_bbox_shape_mapping('layer-index')
+        mappings.ensure_bbox_shape_mapping('layer-index')
+        with mock.patch.object(mappings, 'ES_MAPPING_CACHE_TTL', -1):
+            mappings.ensure_bbox_shape_mapping('layer-index')
+            mappings.ensure_bbox_shape_mapping('layer-index')
+        puts = [r for r in self.standin.requests if r[0] == 'PUT']
+        self.assertEqual(len(puts), 4)
+
+    def test_update(self):
+        mappings.update_bbox_shapes('layer-index')
+        method, path, body = self.standin.requests[-1]
+        self.assertEqual(path, '/layer-index/_update_by_query')
+        self.assertIn('bbox_shape', json.loads(body)['script']['source'])
+
+    def test_missing_index_created(self):
+        self.standin.missing_indices.add('story-index')
+        mappings.ensure_bbox_shape_mapping('story-index', doc_type='doc')
+        puts = [r for r in self.standin.requests if r[0] == 'PUT']
+        self.assertEqual(puts[0][1], '/story-index')
+        self.assertEqual(
+            json.loads(puts[0][2])['mappings']['doc']['properties'],
+            {mappings.BBOX_SHAPE_FIELD: mappings.BBOX_SHAPE_MAPPING})
+
+    def test_missing_index_without_type(self):
+        self.standin.missing_indices.add('story-index')
+        with self.assertRaises(exceptions.NotFoundError):
+            mappings.ensure_bbox_shape_mapping('story-index')
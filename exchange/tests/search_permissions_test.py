@@ -0,0 +1,134 @@
+#
+# Tests for the cached permission sets used by unified search.
+#
+
+import json
+from unittest import TestCase
+
+import mock
+from django.contrib.auth.models import AnonymousUser
+from django.test import override_settings
+from elasticsearch import exceptions
+
+from . import ElasticsearchStandInMixin
+from exchange.search import permissions
+
+
+class PermissionSetTest(TestCase):
+
+    def test_fingerprint(self):
+        a = permissions.PermissionSet([3, 1, 2, 2])
+        b = permissions.PermissionSet([1, 2, 3])
+        c = permissions.PermissionSet([1, 2])
+        self.assertEqual(a.ids.tolist(), [1, 2, 3])
+        self.assertEqual(a.fingerprint, b.fingerprint)
+        self.assertNotEqual(a.fingerprint, c.fingerprint)
+
+    def test_cached_until_invalidated(self):
+        permissions.invalidate_permissions()
+        visible = mock.MagicMock()
+        visible.values_list.return_value = [1, 2, 3]
+        with mock.patch.object(permissions, 'get_objects_for_user',
+                               return_value=visible) as get_objects:
+            first = permissions.get_permission_set(AnonymousUser())
+            second = permissions.get_permission_set(AnonymousUser())
+            self.assertIs(first, second)
+            self.assertEqual(get_objects.call_count, 1)
+
+            permissions.invalidate_permissions()
+            permissions.get_permission_set(AnonymousUser())
+            self.assertEqual(get_objects.call_count, 2)
+
+
+class PermissionSetsTtlTest(TestCase):
+
+    def test_local_cache(self):
+        # other processes never see the generation bumps of this one
+        local = 'django.core.cache.backends.locmem.LocMemCache'
+        with override_settings(CACHES={'default': {'BACKEND': local}}):
+            self.assertEqual(permissions.get_permission_sets_ttl(),
+                             permissions.ES_LOCAL_PERMISSIONS_CACHE_TTL)
+
+    def test_shared_cache(self):
+        shared = 'django.core.cache.backends.memcached.MemcachedCache'
+        with override_settings(CACHES={'default': {'BACKEND': shared}}):
+            self.assertEqual(permissions.get_permission_sets_ttl(),
+                             permissions.ES_PERMISSIONS_CACHE_TTL)
+
+
+class PermissionFilterTest(ElasticsearchStandInMixin, TestCase):
+
+    def index_requests(self):
+        return [r for r in self.standin.requests
+                if r[0] == 'PUT' and '/doc/' in r[1]]
+
+    def test_inline(self):
+        permission_set = permissions.PermissionSet([1, 2, 3])
+        with mock.patch.object(
+                permissions, 'ES_PERMISSIONS_LOOKUP_THRESHOLD', 10):
+            q = permissions.get_permission_filter(permission_set)
+        self.assertEqual(q.to_dict(), {'terms': {'id': [1, 2, 3]}})
+        self.assertEqual(self.index_requests(), [])
+
+    def test_terms_lookup(self):
+        permission_set = permissions.PermissionSet(range(20))
+        with mock.patch.object(
+                permissions, 'ES_PERMISSIONS_LOOKUP_THRESHOLD', 10):
+            q = permissions.get_permission_filter(permission_set)
+            permissions.get_permission_filter(permission_set)
+        self.assertEqual(q.to_dict()['terms']['id']['id'],
+                         permission_set.fingerprint)
+        # the set is only written once
+        self.assertEqual(len(self.index_requests()), 1)
+
+    def test_expiry(self):
+        permissions._next_purge = 0
+        permission_set = permissions.PermissionSet(range(40))
+        with mock.patch.object(
+                permissions, 'ES_PERMISSIONS_LOOKUP_THRESHOLD', 10):
+            permissions.get_permission_filter(permission_set)
+            permissions.get_permission_filter(
+                permissions.PermissionSet(range(50)))
+        body = json.loads(self.index_requests()[-2][2])
+        self.assertIn('stored_at', body)
+
+        # expired sets are deleted at most once per purge interval
+        purges = [r for r in self.standin.requests
+                  if r[1].endswith('_delete_by_query')]
+        self.assertEqual(len(purges), 1)
+        self.assertEqual(
+            json.loads(purges[0][2])['query']['range']['stored_at'],
+            {'lt': 'now-{}s'.format(permissions.ES_PERMISSIONS_SET_TTL)})
+
+    def test_missing_lookup(self):
+        # the permissions index was dropped after the set was stored
+        permission_set = permissions.PermissionSet(range(30))
+        filters = []
+
+        def search():
+            filters.append(
+                permissions.get_permission_filter(permission_set).to_dict())
+            if len(filters) == 1:
+                raise exceptions.NotFoundError(
+                    404, 'index_not_found_exception',
+                    {'error': {'index': permissions.ES_PERMISSIONS_INDEX}})
+            return 'results'
+
+        with mock.patch.object(
+                permissions, 'ES_PERMISSIONS_LOOKUP_THRESHOLD', 10):
+            self.assertEqual(permissions.call_with_permission_set(
+                permission_set, search), 'results')
+            # later searches use the set stored again
+            q = permissions.get_permission_filter(permission_set)
+        self.assertEqual(filters[1], {'terms': {'id': list(range(30))}})
+        self.assertEqual(q.to_dict()['terms']['id']['id'],
+                         permission_set.fingerprint)
+        self.assertEqual(len(self.index_requests()), 2)
+
+    def test_other_not_found(self):
+        permission_set = permissions.PermissionSet(range(30))
+        search = mock.Mock(side_effect=exceptions.NotFoundError(
+            404, 'index_not_found_exception', {'error': {'index': 'x'}}))
+        with self.assertRaises(exceptions.NotFoundError):
+            permissions.call_with_permission_set(permission_set, search)
+        self.assertEqual(search.call_count, 1)
@@ -0,0 +1,94 @@
+#
+# Tests for the unified search query parser.
+#
+
+from unittest import TestCase
+
+from exchange.search import query
+from exchange.search.query import AND, NOT, OR, TERM
+
+
+def term(text, field=None):
+    return (TERM, (field, text))
+
+
+def match(text, field=None):
+    return {'multi_match': {
+        'query': text,
+        'type': 'phrase_prefix',
+        'fields': [field] if field else query.SEARCH_FIELDS
+    }}
+
+
+class ParseTest(TestCase):
+
+    def test_implied_and(self):
+        self.assertEqual(query.parse('relief maps'),
+                         (AND, [term('relief'), term('maps')]))
+        self.assertEqual(query.parse('relief AND maps'),
+                         query.parse('relief maps'))
+
+    def test_precedence(self):
+        self.assertEqual(
+            query.parse('a b OR c'),
+            (OR, [(AND, [term('a'), term('b')]), term('c')]))
+        self.assertEqual(
+            query.parse('a (b OR c)'),
+            (AND, [term('a'), (OR, [term('b'), term('c')])]))
+
+    def test_negation(self):
+        expected = (AND, [term('a'), (NOT, term('b'))])
+        self.assertEqual(query.parse('a NOT b'), expected)
+        self.assertEqual(query.parse('a - b'), expected)
+        self.assertEqual(query.parse('a -b'), expected)
+        self.assertEqual(query.parse('NOT NOT a'), term('a'))
+
+    def test_phrases_and_fields(self):
+        self.assertEqual(
+            query.parse('"shaded relief" title: boxes owner:\'jo x\''),
+            (AND, [term('shaded relief'), term('boxes', 'title'),
+                   term('jo x', 'owner')]))
+
+    def test_flattened(self):
+        self.assertEqual(
+            query.parse('(a (b c)) d'),
+            (AND, [term('a'), term('b'), term('c'), term('d')]))
+        self.assertEqual(
+            query.parse('a OR (b OR c)'),
+            (OR, [term('a'), term('b'), term('c')]))
+
+    def test_lenient(self):
+        self.assertEqual(query.parse('(a OR b'), query.parse('a OR b'))
+        self.assertEqual(query.parse('a) b'), query.parse('a b'))
+        self.assertEqual(query.parse('a OR'), term('a'))
+        self.assertEqual(query.parse('"unterminated'), term('unterminated'))
+        self.assertIsNone(query.parse('AND OR ()'))
+
+
+class CompileTest(TestCase):
+
+    def test_single_term(self):
+        self.assertEqual(query.compile_query('relief').to_dict(),
+                         match('relief'))
+
+    def test_flat_bool(self):
+        q = query.compile_query('a -b c NOT d (e OR f)')
+        self.assertEqual(q.to_dict(), {'bool': {
+            'must': [
+                match('a'),
+                match('c'),
+                {'bool': {'should': [match('e'), match('f')],
+                          'minimum_should_match': 1}}
+            ],
+            'must_not': [match('b'), match('d')]
+        }})
+
+    def test_cached(self):
+        first = query.compile_query('cached query')
+        self.assertIsNotNone(query._compiled.get('cached query'))
+        second = query.compile_query('cached query')
+        self.assertEqual(first.to_dict(), second.to_dict())
+        self.assertIsNot(first, second)
+
+    def test_empty(self):
+        self.assertIsNone(query.compile_query('NOT'))
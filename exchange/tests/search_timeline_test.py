@@ -0,0 +1,76 @@
+#
+# Tests for the timeline histograms of unified search.
+#
+
+from unittest import TestCase
+
+from django.http import QueryDict
+
+from . import ElasticsearchStandInMixin
+from exchange.search import timeline
+from exchange.search.benchmark import ElasticsearchStandIn
+
+DAY = 86400
+
+
+class IntervalTest(TestCase):
+
+    def test_calendar_intervals(self):
+        self.assertEqual(timeline.get_interval(0, 10 * DAY), 'day')
+        self.assertEqual(timeline.get_interval(0, 2 * 365 * DAY), 'month')
+        self.assertEqual(timeline.get_interval(0, 30 * 365 * DAY), 'year')
+
+    def test_partial_bucket(self):
+        # a part of a day more than TIMELINE_BUCKETS days is a 51st bucket
+        self.assertEqual(
+            timeline.get_interval(0, timeline.TIMELINE_BUCKETS * DAY + 1),
+            'week')
+
+    def test_fixed_interval(self):
+        self.assertEqual(timeline.get_interval(0, 500 * 365 * DAY), '3650d')
+
+    def test_parameter_bounds(self):
+        self.assertEqual(
+            timeline.get_parameter_bounds(
+                QueryDict('date__range=1970-01-02,1970-01-03T00:00:00Z'),
+                'date'),
+            (DAY, 2 * DAY))
+        self.assertEqual(
+            timeline.get_parameter_bounds(
+                QueryDict('extent__gte=now-1y'), 'extent'),
+            (None, None))
+
+    def test_aware_bounds(self):
+        self.assertEqual(
+            timeline.get_parameter_bounds(
+                QueryDict('date__gte=1970-01-02T02:00:00%2B02:00'), 'date'),
+            (DAY, None))
+
+
+class CatalogueBoundsTest(ElasticsearchStandInMixin, TestCase):
+
+    def create_standin(self):
+        return ElasticsearchStandIn(search_response={
+            'took': 1,
+            'timed_out': False,
+            'hits': {'total': 2, 'max_score': 0.0, 'hits': []},
+            'aggregations': {
+                'min': {'value': 0},
+                'max': {'value': 3 * DAY * 1000},
+            }
+        })
+
+    def test_open_bounds(self):
+        search = timeline.add_timeline_aggregations(
+            timeline.elasticsearch_dsl.Search(),
+            QueryDict('date__gte=1970-01-02'))
+        histogram = search.to_dict()['aggs']['date']['date_histogram']
+        self.assertEqual(histogram['interval'], 'hour')
+        self.assertEqual(histogram['extended_bounds'],
+                         {'min': DAY * 1000, 'max': 3 * DAY * 1000})
+
+    def test_cached(self):
+        timeline.get_catalogue_bounds('date')
+        timeline.get_catalogue_bounds('date')
+        self.assertEqual(
+            len([r for r in self.standin.requests if '_search' in r[1]]), 1)
@@ -0,0 +1,550 @@
+#
+# Tests for the unified search view against a local Elasticsearch stand-in.
+#
+
+import json
+import time
+
+import django
+import mock
+from django.contrib.auth.models import AnonymousUser
+from django.http import QueryDict
+from django.test import TestCase, RequestFactory, override_settings
+from elasticsearch_dsl.utils import AttrDict
+
+from . import ElasticsearchStandInMixin
+from exchange.search import timing, views
+from exchange.search.benchmark import ElasticsearchStandIn
+from exchange.search.breaker import search_breaker
+from exchange.search.cache import (invalidate_facet_tables,
+                                   invalidate_search_responses)
+from exchange.search.views import (autocomplete, elastic_search, export_search,
+                                   grid_search, suggest)
+
+SEARCH_RESPONSE = {
+    'took': 3,
+    'timed_out': False,
+    '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+    'hits': {
+        'total': 2,
+        'max_score': None,
+        'hits': [{
+            '_index': 'layer-index',
+            '_type': 'doc',
+            '_id': '1',
+            '_score': None,
+            '_source': {'id': 1, 'title': 'relief', 'type': 'layer',
+                        'bbox': [-10.0, -20.0, 10.0, 20.0]},
+            'sort': [1500000000000, 1]
+        }, {
+            '_index': 'layer-index',
+            '_type': 'doc',
+            '_id': '2',
+            '_score': None,
+            '_source': {'id': 2, 'title': 'boxes', 'type': 'layer'},
+            'sort': [1400000000000, 2]
+        }]
+    },
+    'aggregations': {
+        'type': {'buckets': [{'key': 'layer', 'doc_count': 2}]},
+        'overall_facets': {
+            'doc_count': 5,
+            'visible': {
+                'doc_count': 3,
+                'type': {'buckets': [{'key': 'layer', 'doc_count': 2},
+                                     {'key': 'map', 'doc_count': 1}]}
+            }
+        }
+    }
+}
+
+
+@override_settings(SKIP_PERMS_FILTER=True, API_LIMIT_PER_PAGE=20)
+class UnifiedSearchStandInTest(ElasticsearchStandInMixin, TestCase):
+
+    def create_standin(self):
+        return ElasticsearchStandIn(search_response=SEARCH_RESPONSE)
+
+    def search(self, **params):
+        request = RequestFactory().get('/api/base/search/', params)
+        request.user = AnonymousUser()
+        response = elastic_search(request)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def search_requests(self):
+        return [r for r in self.standin.requests if r[1].endswith('_search')]
+
+    def test_single_round_trip(self):
+        results = self.search(q='relief', limit=2)
+        self.assertEqual(len(self.search_requests()), 1)
+        self.assertEqual(results['meta']['total_count'], 2)
+        self.assertEqual(len(results['objects']), 2)
+
+    def test_facets(self):
+        results = self.search()
+        facets = results['meta']['facets']['type']['facets']
+        self.assertEqual(
+            facets['layer'],
+            {'global_count': 2, 'count': 2, 'display': 'layer'})
+        self.assertEqual(
+            facets['map'],
+            {'global_count': 1, 'count': 0, 'display': 'map'})
+        self.assertEqual(
+            results['meta']['facets']['type']['settings']['display'],
+            'Type')
+
+    def test_cached_response(self):
+        first = self.search(q='relief')
+        second = self.search(q='relief')
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.search_requests()), 1)
+
+        self.search(q='boxes')
+        self.assertEqual(len(self.search_requests()), 2)
+
+    def test_invalidated(self):
+        self.search(q='relief')
+        invalidate_search_responses()
+        self.search(q='relief')
+        self.assertEqual(len(self.search_requests()), 2)
+
+    def last_search_body(self):
+        return json.loads(self.search_requests()[-1][2])
+
+    def test_tiebreaker_sort(self):
+        self.search()
+        sort = self.last_search_body()['sort']
+        self.assertEqual(sort, [
+            {'date': {'order': 'desc', 'missing': '_last',
+                      'unmapped_type': 'date'}},
+            {'id': {'order': 'desc', 'unmapped_type': 'long'}}
+        ])
+
+        self.search(order_by='title')
+        sort = self.last_search_body()['sort']
+        self.assertEqual(sort, [
+            'title_sortable',
+            {'id': {'order': 'desc', 'unmapped_type': 'long'}}
+        ])
+
+    def test_default_sort(self):
+        self.search()
+        body = self.last_search_body()
+        self.assertEqual(list(body['sort'][0]), ['date'])
+        self.assertNotIn('function_score', body.get('query', {}))
+
+    def test_relevance(self):
+        self.search(q='relief', order_by='relevance')
+        body = self.last_search_body()
+        self.assertEqual(body['sort'][0], '_score')
+        function_score = body['query']['function_score']
+        self.assertIn('relief', json.dumps(function_score['query']))
+        self.assertEqual(
+            [list(f)[0] if 'gauss' in f else f['field_value_factor']['field']
+             for f in function_score['functions']],
+            ['gauss', 'popular_count', 'rating'])
+        self.assertEqual(function_score['boost_mode'], 'sum')
+        self.assertEqual(function_score['functions'][0]['filter'],
+                         {'exists': {'field': 'date'}})
+
+    def test_relevance_unmapped(self):
+        # a registry index without dates fails any search decaying on them
+        self.standin.unmapped_fields.add('date')
+        self.search(q='relief', order_by='relevance')
+        functions = self.last_search_body()['query']['function_score'][
+            'functions']
+        self.assertEqual([f['field_value_factor']['field'] for f in functions],
+                         ['popular_count', 'rating'])
+
+    def test_next_cursor(self):
+        results = self.search(q='relief', limit=2, offset=4)
+        next_url = results['meta']['next']
+        self.assertTrue(next_url.startswith('/api/base/search/?'))
+        parameters = QueryDict(next_url.split('?', 1)[1])
+        self.assertNotIn('offset', parameters)
+        self.assertEqual(parameters['q'], 'relief')
+
+        self.search(**parameters.dict())
+        body = self.last_search_body()
+        self.assertEqual(body['search_after'], [1400000000000, 2])
+        self.assertEqual(body['from'], 0)
+        self.assertEqual(body['size'], 2)
+
+    def test_last_page(self):
+        results = self.search(limit=5)
+        self.assertIsNone(results['meta']['next'])
+
+    def test_default_fields(self):
+        self.search()
+        includes = self.last_search_body()['_source']['includes']
+        self.assertIn('title', includes)
+        self.assertNotIn('supplemental_information', includes)
+
+    def test_fields(self):
+        self.search(fields='id, title')
+        self.assertEqual(self.last_search_body()['_source'],
+                         {'includes': ['id', 'title']})
+        self.search(fields='*')
+        self.assertNotIn('_source', self.last_search_body())
+
+    def test_bbox_transform(self):
+        objects = self.search()['objects']
+        self.assertEqual(objects[0]['bbox_left'], -10.0)
+        self.assertEqual(objects[0]['bbox_top'], 20.0)
+        self.assertNotIn('bbox', objects[0])
+        self.assertEqual(objects[0]['index'], 'layer-index')
+
+    def test_timeline(self):
+        results = self.search(
+            timeline='1', date__range='2010-01-01,2012-01-01')
+        histogram = self.last_search_body()['aggs']['date']['date_histogram']
+        self.assertEqual(histogram['field'], 'date')
+        self.assertEqual(histogram['interval'], 'month')
+        self.assertEqual(results['meta']['timeline'], {
+            'date': {'interval': 'month', 'buckets': []}})
+
+    def extent_filter(self):
+        return [f for f in self.last_search_body()['query']['bool']['filter']
+                if 'bool' in f][0]['bool']
+
+    def test_extent_contained(self):
+        self.search(extent='-10,-10,10,10')
+        filters = self.last_search_body()['query']['bool']['filter']
+        self.assertIn({'range': {'bbox_left': {'gte': -10.0}}}, filters)
+
+    def test_extent_relation(self):
+        self.search(extent='-10,-10,10,10', extent_relation='intersects')
+        shapes = [q['geo_shape'] for q in self.extent_filter()['should']
+                  if 'geo_shape' in q]
+        self.assertEqual(shapes, [{
+            'bbox_shape': {
+                'shape': {'type': 'envelope',
+                          'coordinates': [[-10.0, 10.0], [10.0, -10.0]]},
+                'relation': 'intersects'
+            },
+            'ignore_unmapped': True
+        }])
+
+    def test_extent_antimeridian(self):
+        self.search(extent='170,-10,-170,10', extent_relation='within')
+        shapes = [q['geo_shape']['bbox_shape']['shape']['coordinates']
+                  for q in self.extent_filter()['should']
+                  if 'geo_shape' in q]
+        self.assertEqual(shapes, [[[170.0, 10.0], [180.0, -10.0]],
+                                  [[-180.0, 10.0], [-170.0, -10.0]]])
+
+    def test_debug_timing(self):
+        timing = self.search(debug_timing='1')['meta']['debug_timing']
+        self.assertEqual(timing['took'], 3)
+        for stage in ('indices', 'permissions', 'query', 'search',
+                      'facets', 'objects'):
+            self.assertIn(stage, timing['stages'])
+
+        self.assertNotIn('debug_timing', self.search()['meta'])
+
+    def test_slow_search_log(self):
+        with mock.patch.object(timing, 'ES_SLOW_SEARCH_THRESHOLD', 1e-6), \
+                mock.patch.object(timing.slow_logger, 'warn') as warn:
+            self.search(q='relief')
+        message = warn.call_args[0][0]
+        self.assertIn('multi_match', message)
+
+    def test_invalid_cursor(self):
+        request = RequestFactory().get(
+            '/api/base/search/', {'cursor': 'not a cursor'})
+        request.user = AnonymousUser()
+        self.assertEqual(elastic_search(request).status_code, 400)
+
+    def test_mismatched_cursor(self):
+        # ES rejects search_after values that do not match the sort
+        for values, order_by in (([1400000000000], '-date'),
+                                 ([1400000000000, 2, 3], '-date'),
+                                 (['relief', 2], '-date'),
+                                 ([1400000000000, 'two'], '-date'),
+                                 ([True, 2], '-date'),
+                                 ([1400000000000, 2], 'title')):
+            request = RequestFactory().get('/api/base/search/', {
+                'cursor': views.encode_cursor(values),
+                'order_by': order_by})
+            request.user = AnonymousUser()
+            self.assertEqual(elastic_search(request).status_code, 400,
+                             values)
+        self.assertEqual(views.decode_cursor(
+            views.encode_cursor(['relief', 2]), 'title'), ['relief', 2])
+
+
+def buckets(**counts):
+    return {'buckets': [AttrDict({'key': k, 'doc_count': c})
+                        for k, c in sorted(counts.items())]}
+
+
+class FacetResultsTest(TestCase):
+
+    def setUp(self):
+        # connects the signals that rebuild the tables
+        django.setup()
+        invalidate_facet_tables()
+
+    def test_tables_built_once(self):
+        category = mock.Mock(identifier='elevation', description='Elevation',
+                             fa_class='fa-mountain', is_choice=True)
+        with mock.patch.object(views.TopicCategory.objects, 'all',
+                               return_value=[category]) as categories:
+            tables = views.get_facet_tables()
+            self.assertIs(views.get_facet_tables(), tables)
+            self.assertEqual(categories.call_count, 1)
+            self.assertEqual(tables.lookups['category']['elevation'],
+                             {'display': 'Elevation', 'icon': 'fa-mountain'})
+
+            invalidate_facet_tables()
+            views.get_facet_tables()
+            self.assertEqual(categories.call_count, 2)
+
+    def test_tables_cleared_locally(self):
+        # the generation is not seen when the default cache is unavailable
+        with mock.patch.object(views, 'get_generation', return_value=0):
+            tables = views.get_facet_tables()
+            invalidate_facet_tables()
+            self.assertIsNot(views.get_facet_tables(), tables)
+
+    def test_tables_expire(self):
+        tables = views.get_facet_tables()
+        with mock.patch('time.time', return_value=time.time() + 3600):
+            self.assertIsNot(views.get_facet_tables(), tables)
+
+    def test_additional_facets(self):
+        with override_settings(ADDITIONAL_FACETS={
+                'license': {'display': 'License'}}):
+            tables = views.get_facet_tables()
+            self.assertIn('license', tables.fields)
+            self.assertEqual(tables.settings['license']['display'],
+                             'License')
+        self.assertNotIn('license', views.get_facet_tables().fields)
+
+    def test_merge(self):
+        overall = {'type': buckets(layer=3, map=2),
+                   'keywords': buckets(roads=1)}
+        filtered = {'type': buckets(layer=1, document=4),
+                    'keywords': buckets()}
+        results = views.get_facet_results(
+            overall, filtered, QueryDict('type=layer'))
+
+        # keywords has no value in the results
+        self.assertEqual(list(results), ['type'])
+        self.assertEqual(results['type']['facets'], {
+            'layer': {'global_count': 3, 'count': 1, 'display': 'layer'},
+            'map': {'global_count': 2, 'count': 0, 'display': 'map'}})
+        self.assertEqual(results['type']['settings'],
+                         {'open': True, 'show': True, 'display': 'Type'})
+
+
+@override_settings(SKIP_PERMS_FILTER=True, API_LIMIT_PER_PAGE=20)
+class UnavailableSearchStandInTest(ElasticsearchStandInMixin, TestCase):
+
+    def create_standin(self):
+        return ElasticsearchStandIn(search_response=SEARCH_RESPONSE)
+
+    def search(self, **params):
+        request = RequestFactory().get('/api/base/search/', params)
+        request.user = AnonymousUser()
+        return elastic_search(request)
+
+    def test_stale_response(self):
+        fresh = json.loads(self.search(q='relief').content)
+        self.assertNotIn('stale', fresh['meta'])
+        invalidate_search_responses()
+        self.standin.search_status = 503
+
+        response = self.search(q='relief')
+        self.assertEqual(response.status_code, 200)
+        stale = json.loads(response.content)
+        self.assertTrue(stale['meta']['stale'])
+        self.assertEqual(stale['objects'], fresh['objects'])
+
+    def test_unavailable(self):
+        self.standin.search_status = 503
+        response = self.search(q='relief')
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(response['Retry-After'])
+
+    def test_fails_fast_once_open(self):
+        self.standin.search_status = 503
+        with mock.patch.object(search_breaker, 'failures', 2):
+            self.search(q='relief')
+            self.search(q='boxes')
+            self.standin.reset_counters()
+            response = self.search(q='roads')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.standin.requests, [])
+
+
+class ExportSearchStandInTest(ElasticsearchStandInMixin, TestCase):
+
+    def create_standin(self):
+        return ElasticsearchStandIn(search_response=SEARCH_RESPONSE)
+
+    def export(self, **params):
+        request = RequestFactory().get('/api/base/search/export/', params)
+        request.user = AnonymousUser()
+        response = export_search(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return b''.join(response.streaming_content)
+
+    def test_streamed(self):
+        content = self.export(q='relief', extent='-180,-90,180,90')
+        lines = content.splitlines()
+        self.assertEqual(len(lines), 2)
+        first = json.loads(lines[0])
+        self.assertEqual(first['title'], 'relief')
+        self.assertEqual(first['bbox_left'], -10.0)
+
+    def test_scroll_without_aggregations(self):
+        self.export(q='relief')
+        paths = [r[1] for r in self.standin.requests if '_search' in r[1]]
+        self.assertEqual(paths, [
+            '/layer-index,map-index/_search',
+            '/_search/scroll',
+            '/_search/scroll',
+        ])
+        # the scroll is cleared once exhausted
+        self.assertEqual(self.standin.requests[-1][0], 'DELETE')
+        body = json.loads(self.standin.requests[-3][2])
+        self.assertNotIn('aggs', body)
+        self.assertEqual(body['sort'], '_doc')
+        self.assertNotIn('_source', body)
+
+
+@override_settings(SKIP_PERMS_FILTER=True)
+class SuggestStandInTest(ElasticsearchStandInMixin, TestCase):
+
+    def create_standin(self):
+        return ElasticsearchStandIn(search_response=SEARCH_RESPONSE)
+
+    def get(self, view, status=200, **params):
+        request = RequestFactory().get('/api/base/search/suggest/', params)
+        request.user = AnonymousUser()
+        response = view(request)
+        self.assertEqual(response.status_code, status)
+        return response.content
+
+    def search_bodies(self):
+        return [json.loads(r[2]) for r in self.standin.requests
+                if r[1].endswith('_search')]
+
+    def test_suggest(self):
+        content = self.get(suggest, q='Rel')
+        self.assertEqual(json.loads(content), {'suggestions': [
+            {'text': 'relief', 'field': 'title'}]})
+
+        bodies = self.search_bodies()
+        self.assertEqual(len(bodies), 1)
+        self.assertNotIn('aggs', bodies[0])
+        self.assertEqual(bodies[0]['size'], 10)
+        self.assertEqual(sorted(bodies[0]['_source']['includes']),
+                         ['keywords', 'owner__username', 'title'])
+
+    def test_cached(self):
+        self.get(suggest, q='rel')
+        self.get(suggest, q='rel')
+        self.assertEqual(len(self.search_bodies()), 1)
+
+    def test_empty(self):
+        content = self.get(suggest, q=' ')
+        self.assertEqual(json.loads(content), {'suggestions': []})
+        self.assertEqual(self.search_bodies(), [])
+
+    def test_bad_limit(self):
+        self.get(suggest, status=400, q='rel', limit='ten')
+        self.get(autocomplete, status=400, q='rel', limit='ten')
+        self.assertEqual(self.search_bodies(), [])
+
+    def test_negative_limit(self):
+        self.get(suggest, q='rel', limit='-5')
+        self.assertEqual(self.search_bodies()[0]['size'], 1)
+
+    def test_large_limit(self):
+        self.get(suggest, q='rel', limit='1000')
+        self.assertEqual(self.search_bodies()[0]['size'], 50)
+
+    def test_autocomplete(self):
+        content = self.get(autocomplete, q='bo')
+        self.assertEqual(content, '<span data-value="boxes">boxes</span>')
+
+
+GRID_RESPONSE = {
+    'took': 2,
+    'timed_out': False,
+    '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+    'hits': {'total': 3, 'max_score': 0.0, 'hits': []},
+    'aggregations': {'x': {'buckets': [{
+        'key': -22.5,
+        'doc_count': 3,
+        'y': {'buckets': [{
+            'key': 0.0,
+            'doc_count': 3,
+            'left': {'value': -20.0},
+            'bottom': {'value': 1.0},
+            'right': {'value': -2.0},
+            'top': {'value': 9.0},
+        }]}
+    }]}}
+}
+
+
+@override_settings(SKIP_PERMS_FILTER=True)
+class GridSearchStandInTest(ElasticsearchStandInMixin, TestCase):
+
+    def create_standin(self):
+        return ElasticsearchStandIn(search_response=GRID_RESPONSE)
+
+    def grid_response(self, **params):
+        request = RequestFactory().get('/api/base/search/grid/', params)
+        request.user = AnonymousUser()
+        return grid_search(request)
+
+    def grid(self, **params):
+        response = self.grid_response(**params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_buckets(self):
+        grid = self.grid(q='relief')
+        self.assertEqual(grid['meta'], {
+            'cells': 16,
+            'extent': [-180.0, -90.0, 180.0, 90.0],
+            'total_count': 3
+        })
+        self.assertEqual(grid['buckets'], [{
+            'count': 3,
+            'cell': [-22.5, 0.0, 0.0, 11.25],
+            'extent': [-20.0, 1.0, -2.0, 9.0]
+        }])
+
+    def test_request(self):
+        self.grid(extent='-10,-10,10,10', cells='4')
+        body = json.loads(self.standin.requests[-1][2])
+        self.assertEqual(body['size'], 0)
+        x = body['aggs']['x']['histogram']
+        self.assertEqual((x['interval'], x['offset']), (5.0, 0.0))
+        self.assertEqual(
+            sorted(body['aggs']['x']['aggs']['y']['aggs']),
+            ['bottom', 'left', 'right', 'top'])
+
+    def test_cells_clamped(self):
+        self.assertEqual(self.grid(cells='0')['meta']['cells'], 1)
+        self.assertEqual(self.grid(cells='-4')['meta']['cells'], 1)
+        self.assertEqual(self.grid(cells='1000')['meta']['cells'], 64)
+
+    def test_bad_parameters(self):
+        for params in ({'cells': 'many'},
+                       {'extent': '-10,-10,10'},
+                       {'extent': '-10,-10,nan,10'},
+                       {'extent': '10,-10,10,10'},
+                       {'extent': '-10,10,10,-10'},
+                       {'extent': '170,-10,-170,10'}):
+            response = self.grid_response(**params)
+            self.assertEqual(response.status_code, 400, params)
+        self.assertFalse(
+            [r for r in self.standin.requests if '_search' in r[1]])
@@ -0,0 +1,149 @@
+#
+# Tests for the in-process thumbnail cache.
+#
+
+from unittest import TestCase
+
+from django.test import override_settings
+
+from exchange.thumbnails import cache
+
+
+def entry(img):
+    return cache.ThumbnailEntry('image/png', img, None, None, None)
+
+
+class ByteBudgetCacheTest(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        lru = cache.ByteBudgetCache(100, 60)
+        lru.set('a', 1, 12)
+        lru.set('b', 2, 12)
+        lru.get('a')
+        for key in 'cdefgh':
+            lru.set(key, key, 12)
+        self.assertEqual(lru.bytes, 96)
+        lru.set('i', 'i', 12)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.bytes, 96)
+
+    def test_large_values_not_cached(self):
+        lru = cache.ByteBudgetCache(100, 60)
+        lru.set('a', 1, 13)
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(lru.bytes, 0)
+
+    def test_budget(self):
+        lru = cache.ByteBudgetCache(100, 60)
+        for i in range(10):
+            lru.set(i, i, 12)
+        self.assertEqual(lru.bytes, 96)
+        self.assertEqual(len(lru), 8)
+        self.assertIsNone(lru.get(0))
+        self.assertEqual(lru.get(9), 9)
+
+    def test_counters(self):
+        lru = cache.ByteBudgetCache(100, 60)
+        lru.get('a')
+        lru.set('a', 1, 1)
+        lru.get('a')
+        lru.get('a')
+        self.assertEqual(lru.stats(), {
+            'hits': 2, 'misses': 1, 'entries': 1, 'bytes': 1})
+
+    def test_ttl(self):
+        lru = cache.ByteBudgetCache(100, -1)
+        lru.set('a', 1, 1)
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(lru.bytes, 0)
+
+
+class ThumbnailCacheTest(TestCase):
+
+    def test_loaded_once(self):
+        thumbnails = cache.ThumbnailCache(10000, 60)
+        loads = []
+
+        def load_many(keys):
+            loads.extend(keys)
+            return dict((key, entry(key[1])) for key in keys)
+
+        thumbnails.get(('maps', '1'), load_many)
+        entries = thumbnails.get_many(
+            [('maps', '1'), ('maps', '2')], load_many)
+        self.assertEqual(entries, {('maps', '1'): entry('1'),
+                                   ('maps', '2'): entry('2')})
+        self.assertEqual(loads, [('maps', '1'), ('maps', '2')])
+
+        thumbnails.invalidate('maps', '1')
+        thumbnails.get(('maps', '1'), load_many)
+        self.assertEqual(len(loads), 3)
+        self.assertEqual(thumbnails.stats()['hits'], 1)
+
+    def test_missing_cached(self):
+        thumbnails = cache.ThumbnailCache(10000, 60)
+        loads = []
+
+        def load_many(keys):
+            loads.extend(keys)
+            return {}
+
+        self.assertIsNone(thumbnails.get(('documents', '1'), load_many))
+        self.assertEqual(
+            thumbnails.get_many([('documents', '1')], load_many), {})
+        self.assertEqual(len(loads), 1)
+
+        # saving the thumbnail bumps its version
+        thumbnails.invalidate('documents', '1')
+        self.assertEqual(
+            thumbnails.get(('documents', '1'),
+                           lambda keys: {keys[0]: entry('png')}),
+            entry('png'))
+
+    def test_versioned(self):
+        # processes sharing the default cache see each other's saves
+        first = cache.ThumbnailCache(10000, 60)
+        second = cache.ThumbnailCache(10000, 60)
+        first.get(('maps', '1'), lambda keys: {keys[0]: entry('png')})
+        second.invalidate('maps', '1')
+        self.assertEqual(
+            first.get(('maps', '1'), lambda keys: {keys[0]: entry('new')}),
+            entry('new'))
+
+    def test_stale_is_miss(self):
+        thumbnails = cache.ThumbnailCache(10000, 60)
+        thumbnails.get(('maps', '1'), lambda keys: {keys[0]: entry('png')})
+        thumbnails.invalidate('maps', '1')
+        thumbnails.get(('maps', '1'), lambda keys: {keys[0]: entry('new')})
+        stats = thumbnails.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 2))
+
+    def test_images(self):
+        thumbnails = cache.ThumbnailCache(10000, 60)
+        loads = []
+
+        def load(key):
+            loads.append(key)
+            return 'png'
+
+        self.assertEqual(thumbnails.get_image('abcd', load), 'png')
+        self.assertEqual(thumbnails.get_image('abcd', load), 'png')
+        self.assertEqual(loads, ['abcd'])
+
+    def test_shared(self):
+        local_cache = 'django.core.cache.backends.locmem.LocMemCache'
+        with override_settings(CACHES={'default': {'BACKEND': local_cache}}):
+            first = cache.ThumbnailCache(10000, 60, 'default')
+            second = cache.ThumbnailCache(10000, 60, 'default')
+            first.get(('maps', '1'), lambda keys: {keys[0]: entry('png')})
+            self.assertEqual(
+                second.get(('maps', '1'),
+                           lambda keys: {keys[0]: entry('other')}),
+                entry('png'))
+            self.assertEqual(second.stats()['shared_hits'], 1)
+
+            # missing thumbnails are shared too
+            first.get(('maps', '2'), lambda keys: {})
+            self.assertIsNone(second.get(
+                ('maps', '2'), lambda keys: {keys[0]: entry('other')}))
@@ -7,11 +7,23 @@ from . import ExchangeTest
 
 from base64 import b64encode
 
+import json
+import mock
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from six import StringIO
+
+from exchange.thumbnails.cache import thumbnail_cache
+from exchange.thumbnails.models import Thumbnail, save_thumbnail
+from exchange.thumbnails.storage import get_image_key, get_thumbnail_storage
+
 
 class ThumbnailTest(ExchangeTest):
 
     def setUp(self):
         super(ThumbnailTest, self).setUp()
+        thumbnail_cache.clear()
 
         self.login()
 
@@ -20,6 +32,21 @@ class ThumbnailTest(ExchangeTest):
         self.assertEqual(r.status_code, 200, "Failed to get thumbnail")
         return r
 
+    # queries against the thumbnail table while calling func
+    #
+    def thumbnail_queries(self, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            result = func(*args, **kwargs)
+        return result, [q for q in queries.captured_queries
+                        if 'thumbnails_thumbnail' in q['sql']]
+
+    # responses may stream their image
+    #
+    def get_content(self, r):
+        if r.streaming:
+            return ''.join(r.streaming_content)
+        return r.content
+
     def test_blank(self):
         r = self.client.get('/thumbnails/maps/no-id')
 
@@ -54,7 +81,7 @@ class ThumbnailTest(ExchangeTest):
         # and check that we have somehting more like test_thumbnail1.png
 
         r = self.get_thumbnail('/thumbnails/maps/0')
-        self.assertEqual(len(r.content), 4911,
+        self.assertEqual(len(self.get_content(r)), 4911,
                          'This does not look like thumbnail 1')
 
     def test_bad_image(self):
@@ -107,7 +134,7 @@ class ThumbnailTest(ExchangeTest):
 
         # then test the correct image came back.
         r = self.client.get('/thumbnails/maps/0')
-        test_b64 = b64encode(r.content)
+        test_b64 = b64encode(self.get_content(r))
         self.assertEqual(test_b64, b64encode(thumbpng),
                          'Images appear to differ.')
 
@@ -125,11 +152,249 @@ class ThumbnailTest(ExchangeTest):
 
         r = self.client.get('/thumbnails/layers/layer1')
         self.assertEqual(r.status_code, 200, 'failed to retrieve thumbnail')
-        data1 = r.content
+        data1 = self.get_content(r)
 
         r = self.client.get('/thumbnails/layers/layer2')
         self.assertEqual(r.status_code, 200, 'failed to retrieve thumbnail')
-        data2 = r.content
+        data2 = self.get_content(r)
 
         self.assertEqual(data1, png1, 'Mismatch in thumbnail 1')
         self.assertEqual(data2, png2, 'Mismatch in thumbnail 2')
+
+    # Images are stored once in the thumbnail storage, under their hash,
+    # and only their key is kept in the database.
+    #
+    def test_content_addressed(self):
+        png = open(self.get_file_path('test_thumbnail0.png'), 'rb').read()
+
+        self.client.post('/thumbnails/layers/layer1', png,
+                         content_type='image/png')
+        self.client.post('/thumbnails/layers/layer2', png,
+                         content_type='image/png')
+
+        thumbs = Thumbnail.objects.filter(object_type='layers')
+        self.assertEqual(
+            set(t.thumbnail_hash for t in thumbs), set([get_image_key(png)]))
+        self.assertEqual([t.thumbnail_img for t in thumbs], [None, None])
+
+        path = get_thumbnail_storage().path(get_image_key(png))
+        self.assertEqual(open(path, 'rb').read(), png)
+
+    def test_sendfile(self):
+        png = open(self.get_file_path('test_thumbnail0.png'), 'rb').read()
+        self.client.post('/thumbnails/maps/0', png, content_type='image/png')
+        storage = get_thumbnail_storage()
+        key = get_image_key(png)
+
+        with mock.patch.object(storage, 'sendfile', 'x-sendfile'):
+            r = self.get_thumbnail('/thumbnails/maps/0')
+        self.assertEqual(r['X-Sendfile'], storage.path(key))
+
+        with mock.patch.object(storage, 'sendfile', 'x-accel-redirect'):
+            r = self.get_thumbnail('/thumbnails/maps/0')
+        self.assertEqual(
+            r['X-Accel-Redirect'],
+            '/thumbnail_store/{}/{}/{}'.format(key[0:2], key[2:4], key))
+
+    # a save of the same image referenced it while it was released
+    #
+    def test_release_race(self):
+        from exchange.thumbnails import models
+
+        png = open(self.get_file_path('test_thumbnail0.png'), 'rb').read()
+        key = get_thumbnail_storage().save(png)
+        with mock.patch.object(models, 'is_image_used',
+                               side_effect=[False, True]):
+            models.release_image(key)
+        self.assertTrue(get_thumbnail_storage().exists(key))
+
+        models.release_image(key)
+        self.assertFalse(get_thumbnail_storage().exists(key))
+
+    def test_missing_image(self):
+        png = open(self.get_file_path('test_thumbnail0.png'), 'rb').read()
+        self.client.post('/thumbnails/maps/0', png, content_type='image/png')
+        get_thumbnail_storage().delete(get_image_key(png))
+        thumbnail_cache.clear()
+
+        missing = self.get_thumbnail('/thumbnails/maps/no-id')
+        r = self.get_thumbnail('/thumbnails/maps/0')
+        self.assertEqual(r.content, missing.content)
+        self.assertNotIn('ETag', r)
+
+        r = self.client.get('/thumbnails/batch', {'id': 'maps/0'})
+        self.assertEqual(
+            json.loads(r.content)['thumbnails']['maps/0'],
+            'data:image/png;base64,' + b64encode(missing.content))
+
+    def test_migrate_thumbnails(self):
+        png = open(self.get_file_path('test_thumbnail0.png'), 'rb').read()
+        Thumbnail.objects.create(object_type='maps', object_id='0',
+                                 thumbnail_mime='image/png',
+                                 thumbnail_img=png)
+
+        # served from the database until it is moved
+        r = self.get_thumbnail('/thumbnails/maps/0')
+        self.assertEqual(self.get_content(r), png)
+
+        call_command('migrate_thumbnails', stdout=StringIO())
+        thumb = Thumbnail.objects.get(object_type='maps', object_id='0')
+        self.assertEqual(thumb.thumbnail_hash, get_image_key(png))
+        self.assertIsNone(thumb.thumbnail_img)
+
+        r = self.get_thumbnail('/thumbnails/maps/0')
+        self.assertEqual(self.get_content(r), png)
+
+    def test_conditional_get(self):
+        png = open(self.get_file_path('test_thumbnail0.png'), 'rb').read()
+        self.client.post('/thumbnails/maps/0', png, content_type='image/png')
+
+        r = self.get_thumbnail('/thumbnails/maps/0')
+        etag = r['ETag']
+        self.assertEqual(etag, '"{}"'.format(get_image_key(png)))
+        self.assertIn('max-age=', r['Cache-Control'])
+
+        # the image is not read to answer a conditional GET
+        thumbnail_cache.clear()
+        with mock.patch.object(get_thumbnail_storage(), 'open',
+                               side_effect=AssertionError):
+            r = self.client.get('/thumbnails/maps/0',
+                                HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r['ETag'], etag)
+
+        r = self.client.get('/thumbnails/maps/0',
+                            HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(r.status_code, 200)
+
+        r = self.client.get('/thumbnails/maps/0',
+                            HTTP_IF_MODIFIED_SINCE=r['Last-Modified'])
+        self.assertEqual(r.status_code, 304)
+
+    def test_cached(self):
+        png = open(self.get_file_path('test_thumbnail0.png'), 'rb').read()
+        self.client.post('/thumbnails/maps/0', png, content_type='image/png')
+
+        self.get_thumbnail('/thumbnails/maps/0')
+        r, queries = self.thumbnail_queries(
+            self.get_thumbnail, '/thumbnails/maps/0')
+        self.assertEqual(queries, [])
+        self.assertEqual(self.get_content(r), png)
+        # the entry and the image
+        self.assertEqual(thumbnail_cache.stats()['hits'], 2)
+
+        # a new image replaces the cached one
+        png1 = open(self.get_file_path('test_thumbnail1.png'), 'rb').read()
+        self.client.post('/thumbnails/maps/0', png1, content_type='image/png')
+        r = self.get_thumbnail('/thumbnails/maps/0')
+        self.assertEqual(self.get_content(r), png1)
+
+    def test_batch(self):
+        png = open(self.get_file_path('test_thumbnail0.png'), 'rb').read()
+        self.client.post('/thumbnails/maps/0', png, content_type='image/png')
+        self.client.post('/thumbnails/layers/0', png,
+                         content_type='image/png')
+
+        r, queries = self.thumbnail_queries(
+            self.client.get, '/thumbnails/batch',
+            {'id': ['maps/0', 'layers/0', 'maps/1']})
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(r.status_code, 200)
+        thumbnails = json.loads(r.content)['thumbnails']
+        self.assertEqual(sorted(thumbnails), ['layers/0', 'maps/0', 'maps/1'])
+        self.assertEqual(thumbnails['maps/0'],
+                         'data:image/png;base64,' + b64encode(png))
+
+        missing = self.client.get('/thumbnails/maps/1')
+        self.assertEqual(thumbnails['maps/1'],
+                         'data:image/png;base64,' + b64encode(missing.content))
+
+    def test_batch_not_migrated(self):
+        # images still in the database are read with a single query
+        png = open(self.get_file_path('test_thumbnail0.png'), 'rb').read()
+        for object_id in ('0', '1', '2'):
+            Thumbnail.objects.create(object_type='maps', object_id=object_id,
+                                     thumbnail_mime='image/png',
+                                     thumbnail_img=png)
+
+        r, queries = self.thumbnail_queries(
+            self.client.get, '/thumbnails/batch',
+            {'id': ['maps/0', 'maps/1', 'maps/2']})
+        self.assertEqual(len(queries), 2)
+        thumbnails = json.loads(r.content)['thumbnails']
+        self.assertEqual(set(thumbnails.values()),
+                         set(['data:image/png;base64,' + b64encode(png)]))
+
+    def test_bad_batch(self):
+        r = self.client.get('/thumbnails/batch', {'id': 'chicken/feed'})
+        self.assertEqual(r.status_code, 400)
+
+    def test_batch_unicode_ids(self):
+        png = open(self.get_file_path('test_thumbnail0.png'), 'rb').read()
+        save_thumbnail('layers', u'geonode:caf\xe9', 'image/png', png)
+
+        r = self.client.get('/thumbnails/batch',
+                            {'id': [u'layers/geonode:caf\xe9', u'maps/\xe9']})
+        self.assertEqual(r.status_code, 200)
+        thumbnails = json.loads(r.content)['thumbnails']
+        self.assertEqual(sorted(thumbnails),
+                         [u'layers/geonode:caf\xe9', u'maps/\xe9'])
+        self.assertEqual(thumbnails[u'layers/geonode:caf\xe9'],
+                         'data:image/png;base64,' + b64encode(png))
+
+        r = self.client.get('/thumbnails/batch', {'id': u'caf\xe9/1'})
+        self.assertEqual(r.status_code, 400)
+        self.assertIn(u'caf\xe9', r.content.decode('utf-8'))
+
+    # GeoServer is asked again by retries of the task, not in a loop
+    #
+    def generate_thumbnail(self, *outcomes):
+        from exchange.thumbnails import tasks
+
+        with mock.patch.object(tasks, 'Map') as Map, \
+                mock.patch.object(tasks, 'get_gs_thumbnail',
+                                  side_effect=outcomes) as get_gs_thumbnail:
+            Map.objects.get.return_value = mock.Mock(is_remote=False)
+            tasks.generate_thumbnail_task.apply(
+                kwargs={'instance_id': 0, 'class_name': 'Map'})
+        return [c[0][1] for c in get_gs_thumbnail.call_args_list]
+
+    def test_generation_retries(self):
+        from exchange.thumbnails import tasks
+
+        png = open(self.get_file_path('test_thumbnail0.png'), 'rb').read()
+        attempts = self.generate_thumbnail(
+            (tasks.THUMBNAIL_PENDING, None),
+            (tasks.THUMBNAIL_PENDING, None),
+            (tasks.THUMBNAIL_READY, png))
+        self.assertEqual(attempts, [0, 1, 2])
+
+        thumb = Thumbnail.objects.get(object_type='maps', object_id='0')
+        self.assertEqual(thumb.get_image(), png)
+        self.assertTrue(thumb.is_automatic)
+        self.assertEqual(thumb.generation_attempts, 3)
+
+    def test_generation_gives_up(self):
+        from exchange.thumbnails import tasks
+
+        attempts = self.generate_thumbnail(
+            (tasks.THUMBNAIL_PENDING, None),
+            (tasks.THUMBNAIL_FAILED, None))
+        self.assertEqual(attempts, [0, 1])
+
+        with self.settings(THUMBNAIL_CONFIG={'generation_attempts': 2}):
+            attempts = self.generate_thumbnail(
+                *[(tasks.THUMBNAIL_PENDING, None)] * 3)
+        self.assertEqual(attempts, [0, 1])
+        self.assertFalse(Thumbnail.objects.filter(
+            object_type='maps', object_id='0').exists())
+
+    def test_retry_countdown(self):
+        from exchange.thumbnails.tasks import get_retry_countdown
+
+        with mock.patch('random.uniform', lambda a, b: b):
+            self.assertEqual(get_retry_countdown(0), 3)
+            self.assertEqual(get_retry_countdown(3), 24)
+            self.assertEqual(get_retry_countdown(10), 60)
+        with mock.patch('random.uniform', lambda a, b: a):
+            self.assertEqual(get_retry_countdown(3), 12)
@@ -0,0 +1,290 @@
+#
+# In-process cache of thumbnails, with an optional shared tier.
+#
+# Popular thumbnails are requested over and over, the cache keeps their
+# validators and bytes in each worker so that those requests touch
+# neither the database nor the thumbnail storage.
+#
+
+from collections import namedtuple, OrderedDict
+import hashlib
+import logging
+import threading
+import time
+
+from django.core.cache import cache, caches
+
+from .storage import get_thumbnail_config
+
+logger = logging.getLogger(__name__)
+
+# img is only set on thumbnails saved before images moved to the
+# thumbnail storage, stored images are read by key.
+ThumbnailEntry = namedtuple(
+    'ThumbnailEntry', ['mime', 'img', 'key', 'etag', 'last_modified'])
+# rough size of an entry besides its image
+ENTRY_OVERHEAD = 256
+# local cache keys of image bytes, object types never take this value
+IMAGE = 'image'
+ENTRY_PREFIX = 'exchange-thumbnail'
+IMAGE_PREFIX = 'exchange-thumbnail-image'
+VERSION_PREFIX = 'exchange-thumbnail-version'
+
+
+class ByteBudgetCache(object):
+    '''
+    Thread safe LRU cache bounded by the total size of its values.
+
+    Entries are evicted least recently used first once the sizes add up
+    to more than max_bytes, values larger than max_bytes / 8 are not
+    cached at all. Entries are ignored once they are older than ttl
+    seconds.
+    '''
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, is_valid=None):
+        '''
+        Return the value of key, None when it is missing, expired or
+        is_valid(value) is false.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and (
+                    entry[0] < time.time() or
+                    (is_valid is not None and not is_valid(entry[2]))):
+                self.bytes -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # re-insert as the most recently used entry
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value, size):
+        if size > self.max_bytes / 8:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self._entries[key] = (time.time() + self.ttl, size, value)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                evicted = self._entries.popitem(last=False)[1]
+                self.bytes -= evicted[1]
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+            }
+
+
+def get_entry_size(entry):
+    if entry is None:
+        return ENTRY_OVERHEAD
+    return ENTRY_OVERHEAD + len(entry.img or '')
+
+
+def get_cache_key(prefix, *parts):
+    # object ids may hold characters cache keys cannot
+    return '{}-{}'.format(prefix, hashlib.sha1(
+        u'/'.join(u'{}'.format(part) for part in parts).encode('utf-8')
+    ).hexdigest())
+
+
+class ThumbnailCache(object):
+    '''
+    Thumbnail entries cached in this process and, when 'cache_backend'
+    names one of the CACHES, in that shared cache.
+
+    Entries hold the validators of a thumbnail, the bytes of stored
+    images are cached apart under their storage key so that answering a
+    conditional GET never reads an image. Objects without a thumbnail
+    are cached too, as missing. Stored images never change, entries are
+    cached under a version of their thumbnail kept in the default cache.
+    Saving a thumbnail bumps the version, which drops its entries in
+    every process sharing the default cache. When that cache is local to
+    each process, other processes only see a saved thumbnail once their
+    entries expire, after cache_ttl seconds.
+    '''
+
+    def __init__(self, max_bytes, ttl, backend=None):
+        self.local = ByteBudgetCache(max_bytes, ttl)
+        self.ttl = ttl
+        self.backend = backend
+        self.shared_hits = 0
+
+    def get_shared(self):
+        return caches[self.backend] if self.backend else None
+
+    def get_versions(self, keys):
+        version_keys = dict(
+            (get_cache_key(VERSION_PREFIX, *key), key) for key in keys)
+        try:
+            found = cache.get_many(list(version_keys))
+        except Exception as e:
+            logger.warn('Thumbnail: unable to read versions: %s', e)
+            found = {}
+        return dict((key, found.get(version_key, 0))
+                    for version_key, key in version_keys.items())
+
+    def get(self, key, load_many):
+        '''
+        Return the entry of the (object type, object id) key, None if
+        load_many did not build one.
+        '''
+        return self.get_many([key], load_many).get(key)
+
+    def get_many(self, keys, load_many):
+        '''
+        Return a dict of the entries of (object type, object id) keys,
+        keys without a thumbnail are left out.
+
+        load_many(keys) builds the entries missing from both tiers, as a
+        dict, keys it leaves out or sets to None are cached as having no
+        thumbnail.
+        '''
+        versions = self.get_versions(keys)
+        entries = {}
+        missing = []
+        for key in keys:
+            # entries of an older version are stale, and count as misses
+            cached = self.local.get(
+                key, lambda cached: cached[0] == versions[key])
+            if cached is None:
+                missing.append(key)
+            elif cached[1] is not None:
+                entries[key] = cached[1]
+
+        shared = self.get_shared()
+        shared_keys = dict(
+            (get_cache_key(ENTRY_PREFIX, key[0], key[1], versions[key]), key)
+            for key in missing)
+        if missing and shared is not None:
+            try:
+                found = shared.get_many(list(shared_keys))
+            except Exception as e:
+                logger.warn('Thumbnail: unable to read shared cache: %s', e)
+                found = {}
+            found_keys = set()
+            for shared_key, entry in found.items():
+                key = shared_keys[shared_key]
+                # an empty tuple is cached for keys without a thumbnail
+                entry = ThumbnailEntry(*entry) if entry else None
+                self.local.set(
+                    key, (versions[key], entry), get_entry_size(entry))
+                if entry is not None:
+                    entries[key] = entry
+                found_keys.add(key)
+                self.shared_hits += 1
+            missing = [key for key in missing if key not in found_keys]
+
+        if not missing:
+            return entries
+        loaded = load_many(missing)
+        loaded = dict((key, loaded.get(key)) for key in missing)
+        for key, entry in loaded.items():
+            self.local.set(key, (versions[key], entry), get_entry_size(entry))
+        if shared is not None:
+            try:
+                shared.set_many(dict(
+                    (shared_key, tuple(loaded[key] or ()))
+                    for shared_key, key in shared_keys.items()
+                    if key in loaded), self.ttl)
+            except Exception as e:
+                logger.warn('Thumbnail: unable to write shared cache: %s', e)
+        entries.update(
+            (key, entry) for key, entry in loaded.items()
+            if entry is not None)
+        return entries
+
+    def get_image(self, image_key, load):
+        '''
+        Return the bytes of the stored image image_key, load(image_key)
+        reads them when neither tier has them.
+        '''
+        key = (IMAGE, image_key)
+        img = self.local.get(key)
+        if img is not None:
+            return img
+
+        shared = self.get_shared()
+        shared_key = get_cache_key(IMAGE_PREFIX, image_key)
+        if shared is not None:
+            try:
+                img = shared.get(shared_key)
+            except Exception as e:
+                logger.warn('Thumbnail: unable to read shared cache: %s', e)
+            if img is not None:
+                self.shared_hits += 1
+
+        if img is None:
+            img = load(image_key)
+            if shared is not None and len(img) <= self.local.max_bytes / 8:
+                try:
+                    shared.set(shared_key, img, self.ttl)
+                except Exception as e:
+                    logger.warn(
+                        'Thumbnail: unable to write shared cache: %s', e)
+        self.local.set(key, img, len(img))
+        return img
+
+    def invalidate(self, object_type, object_id):
+        self.local.delete((object_type, object_id))
+        version_key = get_cache_key(VERSION_PREFIX, object_type, object_id)
+        try:
+            if not cache.add(version_key, 1, None):
+                cache.incr(version_key)
+        except Exception as e:
+            logger.warn('Thumbnail: unable to bump version: %s', e)
+
+    def clear(self):
+        self.local.clear()
+        self.shared_hits = 0
+
+    def stats(self):
+        stats = self.local.stats()
+        stats['shared_hits'] = self.shared_hits
+        return stats
+
+
+def create_thumbnail_cache():
+    conf = get_thumbnail_config()
+    return ThumbnailCache(
+        conf.get('cache_bytes', 32 * 1024 * 1024),
+        conf.get('cache_ttl', 300),
+        conf.get('cache_backend') or None
+    )
+
+
+thumbnail_cache = create_thumbnail_cache()
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from exchange.thumbnails.cache import thumbnail_cache
+from exchange.thumbnails.models import Thumbnail, keep_image
+from exchange.thumbnails.storage import get_thumbnail_storage
+
+
+class Command(BaseCommand):
+    help = ('Move the thumbnail images stored in the database to the '
+            'thumbnail storage')
+
+    def handle(self, *args, **options):
+        storage = get_thumbnail_storage()
+        legacy = Thumbnail.objects.filter(
+            thumbnail_hash__isnull=True, thumbnail_img__isnull=False)
+        ids = list(legacy.values_list('id', flat=True))
+
+        moved = 0
+        # one image in memory at a time
+        for pk in ids:
+            row = Thumbnail.objects.filter(id=pk).values_list(
+                'object_type', 'object_id', 'thumbnail_img').first()
+            if row is None or row[2] is None:
+                continue
+            object_type, object_id, img = row
+            img = bytes(img)
+            key = storage.save(img)
+            Thumbnail.objects.filter(
+                id=pk, thumbnail_hash__isnull=True
+            ).update(
+                thumbnail_hash=key,
+                thumbnail_size=len(img),
+                thumbnail_img=None,
+                last_modified=timezone.now()
+            )
+            keep_image(key, img)
+            thumbnail_cache.invalidate(object_type, object_id)
+            moved += 1
+
+        self.stdout.write("%s of %s thumbnails moved" % (moved, len(ids)))
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thumbnails', '0002_auto_20170504_1443'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumbnail',
+            name='thumbnail_hash',
+            field=models.CharField(
+                db_index=True, max_length=40, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='thumbnail',
+            name='thumbnail_size',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+    ]
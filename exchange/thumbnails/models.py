@@ -4,6 +4,9 @@
 
 from django.db import models
 
+from .cache import thumbnail_cache
+from .storage import get_thumbnail_storage
+
 
 class Thumbnail(models.Model):
     object_type = models.CharField(max_length=255,
@@ -11,33 +14,106 @@ class Thumbnail(models.Model):
     object_id = models.CharField(max_length=255, blank=False)
 
     thumbnail_mime = models.CharField(max_length=127, null=True, blank=True)
+    # only set on thumbnails saved before images moved to the
+    # thumbnail storage, see the migrate_thumbnails command.
     thumbnail_img = models.BinaryField(null=True, blank=True)
+    # key of the image in the thumbnail storage
+    thumbnail_hash = models.CharField(
+        max_length=40, null=True, blank=True, db_index=True)
+    thumbnail_size = models.IntegerField(null=True, blank=True)
+    # validators of conditional GETs, the hash is the ETag
+    last_modified = models.DateTimeField(auto_now=True, null=True, blank=True)
 
     is_automatic = models.BooleanField(default=False)
+    # requests to GeoServer it took to generate an automatic thumbnail
+    generation_attempts = models.IntegerField(null=True, blank=True)
 
     class Meta:
         unique_together = ('object_type', 'object_id')
 
+    def get_image(self):
+        if self.thumbnail_hash:
+            with get_thumbnail_storage().open(self.thumbnail_hash) as f:
+                return f.read()
+        if self.thumbnail_img is not None:
+            return bytes(self.thumbnail_img)
+        return None
+
+
+# Store the image of a thumbnail and drop the image it replaces,
+# unless another thumbnail uses the same image.
+#
+def store_image(thumb, img):
+    storage = get_thumbnail_storage()
+    previous = thumb.thumbnail_hash
+
+    thumb.thumbnail_hash = storage.save(img)
+    thumb.thumbnail_size = len(img)
+    thumb.thumbnail_img = None
+
+    return previous
+
+
+def is_image_used(key):
+    return Thumbnail.objects.filter(thumbnail_hash=key).exists()
+
+
+# Delete a stored image unless a thumbnail uses it.
+#
+# A save of the same image may find it stored just before it is deleted,
+# and only reference it once the check is done. Both sides check again
+# afterwards: the image is stored back here if a reference appeared
+# once it is deleted, and by keep_image if it is gone once the saving
+# thumbnail is written. Whatever the order, one of them sees the other.
+#
+def release_image(key):
+    if not key or is_image_used(key):
+        return
+    storage = get_thumbnail_storage()
+    try:
+        with storage.open(key) as f:
+            img = f.read()
+    except IOError:
+        return
+    storage.delete(key)
+    if is_image_used(key):
+        storage.save(img)
+
+
+# Store the image of a written thumbnail again if a concurrent
+# release_image deleted it in the meantime.
+#
+def keep_image(key, img):
+    storage = get_thumbnail_storage()
+    if not storage.exists(key):
+        storage.save(img)
+
 
 # This function properly handles updating vs inserting
 # for a thumbnail. Django ".save" was not properly dealing
 # with the composite primary key.
 #
-def save_thumbnail(objectType, objectId, mime, img, automatic=False):
+def save_thumbnail(objectType, objectId, mime, img, automatic=False,
+                   attempts=None):
     thumb = None
     try:
-        thumb = Thumbnail.objects.get(
+        thumb = Thumbnail.objects.defer('thumbnail_img').get(
             object_type=objectType, object_id=objectId)
     except Thumbnail.DoesNotExist:
         thumb = Thumbnail(object_type=objectType, object_id=objectId)
 
     # set the image and the mime type
     thumb.thumbnail_mime = mime
-    thumb.thumbnail_img = img
+    previous = store_image(thumb, img)
     thumb.is_automatic = automatic
+    thumb.generation_attempts = attempts
 
-    # save the thumbnail
+    # save the thumbnail, saves are committed right away
     thumb.save()
+    keep_image(thumb.thumbnail_hash, img)
+    thumbnail_cache.invalidate(objectType, objectId)
+    if previous != thumb.thumbnail_hash:
+        release_image(previous)
 
 
 # Check to see if this is an 'automatic' type
@@ -50,7 +126,7 @@ def save_thumbnail(objectType, objectId, mime, img, automatic=False):
 #
 def is_automatic(objectType, objectId):
     try:
-        t = Thumbnail.objects.get(
+        t = Thumbnail.objects.defer('thumbnail_img').get(
             object_type=objectType, object_id=objectId)
     # when no legend exists, then one should be generated automatically.
     except Thumbnail.DoesNotExist:
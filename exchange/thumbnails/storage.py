@@ -0,0 +1,196 @@
+#
+# Storage of thumbnail images outside of the database.
+#
+# Images are content addressed, they are stored under the sha1 of
+# their bytes. The same image is stored once however many thumbnails
+# use it, and a stored image never changes.
+#
+
+import abc
+import hashlib
+import os
+import tempfile
+import threading
+
+import six
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+DEFAULT_STORAGE = 'exchange.thumbnails.storage.FileSystemThumbnailStorage'
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_thumbnail_config():
+    """
+    example settings file
+    THUMBNAIL_CONFIG = {
+        'storage': 'exchange.thumbnails.storage.FileSystemThumbnailStorage',
+        'store_dir': '/var/lib/exchange/thumbnails',
+        'sendfile': 'x-accel-redirect',
+        'accel_redirect_prefix': '/thumbnail_store/',
+        'max_age': 3600,
+        'cache_bytes': 33554432,
+        'cache_ttl': 300,
+        'cache_backend': 'default',
+        'generation_attempts': 15,
+        'retry_delay': 3,
+        'retry_delay_max': 60
+    }
+    """
+    return getattr(settings, 'THUMBNAIL_CONFIG', {})
+
+
+def get_image_key(img):
+    return hashlib.sha1(img).hexdigest()
+
+
+@six.add_metaclass(abc.ABCMeta)
+class ThumbnailStorage(object):
+    '''
+    Interface of thumbnail stores, images are read and written by key.
+    '''
+
+    @abc.abstractmethod
+    def save(self, img):
+        '''
+        Store img and return its key.
+        '''
+
+    @abc.abstractmethod
+    def open(self, key):
+        '''
+        Return a file of the stored image, raises IOError if it is gone.
+        '''
+
+    @abc.abstractmethod
+    def exists(self, key):
+        '''
+        Whether the image is stored.
+        '''
+
+    @abc.abstractmethod
+    def delete(self, key):
+        '''
+        Delete the stored image, if there is one.
+        '''
+
+    def path(self, key):
+        '''
+        Path of the stored image on the local filesystem, None if it is
+        not stored in a local file.
+        '''
+        return None
+
+    def serve(self, key, content_type):
+        '''
+        Return a response having the web server send the stored image,
+        None when the image is sent by exchange.
+        '''
+        return None
+
+
+class FileSystemThumbnailStorage(ThumbnailStorage):
+    '''
+    Stores images in a directory tree sharded on the first characters
+    of their key, ab/cd/abcd... so that no directory grows too large.
+
+    Images are served by the web server when 'sendfile' is set to
+    'x-sendfile' (apache mod_xsendfile) or 'x-accel-redirect' (nginx),
+    and by exchange, through the thumbnail cache, otherwise.
+
+    nginx needs an internal location for the store:
+    location /thumbnail_store/ {
+        internal;
+        alias /var/lib/exchange/thumbnails/;
+    }
+    '''
+
+    def __init__(self, location, sendfile=None, accel_redirect_prefix=None):
+        self.location = os.path.normpath(location)
+        self.sendfile = sendfile
+        self.accel_redirect_prefix = accel_redirect_prefix
+
+    def get_relative_path(self, key):
+        return os.path.join(key[0:2], key[2:4], key)
+
+    def path(self, key):
+        return os.path.join(self.location, self.get_relative_path(key))
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def save(self, img):
+        key = get_image_key(img)
+        path = self.path(key)
+        if os.path.isfile(path):
+            return key
+
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        # written aside and renamed so that readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(img)
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return key
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def serve(self, key, content_type):
+        if self.sendfile == 'x-sendfile':
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = self.path(key)
+            return response
+        if self.sendfile == 'x-accel-redirect':
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = '{}/{}'.format(
+                self.accel_redirect_prefix.rstrip('/'),
+                self.get_relative_path(key).replace(os.sep, '/'))
+            return response
+        return None
+
+
+def get_thumbnail_storage():
+    '''
+    Return the thumbnail storage configured by THUMBNAIL_CONFIG.
+    '''
+    global _storage
+
+    with _storage_lock:
+        if _storage is None:
+            conf = get_thumbnail_config()
+            storage_class = import_string(conf.get('storage', DEFAULT_STORAGE))
+            _storage = storage_class(
+                conf.get('store_dir', os.path.join(
+                    settings.MEDIA_ROOT, 'thumbnails')),
+                sendfile=conf.get('sendfile') or None,
+                accel_redirect_prefix=conf.get(
+                    'accel_redirect_prefix', '/thumbnail_store/')
+            )
+    return _storage
+
+
+def reset_thumbnail_storage():
+    global _storage
+
+    with _storage_lock:
+        _storage = None
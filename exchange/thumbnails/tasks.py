@@ -1,6 +1,6 @@
-import time
 import logging
 import base64
+import random
 from celery.task import task
 
 from django.db.models.signals import post_save
@@ -11,18 +11,28 @@ from geonode.utils import http_client
 
 from .models import is_automatic
 from .models import save_thumbnail
+from .storage import get_thumbnail_config
 
 logger = logging.getLogger(__name__)
 
 
+# Outcomes of a thumbnail request to GeoServer.
+#
+THUMBNAIL_READY = 'ready'
+# the layer is not ready yet, ask again later
+THUMBNAIL_PENDING = 'pending'
+THUMBNAIL_FAILED = 'failed'
+
+
 # Get a thumbnail image generated from GeoServer
 #
 # This is based on the function in GeoNode but gets
-# the image bytes instead.
+# the image bytes instead. Each call makes a single request,
+# attempt is the number of requests made before it.
 #
-# @return PNG bytes.
+# @return (outcome, PNG bytes or None).
 #
-def get_gs_thumbnail(instance):
+def get_gs_thumbnail(instance, attempt=0):
     from geonode.geoserver.helpers import ogc_server_settings
 
     if instance.class_name == 'Map':
@@ -32,7 +42,7 @@ def get_gs_thumbnail(instance):
                 local_layers.append(layer.name)
         layers = ",".join(local_layers).encode('utf-8')
         if(len(local_layers) == 0):
-            return None
+            return THUMBNAIL_FAILED, None
     else:
         layers = instance.typename.encode('utf-8')
         logger.debug('Instance storeType: %s', instance.storeType)
@@ -66,6 +76,10 @@ def get_gs_thumbnail(instance):
             params['styles'] = ''
             params['crs'] = 'epsg:4326'
 
+        # some remote services never render png8
+        if attempt > 4:
+            params['format'] = 'image/jpeg'
+
     # Avoid using urllib.urlencode here because it breaks the url.
     # commas and slashes in values get encoded and then cause trouble
     # with the WMS parser.
@@ -77,57 +91,62 @@ def get_gs_thumbnail(instance):
         if (instance.service.type == 'REST'):
             thumbnail_create_url = "%s/info/thumbnail" % (instance.ows_url)
 
-    tries = 0
-    max_tries = 15
-    while tries < max_tries:
+    logger.debug(
+        'Thumbnail: Requesting thumbnail from GeoServer. '
+        'Attempt %d for %s',
+        attempt + 1, thumbnail_create_url)
+    if (instance.storeType == 'remoteStore'):
+        resp, image = http_client.request(thumbnail_create_url)
+    else:
+        # Login using basic auth as geoserver admin
+        user = settings.GEOSERVER_USER
+        pword = settings.GEOSERVER_PASSWORD
+        auth = base64.encodestring(user + ':' + pword)
+        resp, image = http_client.request(
+            thumbnail_create_url,
+            'GET',
+            headers={'Authorization': 'Basic ' + auth}
+        )
+    if 200 <= resp.status <= 299:
+        if 'ServiceException' not in image:
+            return THUMBNAIL_READY, image
+        # Layer not ready yet, try again
         logger.debug(
-            'Thumbnail: Requesting thumbnail from GeoServer. '
-            'Attempt %d of %d for %s',
-            tries + 1, max_tries, thumbnail_create_url)
-        if (instance.storeType == 'remoteStore'):
-            if tries > 4:
-                thumbnail_create_url = thumbnail_create_url.replace(
-                    'image/png8', 'image/jpeg')
-            resp, image = http_client.request(thumbnail_create_url)
-        else:
-            # Login using basic auth as geoserver admin
-            user = settings.GEOSERVER_USER
-            pword = settings.GEOSERVER_PASSWORD
-            auth = base64.encodestring(user + ':' + pword)
-            resp, image = http_client.request(
-                thumbnail_create_url,
-                'GET',
-                headers={'Authorization': 'Basic ' + auth}
-            )
-        if 200 <= resp.status <= 299:
-            if 'ServiceException' not in image:
-                return image
-            else:
-                logger.debug(
-                    'Thumbnail: Encountered unexpected status code: %d.  '
-                    'Aborting.',
-                    resp.status)
-                logger.debug(resp)
-        else:
-            # Unexpected Error Code, Stop Trying
-            logger.debug(
-                'Thumbnail: Encountered unexpected status code: %d.  '
-                'Aborting.',
-                resp.status)
-            logger.debug(resp)
-            break
+            'Thumbnail: GeoServer returned a service exception.')
+        logger.debug(resp)
+        return THUMBNAIL_PENDING, None
 
-        # Layer not ready yet, try again
-        tries += 1
-        time.sleep(3)
+    # Unexpected Error Code, Stop Trying
+    logger.debug(
+        'Thumbnail: Encountered unexpected status code: %d.  '
+        'Aborting.',
+        resp.status)
+    logger.debug(resp)
+    return THUMBNAIL_FAILED, None
 
-    return None
+
+# Seconds to wait before the attempt following attempt number
+# 'attempt', doubling from 'retry_delay' up to 'retry_delay_max'.
+# Half of the delay is random so that the layers of a bulk import
+# do not all ask GeoServer again at once.
+#
+def get_retry_countdown(attempt):
+    conf = get_thumbnail_config()
+    delay = min(conf.get('retry_delay_max', 60),
+                conf.get('retry_delay', 3) * 2 ** attempt)
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
 
 
+# Generating a thumbnail takes one request to GeoServer per run
+# of the task. While GeoServer is not ready for the layer the task
+# retries itself later instead of sleeping in the worker, up to
+# 'generation_attempts' requests in all.
+#
 @task(
-    max_retries=1,
+    bind=True,
+    max_retries=None,
 )
-def generate_thumbnail_task(instance_id, class_name):
+def generate_thumbnail_task(self, instance_id, class_name):
     obj_type = None
     if class_name == 'Layer':
         try:
@@ -156,28 +175,42 @@ def generate_thumbnail_task(instance_id, class_name):
             'Thumbnail: Unsupported class: %s. Aborting.', class_name)
         return
 
+    attempt = self.request.retries
+    max_attempts = get_thumbnail_config().get('generation_attempts', 15)
     logger.debug(
-        'Thumbnail: Generating thumbnail for \'%s\' of type %s.',
-        instance_id, class_name)
+        'Thumbnail: Generating thumbnail for \'%s\' of type %s. '
+        'Attempt %d of %d.',
+        instance_id, class_name, attempt + 1, max_attempts)
     if(instance_id is not None and is_automatic(obj_type, instance_id)):
         # have geoserver generate a preview png and return it.
-        thumb_png = get_gs_thumbnail(instance)
+        outcome, thumb_png = get_gs_thumbnail(instance, attempt)
 
-        if(thumb_png is not None):
-            logger.debug(
-                'Thumbnail: Thumbnail successfully generated for \'%s\'.',
-                instance_id)
+        if outcome == THUMBNAIL_READY:
+            logger.info(
+                'Thumbnail: Thumbnail successfully generated for \'%s\' '
+                'after %d attempts.',
+                instance_id, attempt + 1)
             if (instance.is_remote):
                 save_thumbnail(obj_type, instance.service_typename,
-                               'image/png', thumb_png, True)
+                               'image/png', thumb_png, True,
+                               attempts=attempt + 1)
             else:
                 save_thumbnail(obj_type, instance_id,
-                               'image/png', thumb_png, True)
-        else:
+                               'image/png', thumb_png, True,
+                               attempts=attempt + 1)
+        elif (outcome == THUMBNAIL_PENDING and
+                attempt + 1 < max_attempts):
+            countdown = get_retry_countdown(attempt)
             logger.debug(
+                'Thumbnail: \'%s\' is not ready, attempt %d of %d in '
+                '%.1f seconds.',
+                instance_id, attempt + 2, max_attempts, countdown)
+            raise self.retry(countdown=countdown)
+        else:
+            logger.warn(
                 'Thumbnail: Unable to get thumbnail image from '
-                'GeoServer for \'%s\'.',
-                instance_id)
+                'GeoServer for \'%s\' after %d attempts.',
+                instance_id, attempt + 1)
 
 
 # This is used as a post-save signal that will
@@ -1,10 +1,12 @@
 
 from django.conf.urls import url
 
-from .views import thumbnail_view
+from .views import batch_thumbnail_view, thumbnail_view
 from .tasks import register_post_save_functions
 
 urlpatterns = (
+    url(r'^thumbnails/batch$',
+        batch_thumbnail_view, name='thumbnail_batch'),
     url(r'^thumbnails/(?P<objectType>maps|documents|layers)/(?P<objectId>.+)$',
         thumbnail_view, name='thumbnail_handler'),
 )
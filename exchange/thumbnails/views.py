@@ -6,19 +6,34 @@
 #
 
 
-from django.http import HttpResponse
-
-from base64 import b64decode
+from django.http import (HttpResponse, HttpResponseNotAllowed,
+                         HttpResponseNotModified, JsonResponse)
+from django.utils.cache import patch_cache_control
+from django.utils.http import (http_date, parse_etags, parse_http_date_safe,
+                               quote_etag)
+
+from base64 import b64decode, b64encode
+import calendar
 import imghdr
+import logging
 import os
 
+from .cache import ThumbnailEntry, thumbnail_cache
 from .models import Thumbnail, save_thumbnail
+from .storage import get_thumbnail_config, get_thumbnail_storage
 from geonode.documents.models import Document
 
+logger = logging.getLogger(__name__)
+
 # cache the missing thumbnail for missing images.
 TEST_DIR = os.path.dirname(__file__)
 MISSING_THUMB = open(
     os.path.join(TEST_DIR, 'static/missing_thumb.png'), 'r').read()
+MISSING_THUMB_URI = 'data:image/png;base64,' + b64encode(MISSING_THUMB)
+
+OBJECT_TYPES = ('maps', 'documents', 'layers')
+# most thumbnails returned by a batch request
+BATCH_LIMIT = 100
 
 
 def document_thumbnail(objectId):
@@ -34,22 +49,164 @@ def document_thumbnail(objectId):
         return img
 
 
+def make_entry(thumb, img=None):
+    # stored images are only read when a response sends them, img is
+    # the image of thumbnails not moved to the thumbnail storage yet.
+    etag = None
+    if thumb.thumbnail_hash:
+        etag = quote_etag(thumb.thumbnail_hash)
+    last_modified = None
+    if thumb.last_modified:
+        last_modified = calendar.timegm(thumb.last_modified.utctimetuple())
+    return ThumbnailEntry(thumb.thumbnail_mime, img, thumb.thumbnail_hash,
+                          etag, last_modified)
+
+
+def load_entries(keys):
+    # a single IN query for every (object type, object id) key, it may
+    # match a few more rows than asked for, those are skipped.
+    # keys left out are cached as missing until a save bumps their version.
+    thumbs = Thumbnail.objects.defer('thumbnail_img').filter(
+        object_type__in=set(k[0] for k in keys),
+        object_id__in=set(k[1] for k in keys))
+
+    wanted = set(keys)
+    found = [thumb for thumb in thumbs
+             if (thumb.object_type, thumb.object_id) in wanted]
+
+    # images still in the database are read with one more query
+    legacy = [thumb.pk for thumb in found if not thumb.thumbnail_hash]
+    images = {}
+    if legacy:
+        images = dict(
+            (pk, bytes(img)) for pk, img in Thumbnail.objects.filter(
+                pk__in=legacy).values_list('pk', 'thumbnail_img')
+            if img is not None)
+
+    entries = {}
+    for thumb in found:
+        entries[(thumb.object_type, thumb.object_id)] = make_entry(
+            thumb, images.get(thumb.pk))
+    return entries
+
+
+def read_image(key):
+    with get_thumbnail_storage().open(key) as f:
+        return f.read()
+
+
+def get_entry_image(entry):
+    '''
+    Return the image of an entry, None if it is no longer stored.
+    '''
+    if entry.img is not None:
+        return entry.img
+    try:
+        return thumbnail_cache.get_image(entry.key, read_image)
+    except IOError as e:
+        logger.warn('Thumbnail: unable to read image %s: %s', entry.key, e)
+        return None
+
+
+def serve_entry(entry):
+    # None when the image is no longer stored
+    if entry.img is None:
+        response = get_thumbnail_storage().serve(entry.key, entry.mime)
+        if response is not None:
+            return response
+    img = get_entry_image(entry)
+    if img is None:
+        return None
+    return HttpResponse(img, content_type=entry.mime)
+
+
+def is_not_modified(request, etag, last_modified):
+    # If-None-Match takes precedence over If-Modified-Since
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etag is not None and (
+            '*' in etags or etag.strip('"') in etags)
+
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE'))
+    return (last_modified is not None and if_modified_since is not None and
+            last_modified <= if_modified_since)
+
+
+def set_cache_headers(response, etag, last_modified):
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    # the thumbnail url stays the same when the image changes, clients
+    # keep it for max_age seconds and then check it with the validators
+    patch_cache_control(
+        response, public=True,
+        max_age=get_thumbnail_config().get('max_age', 3600))
+    return response
+
+
+def get_data_uri(entry):
+    img = get_entry_image(entry) if entry is not None else None
+    if img is None:
+        return MISSING_THUMB_URI
+    return 'data:{};base64,{}'.format(
+        entry.mime or 'image/png', b64encode(img))
+
+
+# Returns the thumbnails of many objects in a single response, for
+# search result pages.
+#
+# GET /thumbnails/batch?id=maps/1&id=layers/geonode:roads
+#
+# returns a JSON object mapping every id to a data URI of its thumbnail,
+# or of the missing thumbnail when there is none.
+#
+def batch_thumbnail_view(request):
+    if(request.method != 'GET'):
+        return HttpResponseNotAllowed(['GET'])
+
+    keys = []
+    for value in request.GET.getlist('id'):
+        objectType, _, objectId = value.partition('/')
+        if(objectType not in OBJECT_TYPES or not objectId):
+            return HttpResponse(
+                status=400, content=u'Bad thumbnail id: {}'.format(value))
+        keys.append((objectType, objectId))
+    if(len(keys) > BATCH_LIMIT):
+        return HttpResponse(
+            status=400,
+            content='At most {} thumbnails per batch.'.format(BATCH_LIMIT))
+
+    entries = thumbnail_cache.get_many(keys, load_entries)
+    thumbnails = dict(
+        (u'{}/{}'.format(*key), get_data_uri(entries.get(key)))
+        for key in keys)
+
+    response = JsonResponse({'thumbnails': thumbnails})
+    patch_cache_control(
+        response, public=True,
+        max_age=get_thumbnail_config().get('max_age', 3600))
+    return response
+
+
 def thumbnail_view(request, objectType, objectId):
     global MISSING_THUMB, ID_PATTERN
 
-    thumb = None
-    try:
-        thumb = Thumbnail.objects.get(object_type=objectType,
-                                      object_id=objectId)
-    except Thumbnail.DoesNotExist:
-        # move along, the code tests for None later.
-        pass
-
     if(request.method == 'GET'):
-        # if the thumb is not None, return it.
-        if(thumb is not None):
-            return HttpResponse(thumb.thumbnail_img,
-                                content_type=thumb.thumbnail_mime)
+        # popular thumbnails are answered from the cache
+        entry = thumbnail_cache.get((objectType, objectId), load_entries)
+
+        # if the thumb exists, return it.
+        if(entry is not None):
+            if is_not_modified(request, entry.etag, entry.last_modified):
+                response = HttpResponseNotModified()
+            else:
+                response = serve_entry(entry)
+            if(response is not None):
+                return set_cache_headers(response, entry.etag,
+                                         entry.last_modified)
 
         # if the thumbnail is for a document
         # create default thumbnail
@@ -99,6 +99,22 @@ if settings.ES_SEARCH:
     urlpatterns += [url(r'^api/(?P<resourcetype>registry)/search/$',
                         'exchange.search.views.elastic_search',
                         name='elastic_search')]
+    urlpatterns += [url(r'^api/(?P<resourcetype>base|documents|layers|maps'
+                        r'|registry)/search/export/$',
+                        'exchange.search.views.export_search',
+                        name='export_search')]
+    urlpatterns += [url(r'^api/(?P<resourcetype>base|documents|layers|maps'
+                        r'|registry)/search/suggest/$',
+                        'exchange.search.views.suggest',
+                        name='suggest_search')]
+    urlpatterns += [url(r'^api/(?P<resourcetype>base|documents|layers|maps'
+                        r'|registry)/search/grid/$',
+                        'exchange.search.views.grid_search',
+                        name='grid_search')]
+    # the site search box, other autocomplete_light lookups stay empty
+    urlpatterns += [url(r'^autocomplete/ResourceBaseAutocomplete/',
+                        'exchange.search.views.autocomplete',
+                        name='autocomplete_search')]
     urlpatterns += [url(r'^autocomplete',
                         views.empty_page,
                         name='autocomplete_override')]